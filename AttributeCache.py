@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## An in-process cache of file attributes (the dicts returned by getattr), keyed by path.
+##
+## Entries expire after ttl seconds (or the ttl given to put) and the cache never holds more than max_entries
+## paths - the least recently used entry is evicted first. Changes done through this mount invalidate the
+## affected paths, changes done by other mounts become visible once the entry expired.
+##
+## Usage:
+##      attr_cache = AttributeCache(ttl=1.0, max_entries=10000)
+##      st = attr_cache.get('/test/images/file.jpg')
+##      if st is None:
+##          st = attr_cache.put('/test/images/file.jpg', dict(st_size=...))
+##      attr_cache.invalidate('/test/images/file.jpg')
+
+import threading
+from time import time
+from collections import OrderedDict
+
+
+class AttributeCache(object):
+    def __init__(self, ttl=1.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # path -> (expiry timestamp, attributes), oldest use first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is None or entry[0] < time():
+                self.misses += 1
+                return None
+            # re-insert to mark it as most recently used
+            self._entries[path] = entry
+            self.hits += 1
+            return entry[1]
+
+    # stores the attributes and hands them back, so callers can simply return the result
+    def put(self, path, attrs, ttl=None):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return attrs
+        with self._lock:
+            self._entries.pop(path, None)
+            self._entries[path] = (time() + (ttl if ttl is not None else self.ttl), attrs)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return attrs
+
+    # whether a valid entry exists - without counting it as a hit or using it
+    def __contains__(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            return entry is not None and entry[0] >= time()
+
+    def invalidate(self, *paths):
+        with self._lock:
+            for path in paths:
+                self._entries.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, entries=len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## Fetches the attributes of listed files in the background, so the stats following a readdir hit the cache.
+##
+## prefetch() splits the entries of a listing into batches of batch_size and queues them for concurrency
+## worker threads; each batch is fetched by one call of fetch_batch (e.g. over one pooled connection).
+## A getattr arriving while the batch of its entry is being fetched waits for it with wait() instead of asking
+## RIAK a second time - a batch still waiting in the queue is not waited for, the getattr is quicker on its own.
+## When the queue is full, further entries are simply not prefetched.
+##
+## Usage:
+##      prefetcher = AttributePrefetcher(fetch_batch, batch_size=100, concurrency=4)
+##      prefetcher.start()
+##      prefetcher.prefetch([('/test/images/file.jpg', 'IMGDIR_test', 'file.jpg'), ...])
+##      prefetcher.wait('/test/images/file.jpg', timeout=10)
+
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger('root')
+
+
+class AttributePrefetcher(object):
+    # fetch_batch(list of entries) has to load the attributes of the entries into the attribute cache,
+    # an entry is a tuple whose first element is the path
+    def __init__(self, fetch_batch, batch_size=100, concurrency=4, max_queued_batches=1000):
+        self.fetch_batch = fetch_batch
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+
+        self._lock = threading.Lock()
+        # path -> event set once the batch holding it is done
+        self._pending = {}
+        # the events of the batches being fetched right now
+        self._running = set()
+        self._batches = queue.Queue(max_queued_batches)
+        self._threads = []
+
+        self.batches = 0
+        self.entries = 0
+        self.dropped = 0
+
+    def prefetch(self, entries):
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= self.batch_size:
+                self._queue(batch)
+                batch = []
+        if batch:
+            self._queue(batch)
+
+    def _queue(self, batch):
+        done = threading.Event()
+        with self._lock:
+            # entries already on their way are not fetched twice
+            batch = [entry for entry in batch if entry[0] not in self._pending]
+            if not batch:
+                return
+            for entry in batch:
+                self._pending[entry[0]] = done
+        try:
+            self._batches.put_nowait((batch, done))
+        except queue.Full:
+            with self._lock:
+                self.dropped += len(batch)
+            self._finish(batch, done)
+
+    def _finish(self, batch, done):
+        with self._lock:
+            self._running.discard(done)
+            for entry in batch:
+                if self._pending.get(entry[0]) is done:
+                    del self._pending[entry[0]]
+        done.set()
+
+    # waits for a running prefetch of path, returns False if there is none (or it is still queued)
+    def wait(self, path, timeout=None):
+        with self._lock:
+            done = self._pending.get(path)
+            if done not in self._running:
+                return False
+        return done.wait(timeout)
+
+    def _worker(self):
+        while True:
+            item = self._batches.get()
+            if item is None:
+                break
+            batch, done = item
+            with self._lock:
+                self._running.add(done)
+            try:
+                self.fetch_batch(batch)
+                with self._lock:
+                    self.batches += 1
+                    self.entries += len(batch)
+            except Exception as e:
+                logger.warning('could not prefetch attributes of %s entries (Exception: %s)'% (len(batch),str(e)))
+            finally:
+                self._finish(batch, done)
+
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._worker, name='attribute-prefetch')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        # queued batches are of no use anymore
+        while True:
+            try:
+                batch, done = self._batches.get_nowait()
+            except queue.Empty:
+                break
+            self._finish(batch, done)
+        for thread in self._threads:
+            self._batches.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        with self._lock:
+            return dict(batches=self.batches, entries=self.entries, dropped=self.dropped, pending=len(self._pending))
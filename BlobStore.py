@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+## Content-addressed storage of file contents (deduplication).
+##
+## Every distinct content is stored once as a blob in a shared blob bucket, named after its sha1. The key of
+## a file only holds a small reference to its blob, recognized by its content type - so references, plain
+## objects and chunked files live side by side:
+##      IMG_test/file.jpg          -> {"blob": "<sha1>", "bucket": "IMGBLOBS", "size": 52311, "ref": "<token>"}
+##      IMGBLOBS/<sha1>            -> the contents (a plain object or a chunked file, compressed or not)
+##      sets: IMGBLOBS/<sha1>      -> the tokens of all references to the blob
+##
+## The set of tokens is the reference count of a blob: a new reference adds its token before it is stored,
+## dropping a reference discards the token and the last one to leave deletes the blob. Tokens make retries
+## harmless. A renamed file gets a token of its own (link) before its new key is stored, the old token is
+## dropped after the old key is gone. Storing contents that exist already only costs a hash pass over the
+## local copy and a head request - the upload is skipped.
+##
+## All changes to one blob are serialized within a process. A blob deleted by another mount right while its
+## contents are stored again is noticed by a second head request after the reference was stored and uploaded again.
+##
+## Usage:
+##      blob_store = BlobStore(riak_pool, 'IMGBLOBS')
+##      record = blob_store.storeFile('IMG_test', 'file.jpg', '/test/images/file.jpg')
+##      with riak_pool.client() as riakClient:
+##          reference = fetchReference(riakClient.bucket('IMG_test'), 'file.jpg')
+##          riakClient.bucket('IMG_test').delete('file.jpg')
+##      blob_store.drop(reference)
+
+import os
+import json
+import uuid
+import logging
+import hashlib
+import threading
+
+import riak.datatypes as datatypes
+
+import ChunkStore
+import FileMetadata
+import Uploader
+from LockTable import LockTable
+
+logger = logging.getLogger('root')
+
+REFERENCE_CONTENT_TYPE = 'application/x-riak-fuse-reference'
+
+
+def isReference(riak_object):
+    return riak_object.exists and riak_object.content_type == REFERENCE_CONTENT_TYPE
+
+
+def loadReference(riak_object):
+    encoded_data = riak_object.encoded_data
+    if isinstance(encoded_data, bytes):
+        encoded_data = encoded_data.decode('utf-8')
+    return json.loads(encoded_data)
+
+
+# returns the reference currently stored under key or None if it is no deduplicated file (a head request if it isn't)
+def fetchReference(bucket, key):
+    riak_object = bucket.get(key, head_only=True)
+    if not isReference(riak_object):
+        return None
+    return loadReference(bucket.get(key))
+
+
+def storeReference(bucket, key, reference, quorum=None):
+    bucket.new(key, encoded_data=json.dumps(reference), content_type=REFERENCE_CONTENT_TYPE).store(return_body=False, **(quorum or {}))
+
+
+# the blob object a reference points to (a manifest if the blob is chunked)
+def fetchBlob(riakClient, reference):
+    return riakClient.bucket(reference['bucket']).get(reference['blob'])
+
+
+# (sha1, size, mtime) of the file, read in pieces of 1MB
+def _fileDigest(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        st = os.fstat(f.fileno())
+        while True:
+            data = f.read(1024*1024)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest(), st.st_size, st.st_mtime
+
+
+class BlobStore(object):
+    # the blobs are stored with content_type, chunk_size, budget, compressor and quorum like Uploader.storeFile stores files,
+    # chunks of deleted blobs and replaced chunked files are deleted by the given ChunkStore.ChunkDeleter
+    def __init__(self, riak_pool, blob_bucket='IMGBLOBS', bucket_type='sets', content_type='application/octet-stream',
+                 chunk_size=0, budget=None, compressor=None, quorum=None, deleter=None):
+        self.riak_pool = riak_pool
+        self.blob_bucket = blob_bucket
+        self.bucket_type = bucket_type
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self.budget = budget
+        self.compressor = compressor
+        self.quorum = quorum
+        self.deleter = deleter
+        # one change to the references of a blob at a time (always taken before a pooled connection)
+        self._locks = LockTable()
+
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.uploaded = 0
+        self.bytes_stored = 0
+        self.bytes_uploaded = 0
+        self.dropped = 0
+        self.blobs_deleted = 0
+
+    def _referrers(self, riakClient, bucket, blob):
+        return datatypes.Set(riakClient.bucket_type(self.bucket_type).bucket(bucket), blob)
+
+    def _upload(self, riakClient, blob, filename, name):
+        record = Uploader.storeFile(riakClient.bucket(self.blob_bucket), blob, filename, self.content_type, self.chunk_size,
+                                    self.budget, self.compressor, name, self.quorum)
+        if record['sha1'] != blob:
+            # changed since it was hashed - nobody may find other contents under this name
+            bucket = riakClient.bucket(self.blob_bucket)
+            manifest = ChunkStore.fetchManifest(bucket, blob)
+            bucket.delete(blob)
+            if manifest is not None:
+                ChunkStore.deleteChunks(bucket, manifest)
+            raise IOError('%s changed while it was stored'% (filename))
+        with self._lock:
+            self.uploaded += 1
+            self.bytes_uploaded += record['size']
+
+    ## Stores filename as reference under bucket/key to its blob, uploading the blob only if it isn't stored yet,
+    ## and returns the metadata record of the file. Whatever was stored under the key before is cleaned up.
+    ## Must not be called with a pooled connection held.
+    def storeFile(self, bucket, key, filename):
+        blob, size, mtime = _fileDigest(filename)
+        record = FileMetadata.makeRecord(size, mtime, blob)
+        with self.riak_pool.client() as riakClient:
+            previous = riakClient.bucket(bucket).get(key, head_only=True)
+            old_reference = loadReference(riakClient.bucket(bucket).get(key)) if isReference(previous) else None
+            old_manifest = ChunkStore.fetchManifest(riakClient.bucket(bucket), key) if ChunkStore.isManifest(previous) else None
+        if (old_reference is not None) and (old_reference['blob'] == blob) and (old_reference['bucket'] == self.blob_bucket):
+            # the key refers to these contents already
+            with self._lock:
+                self.stored += 1
+                self.bytes_stored += size
+            return record
+
+        reference = dict(blob=blob, bucket=self.blob_bucket, size=size, ref=uuid.uuid4().hex)
+        with self._locks.lock(blob):
+            with self.riak_pool.client() as riakClient:
+                # counted before anybody can find it - a blob is never deleted under a reference
+                referrers = self._referrers(riakClient, self.blob_bucket, blob)
+                referrers.add(reference['ref'])
+                referrers.store()
+                blob_bucket = riakClient.bucket(self.blob_bucket)
+                if not blob_bucket.get(blob, head_only=True).exists:
+                    self._upload(riakClient, blob, filename, key)
+                storeReference(riakClient.bucket(bucket), key, reference, self.quorum)
+                if not blob_bucket.get(blob, head_only=True).exists:
+                    # another mount dropped the last reference in the meantime
+                    self._upload(riakClient, blob, filename, key)
+                if old_manifest is not None:
+                    ChunkStore.deleteChunks(riakClient.bucket(bucket), old_manifest, self.deleter)
+        with self._lock:
+            self.stored += 1
+            self.bytes_stored += size
+        logger.debug('stored %s/%s as reference to blob %s', bucket,key,blob)
+        if old_reference is not None:
+            self.drop(old_reference)
+        return record
+
+    ## Returns a copy of the reference with a token of its own, counted before it is returned - for a key taking
+    ## over the contents of another one (rename). Must not be called with a pooled connection held.
+    def link(self, reference):
+        linked = dict(reference, ref=uuid.uuid4().hex)
+        with self._locks.lock(reference['blob']):
+            with self.riak_pool.client() as riakClient:
+                referrers = self._referrers(riakClient, reference['bucket'], reference['blob'])
+                referrers.add(linked['ref'])
+                referrers.store()
+        return linked
+
+    ## Drops a reference whose key is gone (unlink) or replaced - the blob is deleted with its last reference.
+    ## Must not be called with a pooled connection held.
+    def drop(self, reference):
+        blob = reference['blob']
+        with self._locks.lock(blob):
+            with self.riak_pool.client() as riakClient:
+                referrers = self._referrers(riakClient, reference['bucket'], blob)
+                referrers.reload()
+                remaining = set(referrers.value)
+                if reference['ref'] in remaining:
+                    referrers.discard(reference['ref'])
+                    referrers.store()
+                    remaining.discard(reference['ref'])
+                with self._lock:
+                    self.dropped += 1
+                if remaining:
+                    return
+                blob_bucket = riakClient.bucket(reference['bucket'])
+                manifest = ChunkStore.fetchManifest(blob_bucket, blob)
+                blob_bucket.delete(blob)
+                if manifest is not None:
+                    ChunkStore.deleteChunks(blob_bucket, manifest, self.deleter)
+        with self._lock:
+            self.blobs_deleted += 1
+        logger.debug('deleted blob %s with its last reference', blob)
+
+    def stats(self):
+        with self._lock:
+            return dict(stored=self.stored, uploaded=self.uploaded, deduplicated=self.stored - self.uploaded,
+                        bytes_stored=self.bytes_stored, bytes_uploaded=self.bytes_uploaded,
+                        bytes_saved=self.bytes_stored - self.bytes_uploaded,
+                        dedup_ratio=float(self.bytes_stored) / self.bytes_uploaded if self.bytes_uploaded else 0.0,
+                        dropped=self.dropped, blobs_deleted=self.blobs_deleted)
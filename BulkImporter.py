@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+## Imports an existing source tree into RIAK without going through the mount.
+##
+## Every file the path template maps is stored exactly like release() stores it: contents (chunked when
+## larger than the chunk size) under the same bucket/key, size set / metadata record and directory listing
+## in the directory bucket (see RiakDirectory). One thread walks the tree, a pool of workers uploads; the
+## upload budget bounds the bytes held by all running uploads together.
+##
+## Finished files are appended to a checkpoint file, a file is only recorded once it is listed in its
+## directory set. A later run skips files recorded with the same size and mtime - an interrupted import is
+## simply started again. With delete_local a file is removed once it is recorded (unless it changed meanwhile).
+##
+## Usage:
+##      checkpoint = ImportCheckpoint('/var/lib/riak-fuse/import.checkpoint')
+##      importer = BulkImporter('/mnt/source', riak_pool, path_mapper, riak_directory, checkpoint, workers=16)
+##      stats = importer.run()
+
+import os
+import json
+import stat
+import logging
+import threading
+from time import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import Uploader
+from LockTable import LockTable
+from DirectoryCoalescer import DirectoryCoalescer
+
+logger = logging.getLogger('root')
+
+
+## Append-only record of imported files: one JSON line {"path": ..., "size": ..., "mtime": ...} per file.
+## Lines are synced every sync_every records and on close - a crash loses at most those, which are then
+## imported once more (storing a file again is harmless).
+class ImportCheckpoint(object):
+    def __init__(self, checkpoint_path, sync_every=100):
+        self.checkpoint_path = checkpoint_path
+        self.sync_every = sync_every
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._file = None
+
+    # returns path -> (size, mtime) of everything recorded so far
+    def load(self):
+        done = {}
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # torn last line of a crash - that file is imported again
+                        continue
+                    done[record['path']] = (record['size'], record['mtime'])
+        return done
+
+    def record(self, path, size, mtime):
+        line = (json.dumps({'path': path, 'size': size, 'mtime': mtime}) + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is None:
+                self._file = os.open(self.checkpoint_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self._file, line)
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every:
+                os.fsync(self._file)
+                self._unsynced = 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                os.fsync(self._file)
+                os.close(self._file)
+                self._file = None
+
+
+class BulkImporter(object):
+    # riak_directory None leaves the directory structure alone (like --disable_maintain_directory)
+    def __init__(self, root, riak_pool, path_mapper, riak_directory=None, checkpoint=None, content_type='application/octet-stream',
+                 chunk_size=0, budget=None, workers=8, delete_local=False, flush_window=5.0, flush_batch=1000, compressor=None,
+                 blob_store=None):
+        self.root = root
+        self.riak_pool = riak_pool
+        self.path_mapper = path_mapper
+        self.riak_directory = riak_directory
+        self.checkpoint = checkpoint
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self.budget = budget
+        self.compressor = compressor
+        # files with contents that were stored already only get a reference (see BlobStore)
+        self.blob_store = blob_store
+        self.workers = workers
+        self.delete_local = delete_local
+
+        # two source paths may map to the same key - never upload both at once
+        self.key_locks = LockTable()
+        self._queue = queue.Queue(workers * 4)
+        self._lock = threading.Lock()
+        # (directory bucket, key) -> [(path, size, mtime)] stored, but not listed in the directory set yet
+        self._unlisted = {}
+        if riak_directory is not None:
+            self.directory_updates = DirectoryCoalescer(self._flush_directory, window=flush_window, batch_size=flush_batch)
+        else:
+            self.directory_updates = None
+
+        self.started = None
+        self.files = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.unmappable = 0
+        self.failed = 0
+        self.deleted = 0
+
+    # ==================
+    # Walking
+    # ==================
+
+    # yields (path below root, lstat result) of every regular file
+    def _walk(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                full_path = os.path.join(dirpath, filename)
+                try:
+                    st = os.lstat(full_path)
+                except OSError as e:
+                    # removed while walking
+                    logger.warning('could not stat %s (Exception: %s)'% (full_path,str(e)))
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    yield '/' + os.path.relpath(full_path, self.root).replace(os.sep, '/'), st
+
+    def _full_path(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    # ==================
+    # Uploading
+    # ==================
+
+    def _import(self, path):
+        RiakBucketNamespace, RiakDirectoryBucketNamespace, RiakKeyNamespace = self.path_mapper.map(path)
+        with self.key_locks.lock((RiakBucketNamespace,RiakKeyNamespace)):
+            if self.blob_store is not None:
+                # borrows its own connections
+                record = self.blob_store.storeFile(RiakBucketNamespace, RiakKeyNamespace, self._full_path(path))
+            with self.riak_pool.client() as riakClient:
+                if self.blob_store is None:
+                    record = Uploader.storeFile(riakClient.bucket(RiakBucketNamespace), RiakKeyNamespace, self._full_path(path), self.content_type, self.chunk_size, self.budget, self.compressor)
+                if self.riak_directory is not None:
+                    self.riak_directory.store_size(riakClient, RiakDirectoryBucketNamespace, RiakKeyNamespace, record)
+        with self._lock:
+            self.files += 1
+            self.bytes += record['size']
+        if self.directory_updates is None:
+            self._finish(path, record['size'], record['mtime'])
+            return
+        # recorded once the next flush listed it
+        with self._lock:
+            self._unlisted.setdefault((RiakDirectoryBucketNamespace,RiakKeyNamespace), []).append((path, record['size'], record['mtime']))
+        self.directory_updates.add(RiakDirectoryBucketNamespace, RiakKeyNamespace)
+
+    def _flush_directory(self, directory, adds, discards):
+        self.riak_directory.flush(directory, adds, discards)
+        finished = []
+        with self._lock:
+            for key in adds:
+                finished.extend(self._unlisted.pop((directory,key), []))
+        for path, size, mtime in finished:
+            self._finish(path, size, mtime)
+
+    # the file is completely in RIAK now
+    def _finish(self, path, size, mtime):
+        if self.checkpoint is not None:
+            self.checkpoint.record(path, size, mtime)
+        if not self.delete_local:
+            return
+        full_path = self._full_path(path)
+        try:
+            st = os.stat(full_path)
+            if st.st_size != size or st.st_mtime != mtime:
+                logger.warning('%s changed during the import - not removing the local copy'% (path))
+                return
+            os.unlink(full_path)
+        except OSError as e:
+            logger.warning('could not remove local copy %s (Exception: %s)'% (path,str(e)))
+            return
+        with self._lock:
+            self.deleted += 1
+
+    def _worker(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                break
+            try:
+                self._import(path)
+            except Exception as e:
+                logger.error('ERROR importing %s - it is retried by the next run (Exception: %s)'% (path,str(e)))
+                with self._lock:
+                    self.failed += 1
+
+    # ==================
+    # Progress
+    # ==================
+
+    def stats(self):
+        with self._lock:
+            elapsed = max(time() - self.started, 0.001) if self.started is not None else 0.001
+            return dict(files=self.files, bytes=self.bytes, skipped=self.skipped, unmappable=self.unmappable,
+                        failed=self.failed, deleted=self.deleted, seconds=elapsed,
+                        mb_per_second=self.bytes / 1048576.0 / elapsed, files_per_second=self.files / elapsed)
+
+    def _report(self):
+        stats = self.stats()
+        logger.info('%s files (%.1f MB) imported in %.0fs - %.2f MB/s, %.1f files/s (%s skipped, %s failed)'% (
+            stats['files'],stats['bytes'] / 1048576.0,stats['seconds'],stats['mb_per_second'],stats['files_per_second'],stats['skipped'],stats['failed']))
+
+    def _reporter(self, interval, stopped):
+        while not stopped.wait(interval):
+            self._report()
+
+    # imports the whole tree, reports progress every progress_interval seconds and returns the final stats
+    def run(self, progress_interval=10):
+        done = self.checkpoint.load() if self.checkpoint is not None else {}
+        if done:
+            logger.info('%s files are recorded in the checkpoint %s already'% (len(done),self.checkpoint.checkpoint_path))
+        self.started = time()
+        if self.directory_updates is not None:
+            self.directory_updates.start()
+        threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name='import-worker')
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        stopped = threading.Event()
+        reporter = None
+        if progress_interval > 0:
+            reporter = threading.Thread(target=self._reporter, args=(progress_interval, stopped), name='import-progress')
+            reporter.daemon = True
+            reporter.start()
+
+        try:
+            for path, st in self._walk():
+                # the same test as the mount's - a matching bucket alone does not give the file a key
+                if self.path_mapper.map(path).key is None:
+                    with self._lock:
+                        self.unmappable += 1
+                    continue
+                if done.get(path) == (st.st_size, st.st_mtime):
+                    with self._lock:
+                        self.skipped += 1
+                    continue
+                # waits while the workers are busy, the walk never runs far ahead
+                self._queue.put(path)
+        finally:
+            for thread in threads:
+                self._queue.put(None)
+            for thread in threads:
+                thread.join()
+            if self.directory_updates is not None:
+                # lists (and records) whatever is still waiting for a flush
+                self.directory_updates.close()
+            with self._lock:
+                unlisted = sum(len(files) for files in self._unlisted.values())
+            if unlisted:
+                logger.error('%s imported files could not be listed in their directory sets - they are imported again by the next run'% (unlisted))
+            if self.checkpoint is not None:
+                self.checkpoint.close()
+            stopped.set()
+            if reporter is not None:
+                reporter.join()
+        self._report()
+        return self.stats()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## Chunked storage of large files in a RIAK content bucket.
+##
+## A chunked file is stored as a small manifest under its own key plus one object per fixed-size chunk.
+## The manifest is recognized by its content type, so chunked and plain objects live side by side:
+##      IMG_test/file.jpg                  -> {"id": "<id>", "size": 10485760, "chunk_size": 1048576, "chunks": ["<id>/<sha1>", ...]}
+##      IMG_test/<id>/<sha1 of chunk>      -> the bytes of that chunk
+##
+## Chunk keys contain a "/" and therefore never collide with file names. They are named after the random id
+## of their manifest and their contents, not after the key: a manifest keeps its chunks when it is moved to
+## another key (rename) and a file stored under the old key again gets chunks of its own. Rewriting a file
+## keeps the id of its manifest, so only the chunks that changed are uploaded and readers of the old manifest
+## never see a half-written chunk. The manifest is stored after all of its chunks, obsolete chunks are removed last
+## (after a grace period when a ChunkDeleter is given, so readers of the previous manifest can finish).
+## Chunks may be compressed (see Compression), chunk keys and sizes are always those of the plain bytes.
+##
+## Usage:
+##      readahead_pool = ReadaheadPool(workers=4)
+##      chunk_deleter = ChunkDeleter(riak_pool, grace=60)
+##      readahead_pool.start(); chunk_deleter.start()
+##      manifest = storeChunked(bucket, 'file.jpg', f, 1024*1024, 'image/jpeg', deleter=chunk_deleter)
+##      reader = ChunkReader(manifest, fetch, readahead=2, pool=readahead_pool)
+##      reader.read(4096, 0)
+##      readahead_pool.close(); chunk_deleter.close()
+
+import json
+import uuid
+import errno
+import logging
+import hashlib
+import threading
+from time import time
+from collections import OrderedDict, deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import Compression
+
+logger = logging.getLogger('root')
+
+MANIFEST_CONTENT_TYPE = 'application/x-riak-fuse-manifest'
+
+
+def isManifest(riak_object):
+    return riak_object.exists and riak_object.content_type == MANIFEST_CONTENT_TYPE
+
+
+def loadManifest(riak_object):
+    encoded_data = riak_object.encoded_data
+    if isinstance(encoded_data, bytes):
+        encoded_data = encoded_data.decode('utf-8')
+    return json.loads(encoded_data)
+
+
+def chunkKey(manifest_id, data):
+    return '%s/%s'% (manifest_id, hashlib.sha1(data).hexdigest())
+
+
+# returns the manifest currently stored under key or None if it is no chunked file (a head request if it isn't)
+def fetchManifest(bucket, key):
+    riak_object = bucket.get(key, head_only=True)
+    if not isManifest(riak_object):
+        return None
+    return loadManifest(bucket.get(key))
+
+
+## Stores the opened file f as manifest + chunks under key, reading it chunk by chunk. The new manifest takes
+## over the id of the previous manifest of the key, its chunks that are referenced already are not uploaded
+## again. Returns the new manifest.
+## A given hashlib digest is updated with the whole contents on the way, a given compressor compresses the chunks
+## (taking the file extension from name, which defaults to key). Chunks and manifest are stored with the given
+## quorum (see Compression.storeObject), obsolete chunks are deleted by the given ChunkDeleter (right away without one).
+def storeChunked(bucket, key, f, chunk_size, content_type, digest=None, compressor=None, name=None, quorum=None, deleter=None):
+    old_manifest = fetchManifest(bucket, key)
+    old_chunks = set(old_manifest['chunks']) if old_manifest is not None else set()
+    # manifests written before they had an id get one now (their chunks are all replaced then)
+    manifest_id = old_manifest.get('id') if old_manifest is not None else None
+    if manifest_id is None:
+        manifest_id = uuid.uuid4().hex
+
+    chunks = []
+    size = 0
+    uploaded = 0
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        size += len(data)
+        if digest is not None:
+            digest.update(data)
+        chunk_key = chunkKey(manifest_id, data)
+        if (chunk_key not in old_chunks) and (chunk_key not in chunks):
+            Compression.storeObject(bucket, chunk_key, data, content_type, compressor, name=name or key, quorum=quorum)
+            uploaded += 1
+        chunks.append(chunk_key)
+
+    manifest = dict(id=manifest_id, size=size, chunk_size=chunk_size, content_type=content_type, chunks=chunks)
+    bucket.new(key, encoded_data=json.dumps(manifest), content_type=MANIFEST_CONTENT_TYPE).store(return_body=False, **(quorum or {}))
+    logger.debug('stored %s as %s chunks (%s uploaded)', key,len(chunks),uploaded)
+
+    # only now nobody can find the chunks of the old version anymore (readers that have its manifest still can)
+    _deleteChunkKeys(bucket, old_chunks - set(chunks), deleter)
+    return manifest
+
+
+def deleteChunks(bucket, manifest, deleter=None):
+    _deleteChunkKeys(bucket, set(manifest['chunks']), deleter)
+
+
+def _deleteChunkKeys(bucket, chunk_keys, deleter):
+    if deleter is not None:
+        deleter.delete(bucket, chunk_keys)
+        return
+    for chunk_key in chunk_keys:
+        bucket.delete(chunk_key)
+
+
+## Deletes obsolete chunks a grace period after they became obsolete instead of right away, so a reader that
+## fetched the manifest just before it was replaced or its file removed can read it to the end.
+## Borrows its own connections from the pool. Chunks still waiting are deleted by close(), a crash leaves them
+## behind in RIAK.
+class ChunkDeleter(object):
+    def __init__(self, riak_pool, grace=60):
+        self.riak_pool = riak_pool
+        self.grace = grace
+
+        self._lock = threading.Condition()
+        # (due time, bucket name, chunk keys) - oldest first
+        self._due = deque()
+        self._closing = False
+        self._thread = None
+        self.deleted = 0
+        self.errors = 0
+
+    def delete(self, bucket, chunk_keys):
+        chunk_keys = list(chunk_keys)
+        if not chunk_keys:
+            return
+        with self._lock:
+            self._due.append((time() + self.grace, bucket.name, chunk_keys))
+            self._lock.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while (not self._closing) and ((not self._due) or (self._due[0][0] > time())):
+                    self._lock.wait(max(0, self._due[0][0] - time()) if self._due else None)
+                if not self._due:
+                    # closing and nothing left
+                    return
+                due, bucket, chunk_keys = self._due.popleft()
+            try:
+                with self.riak_pool.client() as riakClient:
+                    riak_bucket = riakClient.bucket(bucket)
+                    for chunk_key in chunk_keys:
+                        riak_bucket.delete(chunk_key)
+            except Exception as e:
+                logger.error('ERROR deleting %s obsolete chunks in %s - left behind (Exception: %s)'% (len(chunk_keys),bucket,str(e)))
+                with self._lock:
+                    self.errors += len(chunk_keys)
+            else:
+                with self._lock:
+                    self.deleted += len(chunk_keys)
+
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='chunk-deleter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # deletes what is still waiting without a grace period - must be called while the connection pool is still open
+    def close(self):
+        with self._lock:
+            self._closing = True
+            self._lock.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return dict(waiting=sum(len(chunk_keys) for due, bucket, chunk_keys in self._due), deleted=self.deleted, errors=self.errors)
+
+
+## A few threads shared by all ChunkReaders for their read-ahead, instead of a thread per chunk. Read-ahead is
+## best effort: what does not fit into the queue is not fetched ahead, a read waiting for a chunk that is still
+## queued fetches it itself.
+class ReadaheadPool(object):
+    def __init__(self, workers=4, queue_size=64):
+        self.workers = workers
+        self._work = queue.Queue(queue_size)
+        self._threads = []
+        self.submitted = 0
+        self.dropped = 0
+
+    # returns False if function(*args) was not queued
+    def submit(self, function, *args):
+        try:
+            self._work.put_nowait((function, args))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.submitted += 1
+        return True
+
+    def _worker(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                return
+            function, args = item
+            try:
+                function(*args)
+            except Exception as e:
+                logger.error('ERROR in chunk read-ahead (Exception: %s)'% (str(e)))
+
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name='chunk-readahead')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        for thread in self._threads:
+            self._work.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        return dict(workers=self.workers, queued=self._work.qsize(), submitted=self.submitted, dropped=self.dropped)
+
+
+# writes all chunks of the manifest to filename, one chunk in memory at a time
+def materialize(manifest, fetch, filename):
+    with open(filename, 'wb') as f:
+        for chunk_key in manifest['chunks']:
+            data = fetch(chunk_key)
+            if data is None:
+                raise OSError(errno.EIO, 'chunk %s is missing'% (chunk_key))
+            f.write(data)
+
+
+## Answers reads of a chunked file by fetching just the chunks covering the requested range.
+## The next readahead chunks are fetched in the background by the given ReadaheadPool (none without one),
+## the last cached_chunks chunks are kept. fetch(chunk key) has to return the (uncompressed) bytes of that chunk.
+class ChunkReader(object):
+    def __init__(self, manifest, fetch, readahead=2, cached_chunks=8, pool=None):
+        self.manifest = manifest
+        self.fetch = fetch
+        self.readahead = readahead if pool is not None else 0
+        self.pool = pool
+        self.cached_chunks = max(cached_chunks, self.readahead + 1)
+
+        self._lock = threading.Lock()
+        # chunk index -> bytes, least recently used first
+        self._chunks = OrderedDict()
+        # chunk index -> event set once a fetch of it finished (queued for read-ahead or running)
+        self._loading = {}
+        # chunk indexes whose fetch is running
+        self._started = set()
+
+    def _load(self, index, loaded):
+        data = None
+        try:
+            data = self.fetch(self.manifest['chunks'][index])
+        except Exception as e:
+            logger.error('ERROR fetching chunk %s (Exception: %s)'% (self.manifest['chunks'][index],str(e)))
+        with self._lock:
+            if data is not None:
+                self._chunks[index] = data
+                while len(self._chunks) > self.cached_chunks:
+                    self._chunks.popitem(last=False)
+            del self._loading[index]
+            self._started.discard(index)
+        loaded.set()
+        return data
+
+    def _readahead(self, index, loaded):
+        with self._lock:
+            if (index in self._started) or (self._loading.get(index) is not loaded):
+                # a read got to it first
+                return
+            self._started.add(index)
+        self._load(index, loaded)
+
+    def _chunk(self, index):
+        with self._lock:
+            data = self._chunks.pop(index, None)
+            if data is not None:
+                self._chunks[index] = data
+                return data
+            loaded = self._loading.get(index)
+            if loaded is None:
+                loaded = self._loading[index] = threading.Event()
+            if index not in self._started:
+                # not fetched yet or still queued for read-ahead - not worth waiting for a free worker
+                self._started.add(index)
+                fetching = True
+            else:
+                fetching = False
+        if fetching:
+            data = self._load(index, loaded)
+        else:
+            # read-ahead is on it already
+            loaded.wait()
+            with self._lock:
+                data = self._chunks.get(index)
+        if data is None:
+            # read-ahead failed or the chunk was evicted again right away
+            data = self.fetch(self.manifest['chunks'][index])
+        if data is None:
+            raise OSError(errno.EIO, 'chunk %s is missing'% (self.manifest['chunks'][index]))
+        return data
+
+    def _prefetch(self, index):
+        for next_index in range(index + 1, min(index + 1 + self.readahead, len(self.manifest['chunks']))):
+            with self._lock:
+                if next_index in self._chunks or next_index in self._loading:
+                    continue
+                loaded = self._loading[next_index] = threading.Event()
+            if not self.pool.submit(self._readahead, next_index, loaded):
+                with self._lock:
+                    if next_index not in self._started:
+                        del self._loading[next_index]
+                        loaded.set()
+                # the pool is busy - the following chunks would not make it either
+                break
+
+    def read(self, length, offset):
+        size = self.manifest['size']
+        chunk_size = self.manifest['chunk_size']
+        if offset >= size or length <= 0:
+            return b''
+        end = min(offset + length, size)
+        first = offset // chunk_size
+        last = (end - 1) // chunk_size
+        self._prefetch(last)
+
+        parts = []
+        for index in range(first, last + 1):
+            data = self._chunk(index)
+            start = offset - index * chunk_size if index == first else 0
+            stop = end - index * chunk_size if index == last else chunk_size
+            parts.append(data[start:stop])
+        return b''.join(parts)
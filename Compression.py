@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+## Optional transparent compression of the contents stored in RIAK.
+##
+## A compressed object carries its codec as RIAK content encoding ("deflate" for zlib, "zstd"), objects
+## without one are plain bytes - so compressed and plain objects live side by side and mounts with and
+## without compression read both. Sizes in the directory structure are always the uncompressed sizes.
+##
+## Content that is compressed already is stored as it is: files with a known extension (jpg, png, zip, ...)
+## are not tried at all, of larger values a sample is compressed first and if that does not save enough
+## the value is stored plain. Values that do not get smaller than min_ratio of their size are stored plain.
+##
+## Usage:
+##      compressor = Compressor('zlib')
+##      storeObject(bucket, 'file.txt', data, 'application/octet-stream', compressor)
+##      data = decode(bucket.get('file.txt'))
+
+import os
+import zlib
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# codec -> the content encoding its objects are marked with
+ENCODINGS = {'zlib': 'deflate', 'zstd': 'zstd'}
+DEFAULT_LEVELS = {'zlib': 1, 'zstd': 3}
+# formats that are compressed already
+SKIP_EXTENSIONS = frozenset(('jpg', 'jpeg', 'png', 'gif', 'webp', 'heic', 'avif', 'jp2', 'mp3', 'mp4', 'm4a', 'm4v',
+                             'mov', 'mkv', 'webm', 'ogg', 'avi', 'zip', 'gz', 'tgz', 'bz2', 'xz', 'zst', '7z', 'rar',
+                             'pdf', 'docx', 'xlsx', 'pptx', 'woff', 'woff2'))
+
+
+def available(codec):
+    return codec == 'zlib' or (codec == 'zstd' and zstandard is not None)
+
+
+def decompress(data, content_encoding):
+    if not content_encoding or not data:
+        return data
+    if content_encoding == ENCODINGS['zlib']:
+        return zlib.decompress(data)
+    if content_encoding == ENCODINGS['zstd']:
+        if zstandard is None:
+            raise IOError('the object is zstd compressed but the zstandard module is not installed')
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise IOError('unknown content encoding %s'% (content_encoding))
+
+
+# the uncompressed contents of a fetched RiakObject
+def decode(riak_object):
+    return decompress(riak_object.encoded_data, getattr(riak_object, 'content_encoding', None))
+
+
+## Stores data under key, compressed if the compressor (None stores it plain) finds it worthwhile.
+## name (the file key, defaults to key) is what the extension is taken from, quorum the w/dw/pw the
+## store is acknowledged with (dict(w=2, dw=1) - None uses the defaults of the bucket).
+def storeObject(bucket, key, data, content_type, compressor=None, name=None, quorum=None):
+    content_encoding = None
+    if compressor is not None:
+        data, content_encoding = compressor.compress(data, name or key)
+    riak_object = bucket.new(key, encoded_data=data, content_type=content_type)
+    if content_encoding is not None:
+        riak_object.content_encoding = content_encoding
+    riak_object.store(return_body=False, **(quorum or {}))
+    return riak_object
+
+
+class Compressor(object):
+    def __init__(self, codec='zlib', level=0, min_ratio=0.9, sample_size=64*1024, min_size=256, skip_extensions=SKIP_EXTENSIONS):
+        if codec not in ENCODINGS:
+            raise ValueError('unknown compression codec %s'% (codec))
+        if not available(codec):
+            raise ValueError('compression codec %s needs the zstandard module'% (codec))
+        self.codec = codec
+        self.content_encoding = ENCODINGS[codec]
+        self.level = level or DEFAULT_LEVELS[codec]
+        self.min_ratio = min_ratio
+        self.sample_size = sample_size
+        self.min_size = min_size
+        self.skip_extensions = skip_extensions
+
+        self._lock = threading.Lock()
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _compress(self, data):
+        if self.codec == 'zstd':
+            # compressor objects are not thread-safe
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+        return zlib.compress(data, self.level)
+
+    # whether data (stored under name) is worth compressing at all
+    def _worthwhile(self, data, name):
+        if len(data) < self.min_size:
+            return False
+        extension = os.path.splitext(name)[1][1:].lower() if name else ''
+        if extension in self.skip_extensions:
+            return False
+        if len(data) > 2 * self.sample_size:
+            # a sample from the middle - headers often compress better than the rest
+            start = (len(data) - self.sample_size) // 2
+            sample = data[start:start + self.sample_size]
+            return len(self._compress(sample)) <= len(sample) * self.min_ratio
+        return True
+
+    # returns (data, content encoding) - the content encoding is None if data is returned plain
+    def compress(self, data, name=None):
+        compressed = self._compress(data) if self._worthwhile(data, name) else None
+        if compressed is not None and len(compressed) > len(data) * self.min_ratio:
+            compressed = None
+        with self._lock:
+            self.bytes_in += len(data)
+            if compressed is None:
+                self.skipped += 1
+                self.bytes_out += len(data)
+            else:
+                self.compressed += 1
+                self.bytes_out += len(compressed)
+        if compressed is None:
+            return data, None
+        return compressed, self.content_encoding
+
+    def stats(self):
+        with self._lock:
+            return dict(compressed=self.compressed, skipped=self.skipped, bytes_in=self.bytes_in, bytes_out=self.bytes_out)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## A bounded on-disk cache of RIAK object contents in a dedicated directory.
+##
+## Every entry is stored together with a tag describing the RIAK version it was downloaded from (the
+## vclock or the stored size). A lookup only hits when the caller presents the same tag, so a stale copy
+## is never handed out. The cache never holds more than max_bytes - the least recently used entries are
+## removed first.
+##
+## Usage:
+##      content_cache = ContentCache('/var/cache/riak-fuse', 1024*1024*1024)
+##      cache_path = content_cache.lookup(('IMG_test', 'file.jpg'), vclock)
+##      if cache_path is None:
+##          cache_path = content_cache.store(('IMG_test', 'file.jpg'), data, vclock)
+
+import os
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('root')
+
+
+class ContentCache(object):
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # (bucket, key) -> (file name, size, tag), least recently used first
+        self._entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # the tags are only known in memory - whatever a previous run left behind can't be validated
+        for filename in os.listdir(cache_dir):
+            if filename.endswith('.cache') or filename.endswith('.tmp'):
+                os.unlink(os.path.join(cache_dir, filename))
+
+    def _filename(self, name):
+        name = '%s/%s'% name
+        if not isinstance(name, bytes):
+            name = name.encode('utf-8')
+        return os.path.join(self.cache_dir, hashlib.sha1(name).hexdigest() + '.cache')
+
+    # returns the path of the cached copy if it matches the given tag
+    def lookup(self, name, tag):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                if tag is not None and entry[2] == tag:
+                    self._entries[name] = entry
+                    self.hits += 1
+                    return entry[0]
+                # outdated - drop it right away
+                self._remove(entry)
+            self.misses += 1
+            return None
+
+    # stores the data and returns the path of the cached copy or None if it is too large to be cached
+    def store(self, name, data, tag):
+        size = len(data)
+        if tag is None or size > self.max_bytes:
+            return None
+        filename = self._filename(name)
+        # write it next to the final place and move it there, an open handle of the old copy keeps working
+        tmp_filename = '%s.%s.tmp'% (filename, threading.current_thread().ident)
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self.size -= entry[1]
+            os.rename(tmp_filename, filename)
+            self._entries[name] = (filename, size, tag)
+            self.size += size
+            while self.size > self.max_bytes:
+                oldest_name, oldest = self._entries.popitem(last=False)
+                self._remove(oldest)
+                self.evictions += 1
+        return filename
+
+    def invalidate(self, name):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self._remove(entry)
+
+    # to be called with the lock held and the entry already taken out of the table
+    def _remove(self, entry):
+        self.size -= entry[1]
+        try:
+            os.unlink(entry[0])
+        except OSError as e:
+            logger.warning('could not remove cached file %s (Exception: %s)'% (entry[0],str(e)))
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, entries=len(self._entries), bytes=self.size)
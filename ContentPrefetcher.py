@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+## Fetches the next files of a directory scan into the content cache before they are opened.
+##
+## listed() remembers the order a readdir returned the files of a directory in - only the first max_names of
+## them, so huge directories do not pin their whole listing in memory (a scan past them is not fetched ahead).
+## When opened() sees files of that directory being opened one after the other in this order (min_run of
+## them), the next depth files are queued for concurrency worker threads, which fetch them by calling
+## fetch(path, size). The bytes fetched at the same time are limited by an Uploader.UploadBudget, the expected
+## size is taken from size(path).
+## An open that jumps somewhere else in the directory ends the scan - what it queued is dropped again
+## (fetches already running finish, a RIAK request can't be taken back).
+##
+## Usage:
+##      prefetcher = ContentPrefetcher(fetch, size, Uploader.UploadBudget(64*1024*1024), depth=8, concurrency=4, max_names=10000)
+##      prefetcher.start()
+##      prefetcher.listed('/test/images', ['a.jpg', 'b.jpg', 'c.jpg', ...])
+##      prefetcher.opened('/test/images/a.jpg')
+##      prefetcher.opened('/test/images/b.jpg')   # c.jpg, ... are fetched now
+
+import logging
+import posixpath
+import threading
+from itertools import islice
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger('root')
+
+
+class _Scan(object):
+    def __init__(self, names):
+        # the first files of the directory in readdir order
+        self.names = names
+        self.index = dict((name, i) for i, name in enumerate(names))
+        # position of the last opened file and how many files were opened in order up to it
+        self.last = None
+        self.run = 0
+        # bumped whenever the scan ends - queued fetches of an older generation are dropped
+        self.generation = 0
+        # names queued and not started yet, everything before ahead is queued or done already
+        self.queued = set()
+        self.ahead = 0
+
+
+class ContentPrefetcher(object):
+    # fetch(path, size) has to load the contents of path into the content cache, size(path) has to return its size
+    def __init__(self, fetch, size, budget, depth=8, concurrency=4, min_run=2, max_directories=100, max_names=10000):
+        self.fetch = fetch
+        self.size = size
+        self.budget = budget
+        self.depth = depth
+        self.concurrency = concurrency
+        self.min_run = min_run
+        self.max_directories = max_directories
+        # names remembered per directory
+        self.max_names = max_names
+
+        self._lock = threading.Lock()
+        # directory path -> _Scan, least recently used first
+        self._scans = OrderedDict()
+        self._work = queue.Queue()
+        self._threads = []
+
+        self.scans = 0
+        self.queued = 0
+        self.fetched = 0
+        self.cancelled = 0
+        self.errors = 0
+
+    # remembers the order the first max_names files of a directory were listed in
+    def listed(self, directory, names):
+        names = list(islice((name for name in names if name not in ('.', '..')), self.max_names))
+        with self._lock:
+            scan = self._scans.pop(directory, None)
+            if scan is not None and scan.names == names:
+                # the same listing again (e.g. a second ls) - a running scan goes on
+                self._scans[directory] = scan
+                return
+            if scan is not None:
+                self._cancel(scan)
+            self._scans[directory] = _Scan(names)
+            while len(self._scans) > self.max_directories:
+                directory, scan = self._scans.popitem(last=False)
+                self._cancel(scan)
+
+    # to be called on every open of a file, queues the files following it once the opens look like a scan
+    def opened(self, path):
+        directory, name = posixpath.split(path)
+        with self._lock:
+            scan = self._scans.get(directory)
+            if scan is None or name not in scan.index:
+                return
+            position = scan.index[name]
+            # the file is opened now, fetching it ahead is of no use anymore
+            scan.queued.discard(name)
+            if (scan.last is not None) and (scan.last < position <= scan.last + self.depth):
+                # files skipped within the window may have been cached already
+                scan.run += 1
+            elif scan.last != position:
+                if scan.run >= self.min_run:
+                    logger.debug('scan of %s ended at %s', directory,name)
+                self._cancel(scan)
+                scan.run = 1
+            scan.last = position
+            if scan.run < self.min_run:
+                return
+            if scan.run == self.min_run:
+                self.scans += 1
+                logger.debug('scan of %s detected at %s', directory,name)
+            first = max(scan.ahead, position + 1)
+            scan.ahead = min(position + 1 + self.depth, len(scan.names))
+            for next_name in scan.names[first:scan.ahead]:
+                scan.queued.add(next_name)
+                self.queued += 1
+                self._work.put((directory, next_name, scan.generation))
+
+    # to be called with the lock held
+    def _cancel(self, scan):
+        self.cancelled += len(scan.queued)
+        scan.queued.clear()
+        scan.generation += 1
+        scan.ahead = 0
+
+    # whether a queued fetch is still wanted - taken off the queue if it is
+    def _take(self, directory, name, generation):
+        with self._lock:
+            scan = self._scans.get(directory)
+            if scan is None or scan.generation != generation or name not in scan.queued:
+                return False
+            scan.queued.discard(name)
+            return True
+
+    def _worker(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                break
+            directory, name, generation = item
+            if not self._take(directory, name, generation):
+                continue
+            path = posixpath.join(directory, name)
+            try:
+                size = self.size(path)
+                with self.budget.reserve(size):
+                    with self._lock:
+                        scan = self._scans.get(directory)
+                        if scan is None or scan.generation != generation:
+                            # the scan ended while this one waited for the budget
+                            self.cancelled += 1
+                            continue
+                    self.fetch(path, size)
+                with self._lock:
+                    self.fetched += 1
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                logger.warning('could not prefetch the contents of %s (Exception: %s)'% (path,str(e)))
+
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._worker, name='content-prefetch')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        # queued fetches are of no use anymore
+        with self._lock:
+            for scan in self._scans.values():
+                self._cancel(scan)
+        for thread in self._threads:
+            self._work.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        with self._lock:
+            return dict(scans=self.scans, queued=self.queued, fetched=self.fetched, cancelled=self.cancelled, errors=self.errors,
+                        in_flight=self.budget.in_flight)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## Collects changes to the RIAK directory sets and writes them as one set operation per directory.
+##
+## Every add()/discard() is recorded per directory bucket (the latest change of a key wins). A directory is
+## flushed once its oldest pending change is window seconds old, once batch_size changes are pending for it
+## or when the coalescer is closed - a burst of uploads into one directory then costs a handful of set
+## round trips instead of one per file. With a window of 0 every change is flushed right away by the caller.
+##
+## Changes of a failed flush stay pending and are retried with the next one - and in the background every
+## retry_interval seconds, also with a window of 0. Until a change is flushed, pending() tells readers of the
+## directory set what is missing in RIAK.
+##
+## Usage:
+##      directory_updates = DirectoryCoalescer(flush_directory, window=1.0, batch_size=1000)
+##      directory_updates.start()
+##      directory_updates.add('IMGDIR_test', 'file.jpg')
+##      directory_updates.close()
+
+import logging
+import threading
+from time import time
+from collections import OrderedDict
+
+from LockTable import LockTable
+
+logger = logging.getLogger('root')
+
+
+class DirectoryCoalescer(object):
+    # flush_directory(directory bucket, keys to add, keys to discard) has to store both in one set operation
+    def __init__(self, flush_directory, window=1.0, batch_size=1000, retry_interval=1.0):
+        self.flush_directory = flush_directory
+        self.window = window
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        # directory bucket -> (time of the oldest pending change, key -> True to add / False to discard)
+        self._pending = {}
+        # only one flush per directory at a time, so changes are never stored out of order
+        self._flush_locks = LockTable()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.changes = 0
+        self.flushes = 0
+
+    def add(self, directory, key):
+        self._change(directory, ((key, True),))
+
+    def discard(self, directory, key):
+        self._change(directory, ((key, False),))
+
+    # both sides of a rename within the directory, flushed together
+    def rename(self, directory, old_key, new_key):
+        self._change(directory, ((old_key, False), (new_key, True)))
+
+    def _change(self, directory, changes):
+        with self._lock:
+            entry = self._pending.get(directory)
+            if entry is None:
+                entry = self._pending[directory] = (time(), OrderedDict())
+            for key, present in changes:
+                entry[1].pop(key, None)
+                entry[1][key] = present
+                self.changes += 1
+            full = len(entry[1]) >= self.batch_size
+        if self.window <= 0:
+            self.flush(directory)
+        elif full:
+            self._wakeup.set()
+
+    # the changes of the directory that are not in RIAK yet: (keys added, keys discarded)
+    def pending(self, directory):
+        with self._lock:
+            entry = self._pending.get(directory)
+            if entry is None:
+                return set(), set()
+            return (set(key for key, present in entry[1].items() if present),
+                    set(key for key, present in entry[1].items() if not present))
+
+    # writes the pending changes of the directory to RIAK, raises if that failed (they stay pending then)
+    def flush(self, directory):
+        with self._flush_locks.lock(directory):
+            with self._lock:
+                entry = self._pending.pop(directory, None)
+            if entry is None:
+                return
+            since, changes = entry
+            adds = [key for key, present in changes.items() if present]
+            discards = [key for key, present in changes.items() if not present]
+            try:
+                self.flush_directory(directory, adds, discards)
+            except Exception:
+                with self._lock:
+                    # changes recorded during the flush are newer and win
+                    newer = self._pending.get(directory)
+                    if newer is not None:
+                        changes.update(newer[1])
+                    self._pending[directory] = (since, changes)
+                raise
+            self.flushes += 1
+        logger.debug('flushed directory %s (%s added, %s discarded)', directory,len(adds),len(discards))
+
+    # flushes every directory that is due (or all of them), failures are logged and retried later
+    def flush_all(self, everything=False):
+        # without a window the callers flush right away - what is still pending after a while failed
+        delay = self.window if self.window > 0 else self.retry_interval
+        now = time()
+        with self._lock:
+            due = [directory for directory, (since, changes) in self._pending.items()
+                   if everything or since + delay <= now or len(changes) >= self.batch_size]
+        for directory in due:
+            try:
+                self.flush(directory)
+            except Exception as e:
+                logger.error('ERROR updating directory structure on RIAK bucket %s - retrying later (Exception: %s)'% (directory,str(e)))
+
+    def _flusher(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.window if self.window > 0 else self.retry_interval)
+            self._wakeup.clear()
+            self.flush_all()
+
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._flusher, name='directory-flusher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # stops the background flushes and writes everything that is still pending
+    def close(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush_all(everything=True)
+
+    def stats(self):
+        with self._lock:
+            pending = sum(len(changes) for since, changes in self._pending.values())
+        return dict(changes=self.changes, flushes=self.flushes, pending=pending)
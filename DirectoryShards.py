@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## Spreads the directory listing of very large folders over several RIAK sets.
+##
+## With shards > 0 every file of a directory bucket is listed in exactly one of shards sets, picked by a
+## stable hash of its key. The shard sets are named after the directory key:
+##      IMGDIR_test/directory/0 ... IMGDIR_test/directory/15
+## Keys of files never contain a "/", so shard sets can't collide with the per-file sets of the bucket.
+## With shards = 0 the listing is the single directory set, as it always was.
+##
+## A listing is read shard by shard and changing one entry only reloads/stores the one shard it belongs to,
+## so both stay cheap however large the folder grows. Existing single sets are split up with
+## debugging/riak-shard-directory.py.
+##
+## Usage:
+##      for set_key in DirectoryShards.setKeys('directory', 16):
+##          ...
+##      set_key = DirectoryShards.setKeyFor('directory', 'file.jpg', 16)
+
+import zlib
+
+
+def shardOf(key, shards):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    # crc32 is the same in every process (unlike hash()), every mount has to agree on the shard
+    return (zlib.crc32(key) & 0xffffffff) % shards
+
+
+# the keys of all sets making up the listing, in the order they are read
+def setKeys(directory_key, shards):
+    if shards <= 0:
+        return [directory_key]
+    return ['%s/%s'% (directory_key, shard) for shard in range(shards)]
+
+
+# the key of the set listing the given file
+def setKeyFor(directory_key, key, shards):
+    if shards <= 0:
+        return directory_key
+    return '%s/%s'% (directory_key, shardOf(key, shards))
+
+
+# returns set key -> list of the given keys listed in that set
+def groupBySet(directory_key, keys, shards):
+    groups = {}
+    for key in keys:
+        groups.setdefault(setKeyFor(directory_key, key, shards), []).append(key)
+    return groups
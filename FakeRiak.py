@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+## An in-memory stand-in for RIAK, to drive riak-fuse (and the tools) without a cluster or network.
+##
+## The RIAK backend of riak-fuse is whatever hands out clients with client() and has start()/close():
+## RiakConnectionPool talks to a real cluster, FakeRiakPool to a dictionary. A fake client answers
+## everything riak-fuse asks a RiakClient for - buckets of any bucket type, get (also head_only), new/store,
+## delete, stream_keys, ping - and the fetch/update calls riak.datatypes.Set makes, so sets are the real
+## riak.datatypes.Set working on fake storage.
+##
+## Every request sleeps latency seconds (plus up to jitter, plus the size of the value over bandwidth
+## bytes per second) - the round trip a real cluster would cost. Requests, bytes sent and received are
+## counted per operation.
+##
+## A FakeRiakNode stands in for one node of a cluster: pools of several nodes share one store, every node
+## adds its own latency and can be taken down (its requests fail like a refused connection) and up again.
+##
+## Usage:
+##      riak_pool = FakeRiakPool(latency=0.001, jitter=0.0005, bandwidth=100*1024*1024)
+##      with riak_pool.client() as riakClient:
+##          riakClient.bucket('IMG_test').new('file.jpg', encoded_data=b'...').store()
+##      riak_pool.store.stats()
+##
+##      store = FakeRiakStore()
+##      nodes = {8087: FakeRiakNode(store, latency=0.001), 8088: FakeRiakNode(store, latency=0.02)}
+##      riak_pool = RiakCluster.RiakCluster([('localhost', port) for port in nodes], lambda host, port: FakeRiakPool(store=nodes[port]))
+##      nodes[8087].down = True
+
+import errno
+import random
+import socket
+import threading
+from time import sleep
+from contextlib import contextmanager
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+DEFAULT_TYPE = 'default'
+
+
+## What the fake vclock of an object looks like from the outside (riak.RiakObject.vclock)
+class _VClock(object):
+    def __init__(self, version):
+        self.version = version
+
+    def encode(self, encoding):
+        return 'v%s'% (self.version)
+
+
+class FakeRiakObject(object):
+    def __init__(self, bucket, key, encoded_data=None, content_type=None, vclock=None, exists=False, content_encoding=None):
+        self.bucket = bucket
+        self.key = key
+        self.encoded_data = encoded_data
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.vclock = vclock
+        self.exists = exists
+
+    @property
+    def data(self):
+        return self.encoded_data
+
+    def store(self, return_body=True, **params):
+        self.bucket._client._store(self)
+        return self
+
+    def delete(self, **params):
+        self.bucket.delete(self.key)
+        return self
+
+
+class FakeBucket(object):
+    def __init__(self, client, bucket_type, name):
+        self._client = client
+        self.bucket_type = bucket_type
+        self.name = name
+
+    def new(self, key, encoded_data=None, content_type='application/octet-stream', data=None):
+        if encoded_data is None:
+            encoded_data = data
+        return FakeRiakObject(self, key, encoded_data, content_type)
+
+    def get(self, key, head_only=False, **params):
+        return self._client._get(self, key, head_only)
+
+    def delete(self, key, **params):
+        self._client._delete(self, key)
+
+    def stream_keys(self, **params):
+        return self._client._stream_keys(self)
+
+
+class FakeBucketType(object):
+    def __init__(self, client, name):
+        self._client = client
+        self.name = name
+
+    def bucket(self, name):
+        return FakeBucket(self._client, self, name)
+
+
+class FakeRiakClient(object):
+    def __init__(self, store):
+        self._storage = store
+        self.retries = 0
+
+    def bucket(self, name, bucket_type=DEFAULT_TYPE):
+        return FakeBucket(self, FakeBucketType(self, bucket_type), name)
+
+    def bucket_type(self, name):
+        return FakeBucketType(self, name)
+
+    def ping(self):
+        self._storage.request('ping')
+        return True
+
+    def close(self):
+        pass
+
+    # ==================
+    # Objects
+    # ==================
+    def _name(self, bucket, key):
+        return (bucket.bucket_type.name, bucket.name, key)
+
+    def _get(self, bucket, key, head_only):
+        value = self._storage.get(self._name(bucket, key))
+        self._storage.request('get', received=0 if (value is None or head_only) else len(value[0] or b''))
+        if value is None:
+            return FakeRiakObject(bucket, key)
+        encoded_data, content_type, content_encoding, version = value
+        return FakeRiakObject(bucket, key, b'' if head_only else encoded_data, content_type, _VClock(version), exists=True, content_encoding=content_encoding)
+
+    def _store(self, riak_object):
+        self._storage.request('put', sent=len(riak_object.encoded_data or b''))
+        version = self._storage.put(self._name(riak_object.bucket, riak_object.key), riak_object.encoded_data, riak_object.content_type, riak_object.content_encoding)
+        riak_object.vclock = _VClock(version)
+        riak_object.exists = True
+
+    def _delete(self, bucket, key):
+        self._storage.request('delete')
+        self._storage.delete(self._name(bucket, key))
+
+    def _stream_keys(self, bucket):
+        keys = self._storage.keys(bucket.bucket_type.name, bucket.name)
+        for start in range(0, len(keys), 1000):
+            self._storage.request('stream_keys')
+            yield keys[start:start + 1000]
+
+    # ==================
+    # Datatypes (called by riak.datatypes.Set)
+    # ==================
+    def _fetch_datatype(self, bucket, key, **params):
+        value = self._storage.get(self._name(bucket, key))
+        members = value[0] if value is not None else frozenset()
+        self._storage.request('fetch_datatype', received=sum(len(member) for member in members))
+        return 'set', members, b'context'
+
+    def fetch_datatype(self, bucket, key, **params):
+        from riak.datatypes import TYPES
+        dtype, value, context = self._fetch_datatype(bucket, key, **params)
+        return TYPES[dtype](bucket=bucket, key=key, value=value, context=context)
+
+    def update_datatype(self, datatype, **params):
+        op = datatype.to_op() or {}
+        self._storage.request('update_datatype', sent=sum(len(member) for member in list(op.get('adds', [])) + list(op.get('removes', []))))
+        members = self._storage.update_set(self._name(datatype.bucket, datatype.key), op.get('adds', ()), op.get('removes', ()))
+        if params.get('return_body'):
+            datatype._context = b'context'
+            datatype._set_value(members)
+
+
+## The storage behind all fake clients of one pool: (bucket type, bucket, key) -> (value, content type, content encoding, version)
+class FakeRiakStore(object):
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self._lock = threading.Lock()
+        self._objects = {}
+        self._version = 0
+        # operation -> [requests, bytes sent, bytes received]
+        self._counters = {}
+
+    # accounts for one request and waits as long as it would take
+    def request(self, operation, sent=0, received=0):
+        with self._lock:
+            counter = self._counters.setdefault(operation, [0, 0, 0])
+            counter[0] += 1
+            counter[1] += sent
+            counter[2] += received
+        delay = self.latency
+        if self.jitter > 0:
+            delay += random.uniform(0, self.jitter)
+        if self.bandwidth > 0:
+            delay += float(sent + received) / self.bandwidth
+        if delay > 0:
+            sleep(delay)
+
+    def get(self, name):
+        with self._lock:
+            return self._objects.get(name)
+
+    def put(self, name, encoded_data, content_type, content_encoding=None):
+        with self._lock:
+            self._version += 1
+            self._objects[name] = (encoded_data, content_type, content_encoding, self._version)
+            return self._version
+
+    def delete(self, name):
+        with self._lock:
+            self._objects.pop(name, None)
+
+    def update_set(self, name, adds, removes):
+        with self._lock:
+            value = self._objects.get(name)
+            members = (set(value[0]) if value is not None else set())
+            members.difference_update(removes)
+            members.update(adds)
+            self._version += 1
+            self._objects[name] = (frozenset(members), None, None, self._version)
+            return frozenset(members)
+
+    def keys(self, bucket_type, bucket):
+        with self._lock:
+            return sorted(key for (name_type, name_bucket, key) in self._objects if name_type == bucket_type and name_bucket == bucket)
+
+    def stats(self):
+        with self._lock:
+            return dict((operation, dict(requests=counter[0], sent=counter[1], received=counter[2]))
+                        for operation, counter in self._counters.items())
+
+    def reset_stats(self):
+        with self._lock:
+            self._counters.clear()
+
+
+## One node of a fake cluster, used by FakeRiakPool in place of the store it answers from
+class FakeRiakNode(object):
+    def __init__(self, store, latency=0.0, jitter=0.0):
+        self.store = store
+        self.latency = latency
+        self.jitter = jitter
+        self.down = False
+
+    def request(self, operation, sent=0, received=0):
+        if self.down:
+            raise socket.error(errno.ECONNREFUSED, 'fake RIAK node is down')
+        delay = self.latency
+        if self.jitter > 0:
+            delay += random.uniform(0, self.jitter)
+        if delay > 0:
+            sleep(delay)
+        self.store.request(operation, sent, received)
+
+    # the objects and counters are those of the shared store
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+## A drop-in for RiakConnectionPool: at most pool_size clients are handed out at the same time
+class FakeRiakPool(object):
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=0, pool_size=8, store=None):
+        self.store = store if store is not None else FakeRiakStore(latency, jitter, bandwidth)
+        self.pool_size = pool_size
+        self._idle = queue.Queue(maxsize=pool_size)
+        for i in range(pool_size):
+            self._idle.put(FakeRiakClient(self.store))
+
+    @contextmanager
+    def client(self):
+        riakClient = self._idle.get()
+        try:
+            yield riakClient
+        finally:
+            self._idle.put(riakClient)
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self):
+        idle = self._idle.qsize()
+        return dict(size=self.pool_size, idle=idle, in_use=self.pool_size - idle)
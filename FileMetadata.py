@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## One compact metadata record per file, stored as a plain JSON object next to the directory sets.
+##
+## The record lives in the default bucket type under the name of the directory bucket and the key of the file:
+##      IMGDIR_test/file.jpg -> {"size": 10485760, "mtime": 1500000000.0, "sha1": "<hex>", "chunk_size": 1048576, "chunks": 10}
+##
+## Everything getattr/unlink need is read with a single get and written with a single put - no set reload,
+## no context, no discard. chunks is 0 for files stored as one plain object.
+##
+## Usage:
+##      record = FileMetadata.fetch(riakClient.bucket('IMGDIR_test'), 'file.jpg')
+##      if record is not None:
+##          size = record['size']
+
+import json
+
+METADATA_CONTENT_TYPE = 'application/json'
+
+
+def makeRecord(size, mtime, sha1=None, chunk_size=0, chunks=0):
+    return dict(size=size, mtime=mtime, sha1=sha1, chunk_size=chunk_size, chunks=chunks)
+
+
+def decode(riak_object):
+    if not riak_object.exists:
+        return None
+    encoded_data = riak_object.encoded_data
+    if isinstance(encoded_data, bytes):
+        encoded_data = encoded_data.decode('utf-8')
+    return json.loads(encoded_data)
+
+
+# returns the record of key or None if there is none
+def fetch(bucket, key):
+    return decode(bucket.get(key))
+
+
+def store(bucket, key, record):
+    bucket.new(key, encoded_data=json.dumps(record, sort_keys=True), content_type=METADATA_CONTENT_TYPE).store(return_body=False)
+
+
+def delete(bucket, key):
+    bucket.delete(key)
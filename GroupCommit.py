@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+## Makes the local copies of closed files durable in groups instead of with one fsync per close.
+##
+## add() queues a duplicate of the file descriptor and returns right away, a background thread collects
+## everything queued within window seconds and syncs the group: one fdatasync (fsync where there is none) per
+## duplicated descriptor, so an error is reported for exactly the file it belongs to. sync() queues the same
+## way but waits until its group is on disk (an explicit fsync of an application). A crash therefore loses at
+## most the files closed within the last window - in riak-fuse those were just handed to RIAK as well.
+##
+## With use_syncfs a group is synced with one syncfs(2) per filesystem instead (Linux only, one fdatasync per
+## file elsewhere). That is one call however many files were closed, but it writes out everything dirty on the
+## filesystem, fails every file of the group on it when it fails - and reports write errors only on Linux 5.8
+## and later, earlier kernels return success even if writing a file back failed.
+##
+## At most max_pending files wait for their group, adding more waits until a group is done.
+##
+## Usage:
+##      group_commit = GroupCommit(window=0.05)
+##      group_commit.start()
+##      group_commit.add(fh)
+##      group_commit.sync(fh)
+##      group_commit.close()
+
+import os
+import errno
+import logging
+import threading
+
+try:
+    import ctypes
+    import ctypes.util
+    _syncfs = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).syncfs
+except (ImportError, OSError, AttributeError, TypeError):
+    # not linux (or no glibc)
+    _syncfs = None
+
+# the data and the size of a file, without its timestamps
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+logger = logging.getLogger('root')
+
+
+# syncs the whole filesystem fd is on with a single call
+def _syncFilesystem(fd):
+    if _syncfs(fd) != 0:
+        error = ctypes.get_errno() or errno.EIO
+        raise OSError(error, os.strerror(error))
+
+
+class GroupCommit(object):
+    def __init__(self, window=0.05, max_pending=1000, use_syncfs=False):
+        self.window = window
+        self.max_pending = max_pending
+        if use_syncfs and _syncfs is None:
+            logger.warning('syncfs(2) is not available - closed files are synced one by one')
+            use_syncfs = False
+        self.use_syncfs = use_syncfs
+
+        self._lock = threading.Condition()
+        # [duplicated descriptor, synced, error] of every file waiting for its group
+        self._pending = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.groups = 0
+        self.syncs = 0
+        self.synced = 0
+        self.errors = 0
+        self.largest_group = 0
+
+    def _queue(self, fh):
+        # a duplicate stays valid when the caller closes its descriptor right after (release follows flush)
+        entry = [os.dup(fh), False, None]
+        with self._lock:
+            while len(self._pending) >= self.max_pending and self._thread is not None:
+                self._lock.wait()
+            self._pending.append(entry)
+            self._lock.notify_all()
+        return entry
+
+    # queues the file for the next group and returns right away
+    def add(self, fh):
+        if self._thread is None:
+            return os.fsync(fh)
+        self._queue(fh)
+
+    # queues the file for the next group and waits until it is on disk
+    def sync(self, fh):
+        if self._thread is None:
+            return os.fsync(fh)
+        entry = self._queue(fh)
+        with self._lock:
+            while not entry[1]:
+                self._lock.wait()
+        if entry[2] is not None:
+            raise entry[2]
+
+    # one fdatasync per file, returns the number of syncs
+    def _syncFiles(self, entries):
+        for entry in entries:
+            try:
+                _fdatasync(entry[0])
+            except OSError as e:
+                logger.error('ERROR syncing a closed file to disk (Exception: %s)'% (str(e)))
+                entry[2] = e
+        return len(entries)
+
+    # one syncfs per filesystem (device) the files are on, returns the number of syncs
+    def _syncFilesystems(self, entries):
+        filesystems = {}
+        for entry in entries:
+            try:
+                filesystems.setdefault(os.fstat(entry[0]).st_dev, []).append(entry)
+            except OSError as e:
+                entry[2] = e
+        for same_filesystem in filesystems.values():
+            try:
+                _syncFilesystem(same_filesystem[0][0])
+            except OSError as e:
+                logger.error('ERROR syncing %s closed files to disk (Exception: %s)'% (len(same_filesystem),str(e)))
+                for entry in same_filesystem:
+                    entry[2] = e
+        return len(filesystems)
+
+    def _commit(self, group):
+        try:
+            if self.use_syncfs:
+                syncs = self._syncFilesystems(group)
+            else:
+                syncs = self._syncFiles(group)
+        finally:
+            for entry in group:
+                os.close(entry[0])
+        with self._lock:
+            for entry in group:
+                entry[1] = True
+            self.groups += 1
+            self.syncs += syncs
+            self.synced += len(group)
+            self.errors += sum(1 for entry in group if entry[2] is not None)
+            self.largest_group = max(self.largest_group, len(group))
+            self._lock.notify_all()
+
+    def _committer(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._stopped.is_set():
+                    self._lock.wait()
+                if not self._pending:
+                    return
+            # whatever else is closed within the window joins the group
+            self._stopped.wait(self.window)
+            with self._lock:
+                group = self._pending
+                self._pending = []
+                self._lock.notify_all()
+            self._commit(group)
+
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._committer, name='group-commit')
+            self._thread.daemon = True
+            self._thread.start()
+
+    # syncs what is still queued and stops the background thread
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            self._lock.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        # queued while the thread was finishing
+        with self._lock:
+            group = self._pending
+            self._pending = []
+        if group:
+            self._commit(group)
+
+    def stats(self):
+        with self._lock:
+            return dict(groups=self.groups, syncs=self.syncs, synced=self.synced, errors=self.errors, largest_group=self.largest_group, pending=len(self._pending))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## An in-memory membership index of the keys in each RIAK directory bucket.
+##
+## The index of a directory bucket is a Bloom filter over the keys of its directory set, built by a background
+## thread and reloaded every refresh_interval seconds. It takes about 10 bits per key (1.2 MB for a million keys)
+## instead of a set of all key strings. Keys added through this mount are added right away with add(), removed
+## ones stay in the filter until the next refresh - a Bloom filter can't forget. Keys added by other mounts show
+## up with the next refresh.
+##
+## contains() never blocks on RIAK: once the directory is indexed it answers False if the key is definitely not
+## in it and True if it may be (one in error_rate lookups of a missing key), None while it is not indexed (yet).
+## For anything but False the caller has to ask RIAK itself.
+##
+## Usage:
+##      key_index = KeyIndex(load_directory, refresh_interval=60)
+##      key_index.start()
+##      if key_index.contains('IMGDIR_test', 'file.jpg') is False:
+##          ... # definitely not in RIAK
+##      key_index.add('IMGDIR_test', 'new.jpg')
+
+import math
+import logging
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger('root')
+
+
+class _BloomFilter(object):
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size * math.log(2) / capacity)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    # the bit positions of a key, derived from one md5 (double hashing)
+    def _positions(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        digest = hashlib.md5(key).hexdigest()
+        first, second = int(digest[:16], 16), int(digest[16:], 16) | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class KeyIndex(object):
+    # load_directory(directory bucket) has to return all keys of the directory set of that bucket
+    def __init__(self, load_directory, refresh_interval=60, max_directories=1000, error_rate=0.01):
+        self.load_directory = load_directory
+        self.refresh_interval = refresh_interval
+        self.max_directories = max_directories
+        self.error_rate = error_rate
+
+        self._lock = threading.Lock()
+        # directory bucket -> Bloom filter of its keys, least recently used first
+        self._directories = OrderedDict()
+        # directory bucket -> changes done while that directory was (re)loaded
+        self._loading = {}
+        self._load_requests = queue.Queue()
+
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def contains(self, directory, key):
+        with self._lock:
+            keys = self._directories.pop(directory, None)
+            if keys is not None:
+                # re-insert to mark it as most recently used
+                self._directories[directory] = keys
+                return key in keys
+            if directory in self._loading:
+                return None
+            self._loading[directory] = []
+        # first time this directory is asked for - have it loaded in the background
+        self._load_requests.put(directory)
+        return None
+
+    def add(self, directory, key):
+        with self._lock:
+            keys = self._directories.get(directory)
+            if keys is not None:
+                keys.add(key)
+            # replayed once a running load finished, the loaded keys might miss this change
+            if directory in self._loading:
+                self._loading[directory].append(key)
+
+    # a removed key may still be answered with True until the next refresh - which is always correct
+    def discard(self, directory, key):
+        pass
+
+    def _load(self, directory):
+        with self._lock:
+            self._loading.setdefault(directory, [])
+        try:
+            loaded = list(self.load_directory(directory))
+            # room for the keys added until the next refresh
+            keys = _BloomFilter(2 * len(loaded), self.error_rate)
+            for key in loaded:
+                keys.add(key)
+        except Exception as e:
+            logger.warning('could not index RIAK directory %s (Exception: %s)'% (directory,str(e)))
+            with self._lock:
+                self._loading.pop(directory, None)
+            return
+
+        with self._lock:
+            for key in self._loading.pop(directory, []):
+                keys.add(key)
+            self._directories.pop(directory, None)
+            self._directories[directory] = keys
+            while len(self._directories) > self.max_directories:
+                self._directories.popitem(last=False)
+        logger.debug('indexed RIAK directory %s (%s keys, %s bytes)', directory,len(loaded),len(keys.bits))
+
+    def _loader(self):
+        while not self._stopped.is_set():
+            try:
+                directory = self._load_requests.get(timeout=1)
+            except queue.Empty:
+                continue
+            self._load(directory)
+
+    def _refresher(self):
+        while not self._stopped.wait(self.refresh_interval):
+            with self._lock:
+                directories = list(self._directories.keys())
+            for directory in directories:
+                if self._stopped.is_set():
+                    break
+                self._load(directory)
+
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def start(self):
+        if self._threads:
+            return
+        for target, name in ((self._loader, 'key-index-loader'), (self._refresher, 'key-index-refresher')):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        self._stopped.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(directories=len(self._directories), bytes=sum(len(keys.bits) for keys in self._directories.values()),
+                        loads_queued=self._load_requests.qsize())
+
+    def __len__(self):
+        return len(self._directories)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## A table of fine-grained locks, one per name (e.g. a RIAK bucket/key pair or a directory bucket).
+##
+## Locks only exist while somebody holds or waits for them, so the table does not grow with the
+## number of files ever touched. Several names can be locked at once (e.g. both sides of a rename);
+## they are always acquired in sorted order so two callers can never deadlock on each other.
+##
+## Usage:
+##      key_locks = LockTable()
+##      with key_locks.lock(('IMG_test', 'file.jpg')):
+##          ...
+
+import threading
+from contextlib import contextmanager
+
+
+class LockTable(object):
+    def __init__(self):
+        self._mutex = threading.Lock()
+        # name -> [lock, number of holders and waiters]
+        self._locks = {}
+
+    def _acquire(self, name):
+        with self._mutex:
+            entry = self._locks.get(name)
+            if entry is None:
+                entry = self._locks[name] = [threading.Lock(), 0]
+            entry[1] += 1
+        entry[0].acquire()
+
+    def _release(self, name):
+        with self._mutex:
+            entry = self._locks[name]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[name]
+        entry[0].release()
+
+    @contextmanager
+    def lock(self, *names):
+        # unmappable paths have no name - there is nothing to protect for those
+        names = sorted(set(name for name in names if name is not None))
+        acquired = []
+        try:
+            for name in names:
+                self._acquire(name)
+                acquired.append(name)
+            yield
+        finally:
+            for name in reversed(acquired):
+                self._release(name)
+
+    # number of names currently locked or waited for
+    def __len__(self):
+        with self._mutex:
+            return len(self._locks)
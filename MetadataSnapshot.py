@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+## A local snapshot of the RIAK directory listings and file sizes a mount used, for a warm start.
+##
+## While the mount runs, the complete listings it read (readdir) and the sizes it fetched (getattr) are
+## recorded, together with the changes done through the mount. They are written to a SQLite file every
+## interval seconds and at unmount. After a restart, a directory is read from the file only when it is asked
+## for, and answers the listing and the sizes known for it right away - no RIAK round trip.
+##
+## Those answers are as old as the snapshot. A background thread therefore reloads every directory of the
+## snapshot from its directory set(s) - the ones asked for first, at most rate directories per second so a
+## restart does not flood RIAK - and once RIAK answered, the directory is answered by RIAK again like without
+## a snapshot. The reloaded listing is what the next snapshot records, with the sizes still known for the keys
+## that are still listed (getattr refreshes them from RIAK). Only the rows that changed are written.
+##
+## Usage:
+##      snapshot = MetadataSnapshot('/var/lib/riak-fuse/metadata.db', load_directory, interval=300, rate=5)
+##      snapshot.start()
+##      keys = snapshot.listing('IMGDIR_test')              # None: ask RIAK
+##      size, mtime = snapshot.attrs('IMGDIR_test', 'file.jpg') or (None, None)
+##      snapshot.record_listing('IMGDIR_test', keys)
+##      snapshot.record_size('IMGDIR_test', 'file.jpg', 52311, None)
+##      snapshot.close()
+
+import os
+import logging
+import sqlite3
+import threading
+from time import time
+from collections import OrderedDict
+
+from RateLimiter import RateLimiter
+
+logger = logging.getLogger('root')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS directories (name TEXT PRIMARY KEY, used REAL)',
+    'CREATE TABLE IF NOT EXISTS entries (directory TEXT, key TEXT, size INTEGER, mtime REAL, PRIMARY KEY (directory, key))',
+)
+
+
+class _Directory(object):
+    def __init__(self, keys, served, written=True):
+        # key -> (size, mtime) - (None, None) while the size is not known
+        self.keys = keys
+        # loaded from the snapshot file and not reconciled with RIAK yet - answers are taken from here
+        self.served = served
+        # whether the snapshot file has the directory - its rows are rewritten as a whole otherwise
+        self.written = written
+        # keys whose rows have to be written / deleted with the next save
+        self.changed = set()
+        self.removed = set()
+        self.used = time()
+
+    @property
+    def dirty(self):
+        return (not self.written) or bool(self.changed) or bool(self.removed)
+
+    def set(self, key, value):
+        if self.keys.get(key) != value:
+            self.keys[key] = value
+            self.changed.add(key)
+            self.removed.discard(key)
+
+    def remove(self, key):
+        if key in self.keys:
+            del self.keys[key]
+            self.removed.add(key)
+            self.changed.discard(key)
+
+    # takes over a listing read from RIAK, the sizes of the keys still listed are kept
+    def update(self, keys):
+        added = [key for key in keys if key not in self.keys]
+        removed = [key for key in self.keys if key not in keys]
+        for key in added:
+            self.set(key, (None, None))
+        for key in removed:
+            self.remove(key)
+        return len(added), len(removed)
+
+
+class MetadataSnapshot(object):
+    # load_directory(directory bucket) has to return all keys of the directory set(s) of that bucket
+    def __init__(self, path, load_directory, interval=300, max_directories=10000, rate=5):
+        self.path = path
+        self.load_directory = load_directory
+        self.interval = interval
+        self.max_directories = max_directories
+        # directories reconciled per second
+        self.limiter = RateLimiter(rate)
+
+        self._lock = threading.Lock()
+        # directory bucket -> _Directory, least recently used first (None: not in the snapshot file)
+        self._directories = OrderedDict()
+        # directories of the snapshot file that were not reconciled yet, most recently used first
+        self._unreconciled = OrderedDict()
+        # those of them that were asked for already - reconciled before the others
+        self._asked = OrderedDict()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.served = 0
+        self.reconciled = 0
+        self.keys_added = 0
+        self.keys_removed = 0
+        self.saves = 0
+
+    # ==================
+    # Snapshot file
+    # ==================
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # used by the FUSE threads and the background thread, one at a time
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db_lock:
+            for statement in SCHEMA:
+                self._db.execute(statement)
+            self._db.commit()
+            return [row[0] for row in self._db.execute('SELECT name FROM directories ORDER BY used DESC')]
+
+    def _read(self, directory):
+        with self._db_lock:
+            if self._db is None:
+                return None
+            if self._db.execute('SELECT 1 FROM directories WHERE name = ?', (directory,)).fetchone() is None:
+                return None
+            rows = self._db.execute('SELECT key, size, mtime FROM entries WHERE directory = ?', (directory,)).fetchall()
+        return dict((key, (size, mtime)) for key, size, mtime in rows)
+
+    # writes the rows that changed since the last save in one transaction
+    def save(self):
+        with self._lock:
+            changed = []
+            for name, entry in self._directories.items():
+                if entry is None or not entry.dirty:
+                    continue
+                if entry.written:
+                    changed.append((name, entry.used, False, [(key, entry.keys[key]) for key in entry.changed], list(entry.removed)))
+                else:
+                    changed.append((name, entry.used, True, list(entry.keys.items()), []))
+                entry.written = True
+                entry.changed = set()
+                entry.removed = set()
+        if (not changed) or (self._db is None):
+            return
+        try:
+            with self._db_lock:
+                for name, used, rewrite, keys, removed in changed:
+                    if rewrite:
+                        self._db.execute('DELETE FROM entries WHERE directory = ?', (name,))
+                    self._db.executemany('DELETE FROM entries WHERE directory = ? AND key = ?', [(name, key) for key in removed])
+                    self._db.executemany('INSERT OR REPLACE INTO entries (directory, key, size, mtime) VALUES (?, ?, ?, ?)',
+                                         [(name, key, size, mtime) for key, (size, mtime) in keys])
+                    self._db.execute('INSERT OR REPLACE INTO directories (name, used) VALUES (?, ?)', (name, used))
+                # only the most recently used directories are kept
+                for (name,) in self._db.execute('SELECT name FROM directories ORDER BY used DESC LIMIT -1 OFFSET ?', (self.max_directories,)).fetchall():
+                    self._db.execute('DELETE FROM entries WHERE directory = ?', (name,))
+                    self._db.execute('DELETE FROM directories WHERE name = ?', (name,))
+                self._db.commit()
+            self.saves += 1
+            logger.debug('metadata snapshot %s saved (%s directories changed)', self.path,len(changed))
+        except sqlite3.Error as e:
+            logger.error('ERROR saving the metadata snapshot %s (Exception: %s)'% (self.path,str(e)))
+            with self._lock:
+                for name, used, rewrite, keys, removed in changed:
+                    if self._directories.get(name) is not None:
+                        # not known what made it into the file - written as a whole next time
+                        self._directories[name].written = False
+
+    # ==================
+    # Directories
+    # ==================
+    # to be called with the lock held
+    def _put(self, directory, entry):
+        self._directories.pop(directory, None)
+        self._directories[directory] = entry
+        while len(self._directories) > self.max_directories:
+            self._directories.popitem(last=False)
+
+    # the directory as far as it is known (to be called with the lock held) - read from the file on first use
+    def _entry(self, directory):
+        if directory in self._directories:
+            entry = self._directories[directory]
+        elif directory in self._unreconciled:
+            keys = self._read(directory)
+            entry = _Directory(keys, served=True) if keys is not None else None
+            self._asked[directory] = True
+        else:
+            entry = None
+        self._put(directory, entry)
+        if entry is not None:
+            entry.used = time()
+        return entry
+
+    # the keys of the directory from the snapshot, None if RIAK has to be asked
+    def listing(self, directory):
+        with self._lock:
+            entry = self._entry(directory)
+            if entry is None or not entry.served:
+                return None
+            self.served += 1
+            return list(entry.keys)
+
+    # (size, mtime) of the key from the snapshot, None if RIAK has to be asked
+    def attrs(self, directory, key):
+        with self._lock:
+            entry = self._entry(directory)
+            if entry is None or not entry.served:
+                return None
+            size, mtime = entry.keys.get(key, (None, None))
+            if size is None:
+                return None
+            self.served += 1
+            return size, mtime
+
+    # a complete listing read from RIAK - the sizes known for its keys are kept
+    def record_listing(self, directory, keys):
+        with self._lock:
+            entry = self._entry(directory)
+            if entry is not None and entry.served:
+                # the snapshot answered this listing itself
+                return
+            if entry is None:
+                # new to the snapshot (or dropped from memory, the file may still have its rows)
+                known = self._read(directory)
+                entry = _Directory(known if known is not None else {}, served=False, written=known is not None)
+                self._put(directory, entry)
+            entry.update(set(keys))
+
+    # a size fetched from RIAK - kept if the listing of the directory is known
+    def record_size(self, directory, key, size, mtime):
+        with self._lock:
+            entry = self._directories.get(directory)
+            if entry is not None:
+                entry.set(key, (size, mtime))
+
+    # ==================
+    # Changes done through this mount
+    # ==================
+    def add(self, directory, key, size=None, mtime=None):
+        self.record_size(directory, key, size, mtime)
+
+    def discard(self, directory, key):
+        with self._lock:
+            entry = self._directories.get(directory)
+            if entry is not None:
+                entry.remove(key)
+
+    def rename(self, directory, key, new_key):
+        with self._lock:
+            entry = self._directories.get(directory)
+            if entry is not None and key in entry.keys:
+                value = entry.keys[key]
+                entry.remove(key)
+                entry.set(new_key, value)
+
+    # ==================
+    # Background
+    # ==================
+    # reloads the listing of a directory of the snapshot file from RIAK
+    # (it is answered from the snapshot until RIAK answered)
+    def _reconcile(self, directory):
+        try:
+            keys = set(self.load_directory(directory))
+        except Exception as e:
+            logger.warning('could not reconcile RIAK directory %s with the metadata snapshot (Exception: %s)'% (directory,str(e)))
+            with self._lock:
+                self._unreconciled.pop(directory, None)
+            return
+        with self._lock:
+            self._unreconciled.pop(directory, None)
+            entry = self._directories.get(directory)
+            if entry is None:
+                if directory in self._directories:
+                    # gone from the snapshot file in the meantime
+                    self.reconciled += 1
+                    return
+                # never asked for - its rows stay as they are where RIAK lists the same keys
+                known = self._read(directory)
+                if known is None:
+                    self.reconciled += 1
+                    return
+                entry = _Directory(known, served=False)
+                self._put(directory, entry)
+            added, removed = entry.update(keys)
+            self.keys_added += added
+            self.keys_removed += removed
+            # answered by RIAK from now on - the sizes of the keys still listed are kept for the next snapshot,
+            # getattr fetches them from RIAK (and records them where they changed)
+            entry.served = False
+            self.reconciled += 1
+        logger.debug('reconciled RIAK directory %s with the metadata snapshot (%s keys)', directory,len(keys))
+
+    def _next_unreconciled(self):
+        with self._lock:
+            while self._asked:
+                directory, asked = self._asked.popitem(last=False)
+                if directory in self._unreconciled:
+                    return directory
+            return next(iter(self._unreconciled), None)
+
+    def _background(self):
+        next_save = time() + self.interval
+        while not self._stopped.is_set():
+            if (self.interval > 0) and (time() >= next_save):
+                self.save()
+                next_save = time() + self.interval
+            directory = self._next_unreconciled()
+            if directory is None:
+                # everything is reconciled - just the saves are left
+                self._stopped.wait(max(0, next_save - time()) if self.interval > 0 else None)
+                continue
+            # the directories are spread over time, the mounts' own requests go first
+            self.limiter.acquire()
+            if not self._stopped.is_set():
+                self._reconcile(directory)
+
+    # opens the snapshot file and starts reconciling it
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def start(self):
+        try:
+            directories = self._open()
+        except sqlite3.Error as e:
+            logger.error('ERROR opening the metadata snapshot %s - starting cold (Exception: %s)'% (self.path,str(e)))
+            self._db = None
+            directories = []
+        with self._lock:
+            for directory in directories:
+                self._unreconciled[directory] = True
+        logger.info('metadata snapshot %s has %s directories'% (self.path,len(directories)))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._background, name='metadata-snapshot')
+            self._thread.daemon = True
+            self._thread.start()
+
+    # writes the snapshot a last time
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.save()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self):
+        with self._lock:
+            return dict(directories=sum(1 for entry in self._directories.values() if entry is not None), unreconciled=len(self._unreconciled),
+                        served=self.served, reconciled=self.reconciled, keys_added=self.keys_added, keys_removed=self.keys_removed, saves=self.saves)
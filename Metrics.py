@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+## Low-overhead instrumentation of a mount, rendered in the Prometheus text format.
+##
+## - a latency histogram and an error counter per filesystem operation (operation() around every call)
+## - RIAK requests and bytes sent/received, per filesystem operation that caused them (instrument() wraps
+##   the RIAK backend; requests of background threads are counted as "background")
+## - whatever the subsystems report about themselves (cache hits, queue depths, ...) via add_stats() - a dict
+##   of dicts among them (like the nodes of a RiakCluster) is rendered with a name label per entry
+##
+## Recording is a couple of dictionary updates under one lock, rendering only happens when the stats are
+## asked for. serve() answers http://address:port/metrics from a background thread.
+##
+## Usage:
+##      metrics = Metrics()
+##      riak_pool = metrics.instrument(riak_pool)
+##      metrics.add_stats('attr_cache', attr_cache.stats)
+##      with metrics.operation('getattr'):
+##          ...
+##      metrics.serve('127.0.0.1', 9102)
+
+import logging
+import threading
+from time import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger('root')
+
+# upper bounds of the latency buckets in seconds (the last bucket is +Inf)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+BACKGROUND = 'background'
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    # to be called with the lock of the owner held
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # the value below which the given fraction of the observations lie (upper bound of its bucket)
+    def quantile(self, fraction):
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # operation -> Histogram
+        self._latencies = {}
+        # operation -> number of calls that raised
+        self._errors = {}
+        # (operation, request) -> [requests, bytes sent, bytes received]
+        self._requests = {}
+        # name -> function returning a dict of numbers
+        self._stats = []
+        self._server = None
+
+    # ==================
+    # Recording
+    # ==================
+
+    def current_operation(self):
+        return getattr(self._local, 'operation', BACKGROUND)
+
+    @contextmanager
+    def operation(self, name):
+        outer = getattr(self._local, 'operation', None)
+        self._local.operation = name
+        started = time()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            elapsed = time() - started
+            self._local.operation = outer if outer is not None else BACKGROUND
+            with self._lock:
+                histogram = self._latencies.get(name)
+                if histogram is None:
+                    histogram = self._latencies[name] = Histogram()
+                histogram.observe(elapsed)
+                if failed:
+                    self._errors[name] = self._errors.get(name, 0) + 1
+
+    # times a generator (readdir) until it is exhausted, the work happens while it is iterated
+    def generator(self, name, generator):
+        elapsed = 0.0
+        outer = getattr(self._local, 'operation', None)
+        try:
+            while True:
+                self._local.operation = name
+                started = time()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time() - started
+                    self._local.operation = outer if outer is not None else BACKGROUND
+                yield item
+        finally:
+            with self._lock:
+                histogram = self._latencies.get(name)
+                if histogram is None:
+                    histogram = self._latencies[name] = Histogram()
+                histogram.observe(elapsed)
+
+    def request(self, name, sent=0, received=0):
+        key = (self.current_operation(), name)
+        with self._lock:
+            counter = self._requests.get(key)
+            if counter is None:
+                counter = self._requests[key] = [0, 0, 0]
+            counter[0] += 1
+            counter[1] += sent
+            counter[2] += received
+
+    # stats() has to return a dict of numbers, it is called whenever the metrics are rendered
+    def add_stats(self, name, stats):
+        self._stats.append((name, stats))
+
+    # wraps a RIAK backend (RiakConnectionPool, FakeRiakPool), so all requests through it are counted
+    def instrument(self, riak_pool):
+        return _InstrumentedPool(riak_pool, self)
+
+    # ==================
+    # Reporting
+    # ==================
+
+    # per operation: calls, errors, p50/p99 (bucket bounds in ms), RIAK requests and bytes
+    def summary(self):
+        with self._lock:
+            summary = {}
+            for name, histogram in self._latencies.items():
+                summary[name] = dict(calls=histogram.count, errors=self._errors.get(name, 0),
+                                     p50_ms=histogram.quantile(0.5) * 1000, p99_ms=histogram.quantile(0.99) * 1000,
+                                     riak_requests=0, riak_sent=0, riak_received=0)
+            for (name, request), counter in self._requests.items():
+                entry = summary.setdefault(name, dict(calls=0, errors=0, p50_ms=0, p99_ms=0, riak_requests=0, riak_sent=0, riak_received=0))
+                entry['riak_requests'] += counter[0]
+                entry['riak_sent'] += counter[1]
+                entry['riak_received'] += counter[2]
+            return summary
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines.append('# TYPE riakfuse_operation_seconds histogram')
+            for name in sorted(self._latencies):
+                histogram = self._latencies[name]
+                cumulative = 0
+                for bound, count in zip(self._bounds(histogram), histogram.counts):
+                    cumulative += count
+                    lines.append('riakfuse_operation_seconds_bucket{op="%s",le="%s"} %s'% (name, bound, cumulative))
+                lines.append('riakfuse_operation_seconds_sum{op="%s"} %s'% (name, histogram.sum))
+                lines.append('riakfuse_operation_seconds_count{op="%s"} %s'% (name, histogram.count))
+            lines.append('# TYPE riakfuse_operation_errors_total counter')
+            for name in sorted(self._errors):
+                lines.append('riakfuse_operation_errors_total{op="%s"} %s'% (name, self._errors[name]))
+            for index, metric in ((0, 'riakfuse_riak_requests_total'), (1, 'riakfuse_riak_sent_bytes_total'), (2, 'riakfuse_riak_received_bytes_total')):
+                lines.append('# TYPE %s counter'% (metric))
+                for (name, request) in sorted(self._requests):
+                    lines.append('%s{op="%s",request="%s"} %s'% (metric, name, request, self._requests[(name, request)][index]))
+        for group, stats in self._stats:
+            try:
+                values = stats()
+            except Exception as e:
+                logger.warning('could not collect %s stats (Exception: %s)'% (group,str(e)))
+                continue
+            if 'hits' in values and 'misses' in values:
+                values = dict(values, hit_ratio=float(values['hits']) / max(1, values['hits'] + values['misses']))
+            for name in sorted(values):
+                if isinstance(values[name], dict):
+                    for entry in sorted(values[name]):
+                        for field in sorted(values[name][entry]):
+                            lines.append('riakfuse_%s_%s_%s{name="%s"} %s'% (group, name, field, entry, values[name][entry][field]))
+                elif isinstance(values[name], (int, float)) and not isinstance(values[name], bool):
+                    lines.append('riakfuse_%s_%s %s'% (group, name, values[name]))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _bounds(histogram):
+        return [repr(bound) for bound in histogram.buckets] + ['+Inf']
+
+    # answers GET /metrics on address:port from a background thread
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def serve(self, address, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = HTTPServer((address, port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, name='metrics-server')
+        thread.daemon = True
+        thread.start()
+        logger.info('serving metrics on http://%s:%s/metrics'% (address,port))
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+## The wrappers below count every request a client of the wrapped backend sends, everything else is
+## passed through. Sets (riak.datatypes.Set) call the client of their bucket, so they are counted too.
+
+class _InstrumentedPool(object):
+    def __init__(self, riak_pool, metrics):
+        self._riak_pool = riak_pool
+        self._metrics = metrics
+
+    @contextmanager
+    def client(self):
+        with self._riak_pool.client() as riakClient:
+            yield _InstrumentedClient(riakClient, self._metrics)
+
+    def __getattr__(self, name):
+        return getattr(self._riak_pool, name)
+
+
+def _size(data):
+    return len(data) if data is not None else 0
+
+
+class _InstrumentedClient(object):
+    def __init__(self, riakClient, metrics):
+        self._riakClient = riakClient
+        self._metrics = metrics
+
+    def bucket(self, name, *args, **kwargs):
+        return _InstrumentedBucket(self._riakClient.bucket(name, *args, **kwargs), self)
+
+    def bucket_type(self, name):
+        return _InstrumentedBucketType(self._riakClient.bucket_type(name), self)
+
+    def ping(self):
+        self._metrics.request('ping')
+        return self._riakClient.ping()
+
+    # called by riak.datatypes.Set with the instrumented bucket
+    def _fetch_datatype(self, bucket, key, **params):
+        result = self._riakClient._fetch_datatype(bucket._bucket, key, **params)
+        self._metrics.request('fetch_datatype', received=sum(len(member) for member in (result[1] or ())))
+        return result
+
+    def update_datatype(self, datatype, **params):
+        op = datatype.to_op() or {}
+        self._metrics.request('update_datatype', sent=sum(len(member) for member in list(op.get('adds', [])) + list(op.get('removes', []))))
+        # the real client has to see the real bucket
+        bucket = datatype.bucket
+        datatype.bucket = bucket._bucket
+        try:
+            return self._riakClient.update_datatype(datatype, **params)
+        finally:
+            datatype.bucket = bucket
+
+    def __getattr__(self, name):
+        return getattr(self._riakClient, name)
+
+
+class _InstrumentedBucketType(object):
+    def __init__(self, bucket_type, client):
+        self._bucket_type = bucket_type
+        self._client = client
+
+    def bucket(self, name):
+        return _InstrumentedBucket(self._bucket_type.bucket(name), self._client)
+
+    def __getattr__(self, name):
+        return getattr(self._bucket_type, name)
+
+
+class _InstrumentedBucket(object):
+    def __init__(self, bucket, client):
+        self._bucket = bucket
+        self._client = client
+
+    def get(self, key, *args, **kwargs):
+        riak_object = self._bucket.get(key, *args, **kwargs)
+        self._client._metrics.request('get', received=_size(riak_object.encoded_data) if riak_object.exists else 0)
+        return riak_object
+
+    def new(self, key, *args, **kwargs):
+        return _InstrumentedObject(self._bucket.new(key, *args, **kwargs), self._client._metrics)
+
+    def delete(self, key, *args, **kwargs):
+        self._client._metrics.request('delete')
+        return self._bucket.delete(key, *args, **kwargs)
+
+    def stream_keys(self, *args, **kwargs):
+        self._client._metrics.request('stream_keys')
+        return self._bucket.stream_keys(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._bucket, name)
+
+
+class _InstrumentedObject(object):
+    def __init__(self, riak_object, metrics):
+        self._riak_object = riak_object
+        self._metrics = metrics
+
+    def store(self, *args, **kwargs):
+        self._metrics.request('put', sent=_size(self._riak_object.encoded_data))
+        self._riak_object.store(*args, **kwargs)
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self._riak_object, name)
+
+    # content_encoding and friends are set on the object that gets stored
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._riak_object, name, value)
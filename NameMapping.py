@@ -22,6 +22,88 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import re
+import threading
+from collections import namedtuple, OrderedDict
+
+## The layout riak-fuse was written for: /$id/images/$imagename.jpg
+LEGACY_TEMPLATE = '/{bucket}/images/{key}'
+
+## What a path maps to - bucket and directory_bucket are set for the folder a file is in and everything
+## below it, key only for the files themselves. Unmappable paths map to (None, None, None).
+RiakName = namedtuple('RiakName', ['bucket', 'directory_bucket', 'key'])
+
+_NO_NAME = RiakName(None, None, None)
+
+
+## Maps paths to RIAK names following a path template, e.g. the legacy layout:
+##      /{bucket}/images/{key}
+## {bucket} is the part of the path the bucket names are built from (prefixed with bucket_prefix and
+## directory_prefix), {key} the file name. Both have to be whole path components, {key} the last one;
+## * matches any single component, everything else literally.
+##
+## The template is compiled into regular expressions once, the results of the last cache_size paths are
+## remembered - every filesystem call maps its path with a single dictionary lookup.
+##
+## Example:
+## PathMapper('/{bucket}/images/{key}', 'IMG_', 'IMGDIR_').map('/fdaf16c657d997656bbccc5752eefa9f/images/1620028670_192497.jpg')
+##      --> RiakName(bucket='IMG_fdaf16c657d997656bbccc5752eefa9f', directory_bucket='IMGDIR_fdaf16c657d997656bbccc5752eefa9f', key='1620028670_192497.jpg')
+class PathMapper(object):
+    def __init__(self, template, bucket_prefix, directory_prefix, cache_size=10000):
+        self.template = template
+        self.bucket_prefix = bucket_prefix
+        self.directory_prefix = directory_prefix
+        self.cache_size = cache_size
+        self._pattern = self._compile(template)
+
+        self._lock = threading.Lock()
+        # path -> RiakName, least recently used first
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def _compile(template):
+        components = template.strip('/').split('/')
+        if components.count('{bucket}') != 1 or components[-1] != '{key}' or components.count('{key}') != 1:
+            raise ValueError('path template %s needs exactly one {bucket} component and {key} as last component'% (template))
+        patterns = []
+        for component in components[:-1]:
+            if component == '{bucket}':
+                patterns.append('(?P<bucket>[^/]+)')
+            elif component == '*':
+                patterns.append('[^/]+')
+            else:
+                patterns.append(re.escape(component))
+        folder = '/' + '/'.join(patterns)
+        # the folder itself and anything below it belongs to the buckets, only direct children are keys
+        return re.compile('^%s(?:/(?P<key>[^/]+)|(?:/.*)?)$'% (folder))
+
+    def map(self, path):
+        if self.cache_size <= 0:
+            return self._map(path)
+        with self._lock:
+            name = self._cache.pop(path, None)
+            if name is not None:
+                self._cache[path] = name
+                return name
+        name = self._map(path)
+        with self._lock:
+            self._cache[path] = name
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return name
+
+    def _map(self, path):
+        if not path.startswith('/'):
+            path = '/' + path
+        match = self._pattern.match(path)
+        if match is None:
+            return _NO_NAME
+        bucket = match.group('bucket')
+        return RiakName(self.bucket_prefix + bucket, self.directory_prefix + bucket, match.group('key'))
+
+
+_legacy_mapper = PathMapper(LEGACY_TEMPLATE, '', '')
+
 ## This will take a legacy path in the form like:
 ##      /$id/images/$imagename.jpg
 ## and transform it to the name that is going to be used for the RIAK bucket name
@@ -30,17 +112,10 @@
 ## Example:
 ## /fdaf16c657d997656bbccc5752eefa9f/images/1620028670_192497.jpg --> fdaf16c657d997656bbccc5752eefa9f/1620028670_192497.jpg
 def legacyPathToRiakBucketName(Prefix, LegacyPath):
-    # strip the trailing / if it is there
-    if LegacyPath.startswith("/"):
-        path_parts = LegacyPath[1:].split('/')
-    else:
-        path_parts = LegacyPath.split('/')
-    # it needs to contain images as the second part and needs to be exactly 3 elements long
-    if (len(path_parts) > 1):
-        if (path_parts[1] == 'images') and (len(path_parts) >= 2):
-            return str(Prefix)+str(path_parts[0])
-        else:
-            return None
+    bucket = _legacy_mapper.map(LegacyPath).bucket
+    if bucket is None:
+        return None
+    return str(Prefix)+bucket
 
 ## This will take a legacy path in the form like:
 ##      /id/images/$imagename.jpg
@@ -50,14 +125,4 @@ def legacyPathToRiakBucketName(Prefix, LegacyPath):
 ## Example:
 ## /fdaf16c657d997656bbccc5752eefa9f/images/1620028670_192497.jpg --> 1620028670_192497.jpg
 def legacyPathToRiakKeyName(LegacyPath):
-    # strip the trailing / if it is there
-    if LegacyPath.startswith("/"):
-        path_parts = LegacyPath[1:].split('/')
-    else:
-        path_parts = LegacyPath.split('/')
-    # it needs to contain images as the second part and needs to be exactly 3 elements long
-    if (len(path_parts) > 1):
-        if (path_parts[1] == 'images') and (len(path_parts) == 3):
-            return str(path_parts[-1:][0])
-        else:
-            return None
+    return _legacy_mapper.map(LegacyPath).key
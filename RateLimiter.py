@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+## Limits how many requests per second a background job (the scrubber) sends to RIAK, so it can run next
+## to the live traffic of the mounts.
+##
+## A token bucket shared by all threads of the job: up to burst requests may go out at once, after that
+## acquire() waits until the next request is due. A rate of 0 means unlimited.
+##
+## Usage:
+##      limiter = RateLimiter(200)
+##      limiter.acquire()
+##      bucket.get('file.jpg')
+
+import threading
+from time import time, sleep
+
+
+class RateLimiter(object):
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._lock = threading.Lock()
+        # the time the bucket is empty again if nothing else is acquired
+        self._empty_at = 0.0
+        self.waited = 0.0
+
+    # blocks until n more requests may be sent
+    def acquire(self, n=1):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time()
+            self._empty_at = max(self._empty_at, now) + float(n) / self.rate
+            delay = self._empty_at - now - float(self.burst) / self.rate
+            if delay > 0:
+                self.waited += delay
+        if delay > 0:
+            sleep(delay)
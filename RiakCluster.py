@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+## Spreads the RIAK requests of riak-fuse over several nodes of a cluster.
+##
+## Every node gets its own pool of connections (RiakConnectionPool). A caller is handed a client of the node
+## that is expected to answer first:
+## - least_outstanding: the node with the fewest requests in progress (ties go to the lower latency)
+## - latency: the node with the lowest measured latency times (requests in progress + 1)
+## The latency of a node is a moving average of the pings a background thread sends every probe_interval seconds.
+##
+## A node whose connections failed eject_after times in a row (refused, reset, timed out) is ejected: it gets
+## no requests for eject_interval seconds, then it is pinged again and reinstated once it answers. When every
+## node is ejected the requests are spread over all of them - failing fast is no better than trying.
+##
+## A request that fails with a connection error is retried once on the next available node if it can be
+## repeated safely: get (also head_only), set fetches, delete and the store of an object that carries a vclock.
+## Other requests (stores of new objects, set updates, key streams) fail to the caller, later ones avoid the node.
+##
+## The cluster is a RIAK backend like RiakConnectionPool (client(), start(), close(), stats()), stats() also
+## has the counters of every node. createPool() builds either of them from a --riakhost list.
+##
+## Usage:
+##      riak_pool = RiakCluster.createPool('riak1,riak2:8088,riak3', 8087, pool_size=8, request_timeout=5)
+##      riak_pool.start()
+##      with riak_pool.client() as riakClient:
+##          riakClient.bucket('IMG_test').get('file.jpg')
+##      riak_pool.stats()['nodes']['riak2:8088']
+##      riak_pool.close()
+
+import random
+import logging
+import threading
+from time import time
+from contextlib import contextmanager
+
+from RiakConnectionPool import RiakConnectionPool, CONNECTION_ERRORS
+
+logger = logging.getLogger('root')
+
+LEAST_OUTSTANDING = 'least_outstanding'
+LATENCY = 'latency'
+BALANCE_POLICIES = (LEAST_OUTSTANDING, LATENCY)
+
+# weight of the newest ping in the moving average of the latency of a node
+LATENCY_SMOOTHING = 0.3
+
+
+# 'riak1,riak2:8088' -> [('riak1', port), ('riak2', 8088)]
+def parseNodes(hosts, port):
+    nodes = []
+    for node in hosts.split(','):
+        node = node.strip()
+        if not node:
+            continue
+        host, separator, node_port = node.rpartition(':')
+        if separator and node_port.isdigit():
+            nodes.append((host, int(node_port)))
+        else:
+            nodes.append((node, port))
+    if not nodes:
+        raise ValueError('no RIAK node given')
+    return nodes
+
+
+## Builds the RIAK backend for a --riakhost list: a RiakConnectionPool for a single node,
+## a RiakCluster of one RiakConnectionPool per node for more of them
+def createPool(hosts, port, pool_size=8, keepalive_interval=30, acquire_timeout=10, retries=3, request_timeout=0,
+               balance=LEAST_OUTSTANDING, eject_after=3, eject_interval=10, probe_interval=2):
+    nodes = parseNodes(hosts, port)
+
+    def pool_factory(host, port):
+        return RiakConnectionPool(host, port, pool_size=pool_size, keepalive_interval=keepalive_interval, acquire_timeout=acquire_timeout,
+                                  retries=retries, request_timeout=request_timeout)
+    if len(nodes) == 1:
+        return pool_factory(*nodes[0])
+    return RiakCluster(nodes, pool_factory, balance=balance, eject_after=eject_after, eject_interval=eject_interval, probe_interval=probe_interval)
+
+
+class _Node(object):
+    def __init__(self, host, port, pool):
+        self.name = '%s:%s'% (host, port)
+        self.pool = pool
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        # connection errors since the last request or ping that went through
+        self.failures = 0
+        self.ejections = 0
+        # timestamp the node may be probed again at - None while it is in use
+        self.ejected_until = None
+        # moving average of the ping round trips in seconds, None until the first ping
+        self.latency = None
+
+
+class RiakCluster(object):
+    # pool_factory(host, port) has to return the RIAK backend (RiakConnectionPool, FakeRiakPool) of that node
+    def __init__(self, nodes, pool_factory, balance=LEAST_OUTSTANDING, eject_after=3, eject_interval=10, probe_interval=2):
+        if balance not in BALANCE_POLICIES:
+            raise ValueError('unknown balance policy %s'% (balance))
+        self.balance = balance
+        self.eject_after = max(1, eject_after)
+        self.eject_interval = eject_interval
+        self.probe_interval = probe_interval
+        self.nodes = [_Node(host, port, pool_factory(host, port)) for host, port in nodes]
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._probe_thread = None
+        # requests handed to an ejected node because no node was left
+        self.fail_open = 0
+        # requests retried on another node after a connection error
+        self.fail_overs = 0
+
+    # ==================
+    # Balancing
+    # ==================
+    def _available(self, node, now):
+        if node.ejected_until is None:
+            return True
+        # without the probe thread the next request after the interval probes the node
+        return self._probe_thread is None and now >= node.ejected_until
+
+    def _score(self, node):
+        latency = node.latency or 0.0
+        if self.balance == LATENCY:
+            return (latency * (node.outstanding + 1), node.outstanding, random.random())
+        return (node.outstanding, latency, random.random())
+
+    # to be called with the lock held, returns None if there is no node but the excluded one
+    def _choose(self, exclude=None):
+        now = time()
+        nodes = [node for node in self.nodes if node is not exclude]
+        if not nodes:
+            return None
+        candidates = [node for node in nodes if self._available(node, now)]
+        if not candidates:
+            self.fail_open += 1
+            candidates = nodes
+        return min(candidates, key=self._score)
+
+    # ==================
+    # Health
+    # ==================
+    def _failed(self, node, e):
+        with self._lock:
+            node.errors += 1
+            node.failures += 1
+            if node.failures < self.eject_after:
+                return
+            ejected = node.ejected_until is not None
+            node.ejected_until = time() + self.eject_interval
+            if not ejected:
+                node.ejections += 1
+        if ejected:
+            logger.debug('RIAK node %s still fails - ejected for another %s seconds (Exception: %s)', node.name,self.eject_interval,str(e))
+        else:
+            logger.warning('RIAK node %s ejected for %s seconds after %s failures in a row (Exception: %s)'% (node.name,self.eject_interval,node.failures,str(e)))
+
+    def _succeeded(self, node):
+        with self._lock:
+            node.failures = 0
+            reinstated = node.ejected_until is not None
+            node.ejected_until = None
+        if reinstated:
+            logger.info('RIAK node %s answers again - reinstated'% (node.name))
+
+    # hands out a client of the best node for the duration of the with-block
+    @contextmanager
+    def client(self):
+        with self._lock:
+            node = self._choose()
+            node.outstanding += 1
+            node.requests += 1
+        failover = None
+        try:
+            with node.pool.client() as riakClient:
+                failover = _FailoverClient(self, node, riakClient)
+                yield failover
+        except CONNECTION_ERRORS as e:
+            # a failed retry was counted for the node that was retried on already
+            if (failover is None) or not failover._counted(e):
+                self._failed(node, e)
+            raise
+        else:
+            # only requests the node answered itself reinstate it - not a block without any or one retried elsewhere
+            if node.failures and failover._answered and not failover._failed:
+                self._succeeded(node)
+        finally:
+            with self._lock:
+                node.outstanding -= 1
+
+    # retries a request that failed on node with a connection error once on the next available node
+    def _fail_over(self, node, failover, request):
+        with self._lock:
+            other = self._choose(exclude=node)
+            if other is None:
+                return None, False
+            other.outstanding += 1
+            other.requests += 1
+            self.fail_overs += 1
+        logger.debug('retrying a RIAK request on node %s instead of %s', other.name,node.name)
+        try:
+            with other.pool.client() as riakClient:
+                result = request(riakClient)
+        except CONNECTION_ERRORS as e:
+            self._failed(other, e)
+            failover._failed.append(e)
+            raise
+        else:
+            if other.failures:
+                self._succeeded(other)
+            return result, True
+        finally:
+            with self._lock:
+                other.outstanding -= 1
+
+    # pings every node that is in use or due to be probed again and measures the round trip
+    def _probe(self):
+        while not self._stopped.wait(self.probe_interval):
+            now = time()
+            for node in self.nodes:
+                if node.ejected_until is not None and now < node.ejected_until:
+                    continue
+                if node.pool.stats()['idle'] == 0:
+                    # every connection is busy - the requests in progress tell about this node already
+                    continue
+                started = time()
+                try:
+                    with node.pool.client() as riakClient:
+                        if not riakClient.ping():
+                            raise IOError('ping not answered')
+                except Exception as e:
+                    self._failed(node, e)
+                    continue
+                elapsed = time() - started
+                with self._lock:
+                    node.latency = elapsed if node.latency is None else (1 - LATENCY_SMOOTHING) * node.latency + LATENCY_SMOOTHING * elapsed
+                self._succeeded(node)
+
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def start(self):
+        for node in self.nodes:
+            node.pool.start()
+        if self.probe_interval > 0 and self._probe_thread is None:
+            self._probe_thread = threading.Thread(target=self._probe, name='riak-probe')
+            self._probe_thread.daemon = True
+            self._probe_thread.start()
+
+    def stats(self):
+        nodes = {}
+        totals = dict(size=0, idle=0, in_use=0)
+        with self._lock:
+            for node in self.nodes:
+                pool = node.pool.stats()
+                for name in totals:
+                    totals[name] += pool[name]
+                nodes[node.name] = dict(requests=node.requests, outstanding=node.outstanding, errors=node.errors, ejections=node.ejections,
+                                        ejected=int(node.ejected_until is not None), latency_ms=(node.latency or 0.0) * 1000, idle=pool['idle'])
+            available = sum(1 for node in self.nodes if node.ejected_until is None)
+        return dict(totals, nodes_available=available, fail_open=self.fail_open, fail_overs=self.fail_overs, nodes=nodes)
+
+    def close(self):
+        self._stopped.set()
+        for node in self.nodes:
+            node.pool.close()
+
+
+## The wrappers below hand the requests of a with-block to the client of its node and retry the ones that
+## can be repeated on another node (see RiakCluster._fail_over). Everything else is passed through.
+
+class _FailoverClient(object):
+    def __init__(self, cluster, node, riakClient):
+        self._cluster = cluster
+        self._node = node
+        self._riakClient = riakClient
+        # connection errors the failing node was charged with already
+        self._failed = []
+        # whether the node answered a request of the with-block
+        self._answered = False
+
+    def _counted(self, e):
+        return any(e is failed for failed in self._failed)
+
+    # runs request(riakClient) on the node of the with-block, once more on another node after a connection error
+    def _request(self, request, first=None):
+        try:
+            result = first() if first is not None else request(self._riakClient)
+            self._answered = True
+            return result
+        except CONNECTION_ERRORS as e:
+            self._cluster._failed(self._node, e)
+            self._failed.append(e)
+            result, retried = self._cluster._fail_over(self._node, self, request)
+            if not retried:
+                raise
+            return result
+
+    def bucket(self, name, *args, **kwargs):
+        return _FailoverBucket(self, lambda riakClient: riakClient.bucket(name, *args, **kwargs))
+
+    def bucket_type(self, name):
+        return _FailoverBucketType(self, name)
+
+    # called by riak.datatypes.Set with the failover bucket - a fetch is repeated like a get
+    def _fetch_datatype(self, bucket, key, **params):
+        return self._request(lambda riakClient: riakClient._fetch_datatype(bucket._select(riakClient), key, **params))
+
+    def update_datatype(self, datatype, **params):
+        # the real client has to see the real bucket
+        bucket = datatype.bucket
+        datatype.bucket = bucket._bucket
+        try:
+            result = self._riakClient.update_datatype(datatype, **params)
+            self._answered = True
+            return result
+        finally:
+            datatype.bucket = bucket
+
+    def __getattr__(self, name):
+        return getattr(self._riakClient, name)
+
+
+class _FailoverBucketType(object):
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+        self._bucket_type = client._riakClient.bucket_type(name)
+
+    def bucket(self, name):
+        return _FailoverBucket(self._client, lambda riakClient: riakClient.bucket_type(self._name).bucket(name))
+
+    def __getattr__(self, name):
+        return getattr(self._bucket_type, name)
+
+
+class _FailoverBucket(object):
+    # select(riakClient) returns the bucket of the given client
+    def __init__(self, client, select):
+        self._client = client
+        self._select = select
+        self._bucket = select(client._riakClient)
+
+    def get(self, key, *args, **kwargs):
+        riak_object = self._client._request(lambda riakClient: self._select(riakClient).get(key, *args, **kwargs))
+        return _FailoverObject(riak_object, self)
+
+    def new(self, key, *args, **kwargs):
+        return _FailoverObject(self._bucket.new(key, *args, **kwargs), self)
+
+    def delete(self, key, *args, **kwargs):
+        return self._client._request(lambda riakClient: self._select(riakClient).delete(key, *args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._bucket, name)
+
+
+class _FailoverObject(object):
+    def __init__(self, riak_object, bucket):
+        self._riak_object = riak_object
+        self._bucket = bucket
+
+    # stored again on another node only with a vclock - a new object stored twice could end up as siblings
+    def store(self, *args, **kwargs):
+        riak_object = self._riak_object
+
+        def store_copy(riakClient):
+            copy = self._bucket._select(riakClient).new(riak_object.key, encoded_data=riak_object.encoded_data, content_type=riak_object.content_type)
+            copy.vclock = riak_object.vclock
+            if getattr(riak_object, 'content_encoding', None):
+                copy.content_encoding = riak_object.content_encoding
+            copy.store(*args, **kwargs)
+        if riak_object.vclock is None:
+            riak_object.store(*args, **kwargs)
+            self._bucket._client._answered = True
+        else:
+            self._bucket._client._request(store_copy, first=lambda: riak_object.store(*args, **kwargs))
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self._riak_object, name)
+
+    # content_encoding and friends are set on the object that gets stored
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._riak_object, name, value)
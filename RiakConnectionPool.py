@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## A small, bounded pool of long-lived RIAK clients shared by all filesystem operations.
+##
+## Every RiakClient in the pool keeps its PBC connection open between operations, so a FUSE call
+## only pays for the actual request and not for a connect/teardown. The pool is bounded: when all
+## clients are in use a caller waits (up to the acquire timeout) until one is handed back. With a request
+## timeout, a request that gets no answer within that many seconds fails (and its connection is dropped).
+##
+## Usage:
+##      pool = RiakConnectionPool('localhost', 8087, pool_size=8)
+##      pool.start()
+##      with pool.client() as riakClient:
+##          riakClient.bucket('IMG_test').get('file.jpg')
+##      pool.close()
+
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+
+import riak
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from riak.transports.pool import BadResource
+except ImportError:
+    class BadResource(Exception):
+        pass
+
+logger = logging.getLogger('root')
+
+# exceptions that indicate the underlying connection is no longer usable - not just any OSError, a local
+# file that can't be opened inside a with-block must not reset the connection
+try:
+    CONNECTION_ERRORS = (ConnectionError, TimeoutError, socket.timeout, socket.herror, socket.gaierror, BadResource)
+except NameError:
+    # python 2: every socket.error (errors of local files are no socket.error there)
+    CONNECTION_ERRORS = (socket.error, BadResource)
+
+
+class RiakConnectionPool(object):
+    def __init__(self, host, port, pool_size=8, keepalive_interval=30, acquire_timeout=10, retries=3, request_timeout=0):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.keepalive_interval = keepalive_interval
+        self.acquire_timeout = acquire_timeout
+        self.retries = retries
+        self.request_timeout = request_timeout
+
+        self._idle = queue.Queue(maxsize=pool_size)
+        for i in range(pool_size):
+            self._idle.put(self._new_client())
+
+        self._stopped = threading.Event()
+        self._keepalive_thread = None
+
+    def _new_client(self):
+        # the client connects lazily on first use, so creating it here is cheap
+        # the timeout is set on the socket - it bounds the connect and every wait for an answer
+        transport_options = dict(timeout=self.request_timeout) if self.request_timeout > 0 else {}
+        riakClient = riak.RiakClient(host=self.host, pb_port=self.port, protocol='pbc', transport_options=transport_options)
+        riakClient.retries = self.retries
+        return riakClient
+
+    def _reset(self, riakClient):
+        # drop the (stale) connections of this client - it will reconnect on its next request
+        try:
+            riakClient.close()
+        except Exception as e:
+            logger.debug('ignoring error while closing stale RIAK connection (Exception: %s)', str(e))
+
+    # hands out one client of the pool for the duration of the with-block
+    @contextmanager
+    def client(self):
+        try:
+            riakClient = self._idle.get(timeout=self.acquire_timeout)
+        except queue.Empty:
+            logger.error('ERROR no RIAK connection available within %s seconds (pool size %s)'% (self.acquire_timeout,self.pool_size))
+            raise
+        try:
+            yield riakClient
+        except CONNECTION_ERRORS as e:
+            logger.warning('RIAK connection went stale - reconnecting on next use (Exception: %s)'% (str(e)))
+            self._reset(riakClient)
+            raise
+        finally:
+            self._idle.put(riakClient)
+
+    # keeps idle connections warm and detects dead ones before a filesystem call runs into them
+    def _keepalive(self):
+        while not self._stopped.wait(self.keepalive_interval):
+            for i in range(self.pool_size):
+                try:
+                    riakClient = self._idle.get_nowait()
+                except queue.Empty:
+                    # everything else is busy and therefore warm anyways
+                    break
+                try:
+                    if not riakClient.ping():
+                        self._reset(riakClient)
+                except Exception as e:
+                    logger.warning('RIAK keepalive ping failed - reconnecting on next use (Exception: %s)'% (str(e)))
+                    self._reset(riakClient)
+                finally:
+                    self._idle.put(riakClient)
+
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def start(self):
+        if self.keepalive_interval > 0 and self._keepalive_thread is None:
+            self._keepalive_thread = threading.Thread(target=self._keepalive, name='riak-keepalive')
+            self._keepalive_thread.daemon = True
+            self._keepalive_thread.start()
+
+    def stats(self):
+        idle = self._idle.qsize()
+        return dict(size=self.pool_size, idle=idle, in_use=self.pool_size - idle)
+
+    def close(self):
+        self._stopped.set()
+        closed = []
+        while True:
+            try:
+                riakClient = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._reset(riakClient)
+            closed.append(riakClient)
+        # hand them back - a late caller would simply reconnect
+        for riakClient in closed:
+            self._idle.put(riakClient)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## Reads and writes the directory structure riak-fuse maintains in the RIAK directory buckets.
+##
+## A directory bucket ($riak_directory_namespace_prefix$foldername) holds
+##      - the listing of the folder: one set (directory_key) or shards sets (see DirectoryShards)
+##      - the size of every file: one size set per file (metadata = 'sets') or one metadata record per file
+##        in the default bucket type (metadata = 'record', see FileMetadata)
+##
+## Used by the mount itself and by the tools working on the same buckets (importer, scrubber), so they all
+## agree on the layout. Methods taking a riakClient use the caller's pooled connection.
+##
+## Usage:
+##      riak_directory = RiakDirectory(riak_pool, bucket_type='sets', directory_key='directory', shards=16, metadata='record')
+##      riak_directory.flush('IMGDIR_test', ['new.jpg'], ['old.jpg'])
+##      with riak_pool.client() as riakClient:
+##          size, mtime = riak_directory.fetch_size(riakClient, 'IMGDIR_test', 'new.jpg')
+
+import riak.datatypes as datatypes
+
+import FileMetadata
+import DirectoryShards
+from LockTable import LockTable
+
+
+class RiakDirectory(object):
+    def __init__(self, riak_pool, bucket_type='sets', directory_key='directory', shards=0, metadata='sets'):
+        self.riak_pool = riak_pool
+        self.bucket_type = bucket_type
+        self.directory_key = directory_key
+        self.shards = shards
+        self.metadata = metadata
+        # one read-modify-write of the listing of a directory at a time
+        self._locks = LockTable()
+
+    def _set_bucket(self, riakClient, directory):
+        # get the bucket for the directory namespace - this is a sets pre-configured bucket
+        return riakClient.bucket_type(self.bucket_type).bucket(directory)
+
+    # ==================
+    # Listing
+    # ==================
+
+    # yields (set key, keys listed in it) shard by shard, the pooled connection is handed back in between
+    def listing(self, directory):
+        for set_key in DirectoryShards.setKeys(self.directory_key, self.shards):
+            with self.riak_pool.client() as riakClient:
+                myset = datatypes.Set(self._set_bucket(riakClient, directory), set_key)
+                myset.reload()
+            yield set_key, myset.value
+
+    # returns all keys listed in the directory
+    def load_keys(self, directory):
+        keys = set()
+        for set_key, members in self.listing(directory):
+            keys.update(members)
+        return keys
+
+    # the key of the set listing the given file
+    def set_key_for(self, key):
+        return DirectoryShards.setKeyFor(self.directory_key, key, self.shards)
+
+    # adds and discards keys with one set operation per shard that changed
+    def flush(self, directory, adds, discards):
+        shard_adds = DirectoryShards.groupBySet(self.directory_key, adds, self.shards)
+        shard_discards = DirectoryShards.groupBySet(self.directory_key, discards, self.shards)
+        with self._locks.lock(directory), self.riak_pool.client() as riakClient:
+            bucket = self._set_bucket(riakClient, directory)
+            for set_key in sorted(set(shard_adds) | set(shard_discards)):
+                myset = datatypes.Set(bucket, set_key)
+                set_discards = shard_discards.get(set_key, [])
+                if set_discards:
+                    # removing needs the current context - and RIAK refuses to remove what isn't there
+                    myset.reload()
+                    set_discards = [key for key in set_discards if key in myset.value]
+                for key in set_discards:
+                    myset.discard(key)
+                # if it's already there it won't be added (handled by RIAK)
+                set_adds = shard_adds.get(set_key, [])
+                for key in set_adds:
+                    myset.add(key)
+                if set_adds or set_discards:
+                    myset.store()
+
+    # ==================
+    # Sizes / metadata
+    # ==================
+
+    # returns (size, mtime) of a file, (None, None) if none is stored
+    def fetch_size(self, riakClient, directory, key):
+        if (self.metadata == 'record'):
+            # size and mtime with one get
+            record = FileMetadata.fetch(riakClient.bucket(directory), key)
+            if record is None:
+                return None, None
+            return record['size'], record['mtime']
+        # read the set contents...
+        myset = datatypes.Set(self._set_bucket(riakClient, directory), key)
+        myset.reload()
+        if len(myset) > 0:
+            return int(next(iter(myset))), None
+        return None, None
+
+    # returns the metadata record of a file, None if none is stored - size sets only know the size, a size set
+    # holding more than one size (stored concurrently by several mounts, or by mounts that added the size of every
+    # upload without removing the previous one) has all of them in 'sizes'
+    def fetch_record(self, riakClient, directory, key):
+        if (self.metadata == 'record'):
+            return FileMetadata.fetch(riakClient.bucket(directory), key)
+        myset = datatypes.Set(self._set_bucket(riakClient, directory), key)
+        myset.reload()
+        if len(myset) == 0:
+            return None
+        sizes = sorted(int(size) for size in myset)
+        record = FileMetadata.makeRecord(sizes[0], None)
+        record['sizes'] = sizes
+        return record
+
+    # stores size (and with metadata records everything else) of the metadata record of a stored file
+    def store_size(self, riakClient, directory, key, record):
+        if (self.metadata == 'record'):
+            FileMetadata.store(riakClient.bucket(directory), key, record)
+        else:
+            mysizeset = datatypes.Set(self._set_bucket(riakClient, directory), key)
+            # removing the size of the previous version needs the current context
+            mysizeset.reload()
+            size = str(record['size'])
+            for previous in list(mysizeset):
+                if previous != size:
+                    mysizeset.discard(previous)
+            mysizeset.add(size)
+            # send to RIAK afterall
+            mysizeset.store()
+
+    # removes the size (with metadata records everything else) of a file
+    def remove_size(self, riakClient, directory, key):
+        if (self.metadata == 'record'):
+            # one delete removes all of it, whether there was a record or not
+            FileMetadata.delete(riakClient.bucket(directory), key)
+            return
+        mysizeset = datatypes.Set(self._set_bucket(riakClient, directory), key) # this is the set
+        mysizeset.reload()
+        if len(mysizeset) > 0:
+            for size in list(mysizeset):
+                mysizeset.discard(size)
+            # send to RIAK afterall
+            mysizeset.store()
+
+    # moves the size set / metadata record of a renamed file along - stored under the new key before it is
+    # removed from the old one, whatever the new key had is replaced
+    def move_size(self, riakClient, directory, key, new_key):
+        if (self.metadata == 'record'):
+            metadata_bucket = riakClient.bucket(directory)
+            record = FileMetadata.fetch(metadata_bucket, key)
+            if record is not None:
+                FileMetadata.store(metadata_bucket, new_key, record)
+                FileMetadata.delete(metadata_bucket, key)
+            return
+        sizes = datatypes.Set(self._set_bucket(riakClient, directory), key)
+        sizes.reload()
+        if len(sizes) == 0:
+            return
+        new_sizes = datatypes.Set(self._set_bucket(riakClient, directory), new_key)
+        new_sizes.reload()
+        if new_sizes.value != sizes.value:
+            for size in new_sizes.value - sizes.value:
+                new_sizes.discard(size)
+            for size in sizes.value - new_sizes.value:
+                new_sizes.add(size)
+            new_sizes.store()
+        for size in list(sizes):
+            sizes.discard(size)
+        sizes.store()
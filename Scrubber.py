@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+## Compares what riak-fuse keeps about every file - the local copy, the object in the content bucket, the
+## size set / metadata record and the directory listing - and reports or repairs the differences.
+##
+## A directory is scrubbed as a whole: its listing is read once, then every key that is listed, exists
+## locally (or with stream_keys exists in the content bucket) is inspected by a pool of workers. With
+## verify_content the contents are fetched and their length and sha1 compared, otherwise a head request
+## only tells whether they exist. The contents of a deduplicated file are those of its blob (see BlobStore).
+## Every RIAK request waits for the rate limiter.
+##
+## A mount may be just about to change a file (a pending directory flush, an upload in progress), so a
+## difference is only acted upon when it is still there after grace seconds. Repairs:
+##      not_uploaded    local copy, no content          -> upload the local copy
+##      local_differs   local copy differs from RIAK    -> upload the local copy (a failed release)
+##      dangling        listed/size, neither content nor local copy -> remove it from listing and size
+##      unlisted        content not in the listing      -> add it to the listing
+##      missing_size    content without size            -> store the size
+##      size_mismatch   stored size differs from content -> store the size of the content
+##      stale_sizes     a size set with several sizes   -> keep only the right one
+##      hash_mismatch   content sha1 differs from record (nothing to repair it from) -> reported only
+##
+## Usage:
+##      scrubber = Scrubber(riak_pool, riak_directory, RateLimiter(200), workers=8, repair=True)
+##      scrubber.start()
+##      scrubber.scrub('IMG_test', 'IMGDIR_test', {'file.jpg': '/mnt/source/test/images/file.jpg'})
+##      scrubber.close()
+
+import os
+import logging
+import hashlib
+import threading
+from time import sleep
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import ChunkStore
+import BlobStore
+import Compression
+import FileMetadata
+import Uploader
+
+logger = logging.getLogger('root')
+
+PROBLEMS = ('not_uploaded', 'local_differs', 'dangling', 'unlisted', 'missing_size', 'size_mismatch', 'stale_sizes', 'hash_mismatch')
+
+
+## What one inspection found out about a key, problem is None if everything agrees
+class _Finding(object):
+    def __init__(self, key):
+        self.key = key
+        self.problem = None
+        self.record = None
+        self.content_size = None
+        self.content_sha1 = None
+        self.chunk_size = 0
+        self.chunks = 0
+        self.local_path = None
+        self.local_stat = None
+
+
+## The keys of one directory handed to the workers, done once every key was inspected
+class _Batch(object):
+    def __init__(self, bucket, directory, listed, local, count):
+        self.bucket = bucket
+        self.directory = directory
+        self.listed = listed
+        self.local = local
+        self.findings = []
+        self._remaining = count
+        self._done = threading.Condition()
+
+    def add(self, finding):
+        with self._done:
+            if finding is not None:
+                self.findings.append(finding)
+            self._remaining -= 1
+            self._done.notify_all()
+
+    def wait(self):
+        with self._done:
+            while self._remaining > 0:
+                self._done.wait()
+
+
+class Scrubber(object):
+    def __init__(self, riak_pool, riak_directory, limiter, workers=8, repair=False, verify_content=False, stream_keys=False,
+                 grace=10.0, content_type='application/octet-stream', chunk_size=0, compressor=None, blob_store=None):
+        self.riak_pool = riak_pool
+        self.riak_directory = riak_directory
+        self.limiter = limiter
+        self.workers = workers
+        self.repair = repair
+        self.verify_content = verify_content
+        self.stream_keys = stream_keys
+        self.grace = grace
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self.compressor = compressor
+        # re-uploads go through the blob store when the mounts deduplicate
+        self.blob_store = blob_store
+
+        self._queue = queue.Queue(workers * 4)
+        self._threads = []
+        self._lock = threading.Lock()
+        self.directories = 0
+        self.checked = 0
+        self.found = dict((problem, 0) for problem in PROBLEMS)
+        self.repaired = 0
+        self.failed = 0
+
+    # ==================
+    # Inspecting
+    # ==================
+
+    def _local_sha1(self, path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(1024*1024)
+                if not data:
+                    break
+                digest.update(data)
+        return digest.hexdigest()
+
+    # reads the content of key (as far as needed) into the finding, returns False if there is none
+    def _inspect_content(self, riakClient, bucket, finding):
+        self.limiter.acquire()
+        riak_object = bucket.get(finding.key, head_only=not self.verify_content)
+        if not riak_object.exists:
+            return False
+        if BlobStore.isReference(riak_object):
+            if not self.verify_content:
+                self.limiter.acquire()
+                riak_object = bucket.get(finding.key)
+            reference = BlobStore.loadReference(riak_object)
+            finding.content_size = reference['size']
+            if not self.verify_content:
+                return True
+            # a missing blob leaves nothing to read the file from
+            self.limiter.acquire()
+            bucket = riakClient.bucket(reference['bucket'])
+            riak_object = bucket.get(reference['blob'])
+            if not riak_object.exists:
+                return False
+        if ChunkStore.isManifest(riak_object):
+            if not self.verify_content:
+                self.limiter.acquire()
+                riak_object = bucket.get(finding.key)
+            manifest = ChunkStore.loadManifest(riak_object)
+            finding.content_size = manifest['size']
+            finding.chunk_size = manifest['chunk_size']
+            finding.chunks = len(manifest['chunks'])
+            if self.verify_content:
+                digest = hashlib.sha1()
+                for chunk_key in manifest['chunks']:
+                    self.limiter.acquire()
+                    digest.update(Compression.decode(bucket.get(chunk_key)))
+                finding.content_sha1 = digest.hexdigest()
+        elif self.verify_content:
+            data = Compression.decode(riak_object)
+            finding.content_size = len(data)
+            finding.content_sha1 = hashlib.sha1(data).hexdigest()
+        return True
+
+    def _inspect(self, batch, key):
+        finding = _Finding(key)
+        finding.local_path = batch.local.get(key)
+        if finding.local_path is not None:
+            try:
+                finding.local_stat = os.stat(finding.local_path)
+            except OSError:
+                # removed in the meantime
+                finding.local_path = None
+
+        with self.riak_pool.client() as riakClient:
+            self.limiter.acquire()
+            finding.record = self.riak_directory.fetch_record(riakClient, batch.directory, key)
+            has_content = self._inspect_content(riakClient, riakClient.bucket(batch.bucket), finding)
+
+        record = finding.record
+        # the size RIAK has for the file: the content's if it was read, the stored one otherwise
+        riak_size = finding.content_size if finding.content_size is not None else (record['size'] if record is not None else None)
+        if not has_content:
+            if finding.local_path is not None:
+                finding.problem = 'not_uploaded'
+            elif key in batch.listed or record is not None:
+                finding.problem = 'dangling'
+        elif finding.local_path is not None and (finding.local_stat.st_size != riak_size or
+                (finding.content_sha1 is not None and self._local_sha1(finding.local_path) != finding.content_sha1)):
+            finding.problem = 'local_differs'
+        elif key not in batch.listed:
+            finding.problem = 'unlisted'
+        elif record is None:
+            finding.problem = 'missing_size'
+        elif len(record.get('sizes', ())) > 1:
+            finding.problem = 'stale_sizes'
+        elif finding.content_size is not None and record['size'] != finding.content_size:
+            finding.problem = 'size_mismatch'
+        elif finding.content_sha1 is not None and record.get('sha1') and record['sha1'] != finding.content_sha1:
+            finding.problem = 'hash_mismatch'
+        return finding
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch, key = item
+            finding = None
+            try:
+                finding = self._inspect(batch, key)
+            except Exception as e:
+                logger.error('ERROR inspecting %s/%s (Exception: %s)'% (batch.bucket,key,str(e)))
+                with self._lock:
+                    self.failed += 1
+            batch.add(finding)
+
+    def _listed(self, directory):
+        self.limiter.acquire(max(1, self.riak_directory.shards))
+        return self.riak_directory.load_keys(directory)
+
+    # inspects the keys in parallel, returns the findings with a problem
+    def _inspect_all(self, bucket, directory, keys, listed, local):
+        batch = _Batch(bucket, directory, listed, local, len(keys))
+        for key in keys:
+            self._queue.put((batch, key))
+        batch.wait()
+        with self._lock:
+            self.checked += len(keys)
+        return [finding for finding in batch.findings if finding.problem is not None]
+
+    def _content_keys(self, bucket):
+        keys = set()
+        with self.riak_pool.client() as riakClient:
+            stream = riakClient.bucket(bucket).stream_keys()
+            try:
+                for key_list in stream:
+                    self.limiter.acquire()
+                    # chunks of chunked files are no files of their own
+                    keys.update(key for key in key_list if '/' not in key)
+            finally:
+                stream.close()
+        return keys
+
+    # ==================
+    # Repairing
+    # ==================
+
+    def _repaired_record(self, riakClient, bucket, finding):
+        if finding.content_size is None:
+            # a head request doesn't tell the size of a plain object
+            self.limiter.acquire()
+            finding.content_size = len(Compression.decode(riakClient.bucket(bucket).get(finding.key)))
+        size = finding.content_size
+        mtime = finding.local_stat.st_mtime if finding.local_stat is not None else None
+        return FileMetadata.makeRecord(size, mtime, finding.content_sha1, finding.chunk_size, finding.chunks)
+
+    # repairs one finding, returns the change to the listing (key, listed) it needs or None
+    def _repair(self, bucket, directory, finding):
+        problem = finding.problem
+        if problem in ('not_uploaded', 'local_differs'):
+            self.limiter.acquire(3)
+            if self.blob_store is not None:
+                # borrows its own connections
+                record = self.blob_store.storeFile(bucket, finding.key, finding.local_path)
+            else:
+                with self.riak_pool.client() as riakClient:
+                    record = Uploader.storeFile(riakClient.bucket(bucket), finding.key, finding.local_path, self.content_type, self.chunk_size, compressor=self.compressor)
+            with self.riak_pool.client() as riakClient:
+                self.riak_directory.remove_size(riakClient, directory, finding.key)
+                self.riak_directory.store_size(riakClient, directory, finding.key, record)
+            return (finding.key, True)
+        with self.riak_pool.client() as riakClient:
+            if problem == 'dangling':
+                self.limiter.acquire()
+                self.riak_directory.remove_size(riakClient, directory, finding.key)
+                return (finding.key, False)
+            if problem == 'unlisted':
+                if finding.record is None:
+                    record = self._repaired_record(riakClient, bucket, finding)
+                    self.limiter.acquire()
+                    self.riak_directory.store_size(riakClient, directory, finding.key, record)
+                return (finding.key, True)
+            if problem in ('missing_size', 'size_mismatch', 'stale_sizes'):
+                record = self._repaired_record(riakClient, bucket, finding)
+                self.limiter.acquire(2)
+                self.riak_directory.remove_size(riakClient, directory, finding.key)
+                self.riak_directory.store_size(riakClient, directory, finding.key, record)
+        return None
+
+    # ==================
+    # Scrubbing
+    # ==================
+
+    # scrubs one directory, local maps the keys of the folder to their local copies, returns the findings
+    def scrub(self, bucket, directory, local):
+        listed = self._listed(directory)
+        keys = set(local) | listed
+        if self.stream_keys:
+            keys.update(self._content_keys(bucket))
+        findings = self._inspect_all(bucket, directory, keys, listed, local)
+        if findings and self.grace > 0:
+            # whatever a mount was just doing is done now - only differences still there count
+            sleep(self.grace)
+            first = dict((finding.key, finding.problem) for finding in findings)
+            findings = [finding for finding in self._inspect_all(bucket, directory, list(first), self._listed(directory), local)
+                        if first.get(finding.key) == finding.problem]
+
+        adds = []
+        discards = []
+        for finding in findings:
+            with self._lock:
+                self.found[finding.problem] += 1
+            logger.warning('%s: %s/%s'% (finding.problem,directory,finding.key))
+            if not self.repair or finding.problem == 'hash_mismatch':
+                continue
+            try:
+                change = self._repair(bucket, directory, finding)
+            except Exception as e:
+                logger.error('ERROR repairing %s of %s/%s (Exception: %s)'% (finding.problem,bucket,finding.key,str(e)))
+                with self._lock:
+                    self.failed += 1
+                continue
+            if change is not None:
+                (adds if change[1] else discards).append(change[0])
+            with self._lock:
+                self.repaired += 1
+        if adds or discards:
+            # one set operation per shard for all repairs of the directory
+            self.limiter.acquire(2)
+            self.riak_directory.flush(directory, adds, discards)
+        with self._lock:
+            self.directories += 1
+        logger.info('scrubbed %s (%s keys, %s differences)'% (directory,len(keys),len(findings)))
+        return findings
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name='scrub-worker')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        with self._lock:
+            stats = dict(directories=self.directories, checked=self.checked, repaired=self.repaired, failed=self.failed,
+                         waited=round(self.limiter.waited, 1))
+            stats.update(self.found)
+            return stats
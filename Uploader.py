@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## Uploads local files into a RIAK content bucket with a bounded amount of memory.
+##
+## RIAK PBC has no streaming put - a plain object has to be handed over as one value. A file is therefore
+## read exactly once into that value (no further copies, the file is stat'ed once and closed again) and
+## stored without asking RIAK to send the body back. Files larger than the chunk size are read and stored
+## one chunk at a time (see ChunkStore), so they never need more than one chunk of memory.
+##
+## An UploadBudget caps the bytes all running uploads hold at the same time: closing many large files at
+## once makes the later uploads wait instead of growing the process. With a Compressor the compressed copy
+## is held next to the data, so compressed uploads reserve twice as much.
+##
+## Usage:
+##      budget = UploadBudget(256*1024*1024)
+##      record = storeFile(bucket, 'file.jpg', '/test/images/file.jpg', 'application/octet-stream', chunk_size, budget, compressor)
+
+import os
+import logging
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import ChunkStore
+import Compression
+import FileMetadata
+
+logger = logging.getLogger('root')
+
+
+class UploadBudget(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Condition()
+
+    # holds nbytes of the budget for the duration of the with block, an upload larger than the whole
+    # budget waits until it runs alone
+    @contextmanager
+    def reserve(self, nbytes):
+        nbytes = min(nbytes, self.max_bytes)
+        with self._lock:
+            while self.in_flight > 0 and self.in_flight + nbytes > self.max_bytes:
+                self._lock.wait()
+            self.in_flight += nbytes
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= nbytes
+                self._lock.notify_all()
+
+    def stats(self):
+        return dict(in_flight=self.in_flight, peak=self.peak, max_bytes=self.max_bytes)
+
+
+@contextmanager
+def _reserved(budget, nbytes):
+    if budget is None:
+        yield
+    else:
+        with budget.reserve(nbytes):
+            yield
+
+
+## Stores filename under key (as plain object or, when larger than chunk_size > 0, as chunks + manifest)
+## and returns the metadata record of what was stored. A chunked previous version of the key is cleaned up.
+## Values are compressed by the given Compression.Compressor where that is worthwhile, name (defaults to
+## key) is what the compressor takes the file extension from. Everything is stored with the given quorum
+## (the w/dw/pw RIAK acknowledges the values with, see Compression.storeObject), obsolete chunks are deleted
+## by the given ChunkStore.ChunkDeleter (right away without one).
+def storeFile(bucket, key, filename, content_type, chunk_size=0, budget=None, compressor=None, name=None, quorum=None, deleter=None):
+    digest = hashlib.sha1()
+    copies = 2 if compressor is not None else 1
+    with open(filename, 'rb') as f:
+        # the one and only stat - also the size and mtime reported to the directory structure
+        st = os.fstat(f.fileno())
+        if (chunk_size > 0) and (st.st_size > chunk_size):
+            # one chunk in memory at a time
+            with _reserved(budget, copies * chunk_size):
+                manifest = ChunkStore.storeChunked(bucket, key, f, chunk_size, content_type, digest, compressor, name, quorum, deleter)
+            return FileMetadata.makeRecord(manifest['size'], st.st_mtime, digest.hexdigest(), chunk_size, len(manifest['chunks']))
+
+        # a chunked previous version leaves its chunks behind otherwise
+        old_manifest = ChunkStore.fetchManifest(bucket, key) if (chunk_size > 0) else None
+        with _reserved(budget, copies * st.st_size):
+            data = f.read()
+            digest.update(data)
+            Compression.storeObject(bucket, key, data, content_type, compressor, name, quorum)
+            size = len(data)
+            del data
+    if old_manifest is not None:
+        ChunkStore.deleteChunks(bucket, old_manifest, deleter)
+    return FileMetadata.makeRecord(size, st.st_mtime, digest.hexdigest())
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+## Uploads closed files to RIAK in the background (write-back).
+##
+## Every upload is first appended to an on-disk journal (and synced), then handed to a pool of worker
+## threads. An upload that fails is retried with an exponential backoff until it succeeds, uploads that
+## did not finish before a crash or unmount are replayed from the journal by the next start().
+##
+## All uploads of the same name (RIAK bucket/key) are handled by the same worker, so they are done in the
+## order they were queued. Callers that are about to change a name otherwise (unlink/rename) use wait() or
+## cancel() first, so they are never overtaken by an older upload of it - with a timeout, as an upload is
+## retried for as long as RIAK does not take it.
+##
+## Usage:
+##      write_back = WriteBackQueue('/var/lib/riak-fuse/journal', upload_function, workers=4)
+##      write_back.start(name_for_path)
+##      write_back.enqueue(('IMG_test', 'file.jpg'), '/test/images/file.jpg')
+##      write_back.wait(('IMG_test', 'file.jpg'), timeout=10)
+##      write_back.close()
+
+import os
+import json
+import logging
+import threading
+from time import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger('root')
+
+
+class WriteBackQueue(object):
+    # upload(path) has to raise an exception if the upload did not succeed
+    def __init__(self, journal_path, upload, workers=4, queue_size=1000, backoff=1.0, max_backoff=60.0, drain_timeout=60):
+        self.journal_path = journal_path
+        self.upload = upload
+        self.workers = workers
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.drain_timeout = drain_timeout
+
+        self._lock = threading.Condition()
+        self._seq = 0
+        # name -> number of journaled uploads that are not done yet
+        self._pending = {}
+        # name -> sequence number of its upload that waits in a queue and was not started yet
+        self._queued = {}
+        self._cancelled = set()
+        # one bounded queue per worker - a full queue makes enqueue() wait
+        self._queues = [queue.Queue(max(1, queue_size // workers)) for i in range(workers)]
+        self._threads = []
+        # set by close(): workers stop once their queue is drained
+        self._closing = threading.Event()
+        # set once the drain timeout is over: workers stop right away, what is left stays in the journal
+        self._stopping = threading.Event()
+        self._journal = None
+
+    # ==================
+    # Journal
+    # ==================
+    def _journal_append(self, record):
+        os.write(self._journal, (json.dumps(record) + '\n').encode('utf-8'))
+        os.fsync(self._journal)
+
+    # returns the paths of all uploads that were journaled but not done, in their original order
+    def _journal_read(self):
+        puts = {}
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # torn last line of a crash - the upload was never acknowledged to anybody
+                        continue
+                    if 'put' in record:
+                        puts[record['put']] = record['path']
+                    elif 'done' in record:
+                        puts.pop(record['done'], None)
+        replay = []
+        for seq in sorted(puts):
+            if puts[seq] not in replay:
+                replay.append(puts[seq])
+        return replay
+
+    # rewrites the journal with just the given uploads (crash-safe: written aside and moved into place)
+    def _journal_compact(self, paths):
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for seq, path in enumerate(paths):
+                f.write((json.dumps({'put': seq + 1, 'path': path}) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.journal_path)
+        self._journal = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND)
+
+    # ==================
+    # Queue
+    # ==================
+    def _queue_for(self, name):
+        return self._queues[hash(name) % self.workers]
+
+    def enqueue(self, name, path, journaled=False):
+        with self._lock:
+            if name in self._queued:
+                # the same file is waiting already - it is read when the upload starts, so that one covers it
+                return
+            self._seq += 1
+            seq = self._seq
+            if not journaled:
+                self._journal_append({'put': seq, 'path': path})
+            self._queued[name] = seq
+            self._pending[name] = self._pending.get(name, 0) + 1
+        self._queue_for(name).put((seq, name, path))
+
+    def _done(self, seq, name):
+        # to be called with the lock held
+        self._journal_append({'done': seq})
+        self._pending[name] -= 1
+        if self._pending[name] == 0:
+            del self._pending[name]
+        if not self._pending:
+            # nothing outstanding - start over with an empty journal
+            os.ftruncate(self._journal, 0)
+        self._lock.notify_all()
+
+    def pending(self, name):
+        with self._lock:
+            return name in self._pending
+
+    # blocks until all uploads of the given name are done, returns False if they are not done after timeout seconds
+    def wait(self, name, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+        with self._lock:
+            while name in self._pending:
+                if deadline is None:
+                    self._lock.wait()
+                    continue
+                remaining = deadline - time()
+                if remaining <= 0:
+                    # an upload that keeps failing is retried for as long as it takes
+                    return False
+                self._lock.wait(remaining)
+            return True
+
+    # drops an upload of the given name that did not start yet and waits for a running one (see wait())
+    def cancel(self, name, timeout=None):
+        with self._lock:
+            seq = self._queued.pop(name, None)
+            if seq is not None:
+                self._cancelled.add(seq)
+                self._done(seq, name)
+        return self.wait(name, timeout)
+
+    def _worker(self, work):
+        while not self._stopping.is_set():
+            try:
+                item = work.get(timeout=0.1)
+            except queue.Empty:
+                if self._closing.is_set():
+                    break
+                continue
+            seq, name, path = item
+            with self._lock:
+                if seq in self._cancelled:
+                    self._cancelled.discard(seq)
+                    continue
+                if self._queued.get(name) == seq:
+                    del self._queued[name]
+
+            attempt = 0
+            while True:
+                try:
+                    self.upload(path)
+                except Exception as e:
+                    if self._stopping.is_set():
+                        logger.error('ERROR uploading %s - left in the journal for the next start (Exception: %s)'% (path,str(e)))
+                        break
+                    delay = min(self.backoff * (2 ** attempt), self.max_backoff)
+                    logger.error('ERROR uploading %s - retrying in %s seconds (Exception: %s)'% (path,delay,str(e)))
+                    if self._stopping.wait(delay):
+                        logger.error('ERROR uploading %s - left in the journal for the next start'% (path))
+                        break
+                    attempt += 1
+                else:
+                    with self._lock:
+                        self._done(seq, name)
+                    break
+
+    # replays the journal and starts the workers, name_for_path(path) has to return the name of a journaled path
+    # needs to be called after FUSE went into background (threads do not survive the fork)
+    def start(self, name_for_path):
+        replay = self._journal_read()
+        self._journal_compact(replay)
+        for work in self._queues:
+            thread = threading.Thread(target=self._worker, args=(work,), name='write-back')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        if replay:
+            logger.info('replaying %s uploads from the write-back journal %s'% (len(replay),self.journal_path))
+        # the compacted journal numbered them 1..n already
+        for path in replay:
+            self.enqueue(name_for_path(path), path, journaled=True)
+
+    # waits for the queued uploads and stops the workers - uploads still failing or not started after
+    # drain_timeout seconds are given up and stay in the journal for the next start
+    def close(self):
+        self._closing.set()
+        deadline = time() + self.drain_timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time()))
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        if self._journal is not None:
+            os.close(self._journal)
+            self._journal = None
+
+    def stats(self):
+        with self._lock:
+            return dict(pending=sum(self._pending.values()), queued=sum(work.qsize() for work in self._queues))
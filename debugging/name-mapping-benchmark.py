@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+# Quick benchmark of the path mapping done on every filesystem call
+#
+# Compares the split based mapping riak-fuse used to do (two calls per path, one per name) with the
+# compiled PathMapper, without and with its memo of recently mapped paths.
+#
+# Example:
+#        python name-mapping-benchmark.py
+#        python name-mapping-benchmark.py 1000000 '/{bucket}/images/{key}'
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import NameMapping
+
+
+# the mapping as it was before the PathMapper - kept here as the baseline
+def splitBucketName(Prefix, LegacyPath):
+    path_parts = LegacyPath[1:].split('/') if LegacyPath.startswith("/") else LegacyPath.split('/')
+    if (len(path_parts) > 1):
+        if (path_parts[1] == 'images') and (len(path_parts) >= 2):
+            return str(Prefix)+str(path_parts[0])
+        else:
+            return None
+
+def splitKeyName(LegacyPath):
+    path_parts = LegacyPath[1:].split('/') if LegacyPath.startswith("/") else LegacyPath.split('/')
+    if (len(path_parts) > 1):
+        if (path_parts[1] == 'images') and (len(path_parts) == 3):
+            return str(path_parts[-1:][0])
+        else:
+            return None
+
+
+calls = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+template = sys.argv[2] if len(sys.argv) > 2 else NameMapping.LEGACY_TEMPLATE
+# a working set of files like a busy folder sees it
+paths = ['/fdaf16c657d997656bbccc5752eefa9f/images/%s_192497.jpg'% (i) for i in range(1000)]
+
+uncached = NameMapping.PathMapper(template, 'IMG_', 'IMGDIR_', cache_size=0)
+memoized = NameMapping.PathMapper(template, 'IMG_', 'IMGDIR_', cache_size=10000)
+
+def split_mapping():
+    for path in paths:
+        splitBucketName('IMG_', path)
+        splitBucketName('IMGDIR_', path)
+        splitKeyName(path)
+
+def compiled_mapping():
+    for path in paths:
+        uncached.map(path)
+
+def memoized_mapping():
+    for path in paths:
+        memoized.map(path)
+
+print('template: %s, %s mappings each'% (template,calls))
+for name, function in (('split (bucket + directory bucket + key)', split_mapping), ('compiled', compiled_mapping), ('compiled + memoized', memoized_mapping)):
+    seconds = timeit.timeit(function, number=max(1, calls // len(paths)))
+    print('%-42s %8.3f s  %6.2f us per path'% (name,seconds,seconds * 1000000.0 / calls))
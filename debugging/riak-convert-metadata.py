@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# this tool converts the per-file size sets of a directory bucket into metadata records (--riak_metadata record)
+#
+# For every file listed in the directory set(s) a record with its size and chunk information is written to the
+# default bucket type under the directory bucket name. Files already having a record are skipped, so the
+# tool can be run again after an interruption. The modification time of existing files is not known - their
+# records carry none and riak-fuse reports the current time for them, as it did before.
+#
+# Example:
+#        python riak-convert-metadata.py IMGDIR_test IMG_test
+#        python riak-convert-metadata.py IMGDIR_test IMG_test --hash --remove_size_sets
+#        python riak-convert-metadata.py IMGDIR_test IMG_test -rds 16
+
+import os
+import sys
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import riak
+import riak.datatypes as datatypes
+import ChunkStore
+import Compression
+import BlobStore
+import FileMetadata
+from RiakConnectionPool import RiakConnectionPool
+from RiakDirectory import RiakDirectory
+
+parser = argparse.ArgumentParser(description='converts the size sets of a RIAK directory bucket into metadata records')
+parser.add_argument('directory_bucket', help='the directory bucket, e.g. IMGDIR_test')
+parser.add_argument('content_bucket', help='the binary content bucket of the same folder, e.g. IMG_test')
+parser.add_argument('--hash', help='download every file to store its sha1 in the record', dest='hash', action='store_true', default=False)
+parser.add_argument('--remove_size_sets', help='empty the size set of a file once its record is stored', dest='remove_size_sets', action='store_true', default=False)
+parser.add_argument('-rp','--riakport', help='the port RIAK PBC is listening on', type=int, default=8087)
+parser.add_argument('-rh','--riakhost', help='the host or IP adress RIAK PBC is listening on', type=str, default='localhost')
+parser.add_argument('-rbt','--riak_directory_set_buckettype', help='the RIAK bucket type name used for directory content buckets', type=str, default='sets')
+parser.add_argument('-rdk','--riak_directory_set_directorykey', help='the reserved key name of the directory listing set', type=str, default='directory')
+parser.add_argument('-rds','--riak_directory_shards', help='the number of sets the directory listing is spread over (as used by the mount)', type=int, default=0)
+args = parser.parse_args()
+
+client = riak.RiakClient(host=args.riakhost, pb_port=args.riakport, protocol='pbc')
+set_bucket = client.bucket_type(args.riak_directory_set_buckettype).bucket(args.directory_bucket)
+metadata_bucket = client.bucket(args.directory_bucket)
+content_bucket = client.bucket(args.content_bucket)
+
+# the listing may be spread over shard sets - read the way the mount reads it
+riak_pool = RiakConnectionPool(args.riakhost, args.riakport, pool_size=1)
+riak_directory = RiakDirectory(riak_pool, bucket_type=args.riak_directory_set_buckettype, directory_key=args.riak_directory_set_directorykey,
+                               shards=args.riak_directory_shards)
+directory = riak_directory.load_keys(args.directory_bucket)
+
+converted = skipped = missing = 0
+for key in sorted(directory):
+    if FileMetadata.fetch(metadata_bucket, key) is not None:
+        skipped += 1
+        continue
+
+    sizes = datatypes.Set(set_bucket, key)
+    sizes.reload()
+    manifest = ChunkStore.fetchManifest(content_bucket, key)
+    reference = BlobStore.fetchReference(content_bucket, key) if manifest is None else None
+    sha1 = None
+    if manifest is not None:
+        size = manifest['size']
+        if args.hash:
+            digest = hashlib.sha1()
+            for chunk_key in manifest['chunks']:
+                digest.update(Compression.decode(content_bucket.get(chunk_key)))
+            sha1 = digest.hexdigest()
+        record = FileMetadata.makeRecord(size, None, sha1, manifest['chunk_size'], len(manifest['chunks']))
+    elif reference is not None:
+        # a deduplicated file - its blob is named after the sha1 of the contents
+        record = FileMetadata.makeRecord(reference['size'], None, reference['blob'])
+    else:
+        if args.hash or len(sizes) == 0:
+            content = content_bucket.get(key)
+            if not content.exists:
+                print('%s: listed in the directory but not stored - skipped'% (key))
+                missing += 1
+                continue
+            data = Compression.decode(content)
+            size = len(data)
+            sha1 = hashlib.sha1(data).hexdigest()
+        else:
+            size = int(next(iter(sizes)))
+        record = FileMetadata.makeRecord(size, None, sha1)
+
+    FileMetadata.store(metadata_bucket, key, record)
+    if args.remove_size_sets and len(sizes) > 0:
+        for value in list(sizes):
+            sizes.discard(value)
+        sizes.store()
+    converted += 1
+
+print('%s: %s records written, %s already converted, %s missing'% (args.directory_bucket,converted,skipped,missing))
@@ -2,24 +2,29 @@
 
 # this tool dumps the directory listing of a specified merchant directory bucket to STDOUT
 #
-# This takes two parameters:
+# This takes up to two parameters:
 #   parameter 1: the bucket name
+#   parameter 2: the number of shard sets the listing is spread over (optional, see --riak_directory_shards)
 
 import riak
 import sys
 import riak.datatypes as datatypes
 
 if (len(sys.argv) == 1):
-    print('Give 1 parameters: <bucket name>')
+    print('Give 1 or 2 parameters: <bucket name> [<number of shards>]')
     print('Example:')
     print('        python riak-dump-directory.py IMGDIR_test')
+    print('        python riak-dump-directory.py IMGDIR_test 16')
     print('')
     print('This will dump the IMGDIR_test directories contents to STDOUT')
 else:
     btype = riak.RiakClient(pb_port=8087, protocol='pbc').bucket_type('sets')
     bucket = btype.bucket(sys.argv[1])
-    myset = datatypes.Set(bucket, 'directory')
-    myset.reload()
+    shards = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    set_keys = ['directory'] if shards <= 0 else ['directory/%s'% (shard) for shard in range(shards)]
+    for set_key in set_keys:
+        myset = datatypes.Set(bucket, set_key)
+        myset.reload()
 
-    for id in myset:
-        print('%s'% (id))
+        for id in myset:
+            print('%s'% (id))
@@ -5,10 +5,18 @@
 # This takes two parameters:
 #   parameter 1: the bucket name
 #   parameter 2: the key name
+#
+# Compressed objects (riak-fuse --compression) are written uncompressed, of deduplicated files (--dedup) the
+# blob they refer to is written.
 
-import riak
+import os
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import riak
+import Compression
+import BlobStore
+
 if (len(sys.argv) == 2):
     print('Give 2 parameters: <bucket name> <key name>')
     print('Example:')
@@ -19,7 +27,9 @@ else:
     myClient = riak.RiakClient(pb_port=8087, protocol='pbc')
     photo_bucket = myClient.bucket(sys.argv[1])
     image_data_out = photo_bucket.get(sys.argv[2])
+    if BlobStore.isReference(image_data_out):
+        image_data_out = BlobStore.fetchBlob(myClient, BlobStore.loadReference(image_data_out))
     # You've now got a ``RiakObject``. To get at the binary data, call:
     with open(sys.argv[2], 'wb') as f:
-        binary_data = image_data_out.encoded_data
+        binary_data = Compression.decode(image_data_out)
         f.write(binary_data)
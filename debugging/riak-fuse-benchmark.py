@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+# this tool benchmarks the filesystem calls of riak-fuse against an in-memory fake RIAK (see FakeRiak.py)
+#
+# The filesystem is built exactly like riak-fuse.py builds it from its command line (pass any riak-fuse
+# option with --options), only the RIAK backend is a FakeRiakPool with the given latency. No mount and no
+# cluster are needed: the filesystem is called like FUSE calls it, from --threads threads at once.
+#
+# For every combination of --file_sizes and --directory_sizes a folder with that many files of that size
+# is created, then getattr, readdir, open+read, scan (open+read in listing order), write+release, rename
+# and unlink are measured. Reported are p50/p99 latency, operations per second, the RIAK requests and the
+# KB sent to / received from RIAK per operation. --content text writes compressible files instead of random
+# bytes (compare the bytes on the wire with and without --options "... -cmp zlib").
+#
+# --nodes spreads the requests over several fake RIAK nodes (see RiakCluster.py) that add the given latency
+# each, --down takes some of them down for the measurement - the requests every node answered and its
+# ejections are printed after the results (compare --options "... -rb latency" with the default).
+#
+# write+release closes the file like FUSE does (flush, then release), so it shows what the durability mode
+# costs: compare --options "... -dur always", "... -dur group" and "... -dur riak" (put --tmpdir on the disk
+# the mount would use - a sync is free on a tmpfs).
+#
+# --save stores the results as a baseline, --baseline compares against one and exits with 1 if an
+# operation got slower than --threshold percent.
+#
+# Example:
+#        python riak-fuse-benchmark.py --latency 1 --save baseline.json
+#        python riak-fuse-benchmark.py --latency 1 --baseline baseline.json
+#        python riak-fuse-benchmark.py --file_sizes 4,1024 --directory_sizes 10000 --options "-rreaddir -rreadcontent -rds 16"
+#        python riak-fuse-benchmark.py --content text --options "-rreaddir -rreadcontent -cmp zlib"
+#        python riak-fuse-benchmark.py --file_sizes 16 --directory_sizes 100 --options "-rreaddir -rreadcontent -dur group"
+#        python riak-fuse-benchmark.py --latency 20 --file_sizes 64 --directory_sizes 1000 --options "-rreaddir -rreadcontent -ccd /tmp/riak-fuse-cache -ccv size"
+#        python riak-fuse-benchmark.py --nodes 0,0,20 --down 1 --threads 8 --options "-mt -rreaddir -rreadcontent -rb latency -rpi 0.1"
+
+import os
+import sys
+import json
+import shlex
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from FakeRiak import FakeRiakPool, FakeRiakStore, FakeRiakNode
+from RiakCluster import RiakCluster
+
+FOLDER = '/benchmark/images'
+IO_SIZE = 128 * 1024
+OPERATIONS = ('getattr', 'readdir', 'open+read', 'scan', 'write+release', 'rename', 'unlink')
+
+
+# riak-fuse.py can't be imported by its name
+def load_riakfuse():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'riak-fuse.py')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('riakfuse_module', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except ImportError:
+        import imp
+        module = imp.load_source('riakfuse_module', path)
+    return module
+
+
+# file contents of the given size: random bytes (like photos) or text that compresses well
+def make_data(content, size):
+    if content == 'random':
+        return os.urandom(size)
+    chooser = random.Random(size)
+    words = [''.join(chooser.choice('abcdefghijklmnopqrstuvwxyz') for i in range(chooser.randint(2, 10))) for w in range(2000)]
+    text = []
+    length = 0
+    while length < size:
+        word = chooser.choice(words)
+        text.append(word)
+        length += len(word) + 1
+    return ' '.join(text).encode('ascii')[:size]
+
+
+def percentile(samples, fraction):
+    return samples[int(round(fraction * (len(samples) - 1)))]
+
+
+def write_file(fs, path, data):
+    fh = fs('create', path, 0o644)
+    for offset in range(0, len(data), IO_SIZE):
+        fs('write', path, data[offset:offset + IO_SIZE], offset, fh)
+    fs('flush', path, fh)
+    fs('release', path, fh)
+
+
+def read_file(fs, path):
+    fh = fs('open', path, os.O_RDONLY)
+    offset = 0
+    while True:
+        data = fs('read', path, IO_SIZE, offset, fh)
+        if not data:
+            break
+        offset += len(data)
+    fs('flush', path, fh)
+    fs('release', path, fh)
+
+
+# calls operation(i) for every i in range(count) from the given number of threads, returns (latencies, seconds)
+def measure(operation, count, threads):
+    latencies = []
+    lock = threading.Lock()
+    indices = iter(range(count))
+
+    def caller():
+        while True:
+            with lock:
+                i = next(indices, None)
+            if i is None:
+                return
+            started = time()
+            operation(i)
+            elapsed = time() - started
+            with lock:
+                latencies.append(elapsed)
+
+    started = time()
+    workers = [threading.Thread(target=caller) for t in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sorted(latencies), time() - started
+
+
+def run(module, args, file_size, directory_size):
+    source = tempfile.mkdtemp(prefix='riak-fuse-benchmark-', dir=args.tmpdir)
+    try:
+        options = ['-s', source, '-t', source] + shlex.split(args.options)
+        module.configure(vars(module.argument_parser().parse_args(options)))
+        if args.nodes:
+            # fake nodes on consecutive ports, answering from one store
+            store = FakeRiakStore()
+            nodes = dict((8087 + i, FakeRiakNode(store)) for i in range(len(args.nodes.split(','))))
+            riak_pool = RiakCluster([('localhost', port) for port in sorted(nodes)], lambda host, port: FakeRiakPool(pool_size=module.riak_pool_size, store=nodes[port]),
+                                    balance=module.riak_balance, eject_after=module.riak_eject_after, eject_interval=module.riak_eject_interval,
+                                    probe_interval=module.riak_probe_interval)
+        else:
+            riak_pool = FakeRiakPool(pool_size=module.riak_pool_size)
+            store = riak_pool.store
+        fs = module.build_filesystem(source, riak_pool)
+        fs.init('/')
+        os.makedirs(os.path.join(source, FOLDER.lstrip('/')))
+
+        # the folder is filled without latency
+        data = make_data(args.content, file_size)
+        extension = 'jpg' if args.content == 'random' else 'txt'
+        files = ['%s/file%06d.%s'% (FOLDER, i, extension) for i in range(directory_size)]
+        for path in files:
+            write_file(fs, path, data)
+        if fs.directory_updates is not None:
+            fs.directory_updates.flush_all(everything=True)
+
+        store.latency = args.latency / 1000.0
+        store.jitter = args.jitter / 1000.0
+        store.bandwidth = args.bandwidth * 1024 * 1024
+        if args.nodes:
+            for port, latency in zip(sorted(nodes), args.nodes.split(',')):
+                nodes[port].latency = float(latency) / 1000.0
+                nodes[port].down = str(port - 8087) in args.down.split(',')
+        chooser = random.Random(42)
+        picks = [chooser.choice(files) for i in range(args.operations)]
+        # files read one after the other in listing order, like a thumbnailer walking the folder
+        scan = ['%s/%s'% (FOLDER, name) for name in fs('readdir', FOLDER, None) if name not in ('.', '..')]
+        operations = {
+            'getattr': (lambda i: fs('getattr', picks[i]), args.operations),
+            'readdir': (lambda i: list(fs('readdir', FOLDER, None)), max(1, args.operations // 10)),
+            'open+read': (lambda i: read_file(fs, picks[i]), args.operations),
+            'scan': (lambda i: read_file(fs, scan[i]), min(args.operations, len(scan))),
+            'write+release': (lambda i: write_file(fs, '%s/new%06d.%s'% (FOLDER, i, extension), data), args.operations),
+            'rename': (lambda i: fs('rename', '%s/new%06d.%s'% (FOLDER, i, extension), '%s/renamed%06d.%s'% (FOLDER, i, extension)), args.operations),
+            'unlink': (lambda i: fs('unlink', '%s/renamed%06d.%s'% (FOLDER, i, extension)), args.operations),
+        }
+
+        results = {}
+        for name in OPERATIONS:
+            operation, count = operations[name]
+            store.reset_stats()
+            latencies, seconds = measure(operation, count, args.threads)
+            counters = store.stats().values()
+            requests = sum(counter['requests'] for counter in counters)
+            sent = sum(counter['sent'] for counter in counters)
+            received = sum(counter['received'] for counter in counters)
+            results['%s size=%sKB files=%s'% (name, file_size // 1024, directory_size)] = dict(
+                p50=percentile(latencies, 0.5) * 1000, p99=percentile(latencies, 0.99) * 1000,
+                ops_per_second=count / seconds, riak_requests=float(requests) / count,
+                sent_kb=sent / 1024.0 / count, received_kb=received / 1024.0 / count)
+        if args.nodes:
+            for name, node in sorted(riak_pool.stats()['nodes'].items()):
+                print('%s files=%s size=%sKB: %s requests, %s errors, %s ejections, %.3f ms latency'% (name, directory_size, file_size // 1024, node['requests'],
+                                                                                                   node['errors'], node['ejections'], node['latency_ms']))
+        fs.destroy('/')
+        return results
+    finally:
+        shutil.rmtree(source, ignore_errors=True)
+
+
+# returns the change of value against base in percent, positive is better
+def improvement(base, value, lower_is_better):
+    if base == 0:
+        return 0.0
+    change = (value - base) * 100.0 / base
+    return -change if lower_is_better else change
+
+
+parser = argparse.ArgumentParser(description='benchmarks the riak-fuse filesystem calls against an in-memory fake RIAK')
+parser.add_argument('--latency', help='milliseconds every RIAK request takes', type=float, default=1.0)
+parser.add_argument('--jitter', help='up to this many milliseconds are added to every RIAK request at random', type=float, default=0.0)
+parser.add_argument('--bandwidth', help='MB per second RIAK sends and receives values with (0 means unlimited)', type=float, default=0)
+parser.add_argument('--nodes', help='comma separated milliseconds each fake RIAK node adds to every request - spreads the requests over these nodes (empty uses a single node)', type=str, default='')
+parser.add_argument('--down', help='comma separated indexes of the --nodes that are down while measuring', type=str, default='')
+parser.add_argument('--file_sizes', help='comma separated file sizes in KB', type=str, default='4,64,1024')
+parser.add_argument('--directory_sizes', help='comma separated numbers of files in the folder', type=str, default='100,1000')
+parser.add_argument('--content', help='what the files contain: random (incompressible, like photos) or text (compressible)', type=str, choices=['random','text'], default='random')
+parser.add_argument('--operations', help='how often every operation is measured (readdir a tenth of it)', type=int, default=200)
+parser.add_argument('--threads', help='the number of threads calling the filesystem at once (use with --options -mt)', type=int, default=1)
+parser.add_argument('--options', help='riak-fuse options the filesystem is built with', type=str, default='-rreaddir -rreadcontent')
+parser.add_argument('--tmpdir', help='the directory the local copies are written in (the system default if not given)', type=str, default=None)
+parser.add_argument('--save', help='store the results as a baseline in this file', type=str, default=None)
+parser.add_argument('--baseline', help='compare the results with the baseline in this file', type=str, default=None)
+parser.add_argument('--threshold', help='percent an operation may get slower than the baseline', type=float, default=10.0)
+args = parser.parse_args()
+
+module = load_riakfuse()
+# the filesystem logs every call otherwise
+logging.getLogger('root').setLevel(logging.WARNING)
+
+results = {}
+for directory_size in [int(size) for size in args.directory_sizes.split(',')]:
+    for file_size in [int(size) * 1024 for size in args.file_sizes.split(',')]:
+        results.update(run(module, args, file_size, directory_size))
+
+settings = dict((name, getattr(args, name)) for name in ('latency', 'jitter', 'bandwidth', 'content', 'operations', 'threads', 'options'))
+if args.nodes:
+    settings.update(nodes=args.nodes, down=args.down)
+baseline = {}
+if args.baseline:
+    with open(args.baseline) as f:
+        stored = json.load(f)
+    baseline = stored['results']
+    if stored['settings'] != settings:
+        print('the baseline was measured with different settings: %s'% (stored['settings']))
+
+regressions = 0
+print('%-42s %10s %10s %12s %10s %10s %10s %s'% ('operation', 'p50 ms', 'p99 ms', 'ops/s', 'requests', 'KB sent', 'KB recv', 'vs. baseline' if baseline else ''))
+for name in sorted(results, key=lambda name: (int(name.split('files=')[1]), int(name.split('size=')[1].split('KB')[0]), OPERATIONS.index(name.split(' ')[0]))):
+    result = results[name]
+    compared = ''
+    if name in baseline:
+        p50 = improvement(baseline[name]['p50'], result['p50'], True)
+        throughput = improvement(baseline[name]['ops_per_second'], result['ops_per_second'], False)
+        compared = 'p50 %+.1f%%, ops/s %+.1f%%'% (p50, throughput)
+        # baselines saved before the bytes were counted don't have them
+        if 'sent_kb' in baseline[name]:
+            wire = improvement(baseline[name]['sent_kb'] + baseline[name]['received_kb'], result['sent_kb'] + result['received_kb'], True)
+            compared += ', bytes %+.1f%%'% (wire)
+        if min(p50, throughput) < -args.threshold:
+            compared += '  REGRESSION'
+            regressions += 1
+    print('%-42s %10.3f %10.3f %12.1f %10.1f %10.1f %10.1f %s'% (name, result['p50'], result['p99'], result['ops_per_second'], result['riak_requests'],
+                                                              result['sent_kb'], result['received_kb'], compared))
+
+if args.save:
+    with open(args.save, 'w') as f:
+        json.dump(dict(settings=settings, results=results), f, indent=2, sort_keys=True)
+    print('results saved as baseline in %s'% (args.save))
+
+if regressions:
+    print('%s operations are more than %s%% slower than the baseline'% (regressions, args.threshold))
+    sys.exit(1)
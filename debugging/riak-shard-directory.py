@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# this tool splits the single directory set of a directory bucket into shard sets (--riak_directory_shards)
+#
+# Every member of the directory set is added to its shard set, one store per shard. Adding is idempotent,
+# so the tool can simply be run again after an interruption. With --remove_old the single set is emptied
+# once all shards are stored. Mount with the same number of shards afterwards.
+#
+# Example:
+#        python riak-shard-directory.py IMGDIR_test 16
+#        python riak-shard-directory.py IMGDIR_test 16 --remove_old
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import riak
+import riak.datatypes as datatypes
+import DirectoryShards
+
+parser = argparse.ArgumentParser(description='splits the directory set of a RIAK directory bucket into shard sets')
+parser.add_argument('directory_bucket', help='the directory bucket, e.g. IMGDIR_test')
+parser.add_argument('shards', help='the number of shard sets', type=int)
+parser.add_argument('--remove_old', help='empty the single directory set once the shards are stored', dest='remove_old', action='store_true', default=False)
+parser.add_argument('--batch', help='the maximum number of members added to a shard with one store', type=int, default=10000)
+parser.add_argument('-rp','--riakport', help='the port RIAK PBC is listening on', type=int, default=8087)
+parser.add_argument('-rh','--riakhost', help='the host or IP adress RIAK PBC is listening on', type=str, default='localhost')
+parser.add_argument('-rbt','--riak_directory_set_buckettype', help='the RIAK bucket type name used for directory content buckets', type=str, default='sets')
+parser.add_argument('-rdk','--riak_directory_set_directorykey', help='the reserved key name of the directory listing set', type=str, default='directory')
+args = parser.parse_args()
+
+if args.shards <= 0:
+    print('the number of shards has to be larger than 0')
+    sys.exit(1)
+
+client = riak.RiakClient(host=args.riakhost, pb_port=args.riakport, protocol='pbc')
+bucket = client.bucket_type(args.riak_directory_set_buckettype).bucket(args.directory_bucket)
+
+directory = datatypes.Set(bucket, args.riak_directory_set_directorykey)
+directory.reload()
+members = list(directory.value)
+
+groups = DirectoryShards.groupBySet(args.riak_directory_set_directorykey, members, args.shards)
+for set_key in DirectoryShards.setKeys(args.riak_directory_set_directorykey, args.shards):
+    keys = groups.get(set_key, [])
+    for start in range(0, len(keys), args.batch):
+        shard = datatypes.Set(bucket, set_key)
+        for key in keys[start:start + args.batch]:
+            shard.add(key)
+        shard.store()
+    print('%s: %s members'% (set_key,len(keys)))
+
+if args.remove_old and members:
+    # files added through an unsharded mount in the meantime stay in the old set and are reported
+    directory.reload()
+    for key in members:
+        if key in directory.value:
+            directory.discard(key)
+    directory.store()
+    directory.reload()
+    if len(directory) > 0:
+        print('%s members were added to %s during the migration - run again to move them'% (len(directory),args.riak_directory_set_directorykey))
+
+print('%s: %s members spread over %s shards'% (args.directory_bucket,len(members),args.shards))
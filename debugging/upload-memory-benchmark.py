@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# this tool measures the memory riak-fuse needs to upload files that are closed at the same time
+#
+# It writes --files temporary files of --size MB, uploads them all at once from --files threads the
+# same way release() does (Uploader.storeFile) and reports the peak RSS growth of the process, in
+# total and per upload. Run it once per setting - the peak RSS of a process never goes down again.
+#
+# Example:
+#        python upload-memory-benchmark.py --files 16 --size 64 --upload_memory 256
+#        python upload-memory-benchmark.py --files 16 --size 64 --upload_memory 256 --chunk_size 1024
+
+import os
+import sys
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import Uploader
+import ChunkStore
+from RiakConnectionPool import RiakConnectionPool
+
+
+# peak resident set size of this process in bytes (Linux reports KB)
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+parser = argparse.ArgumentParser(description='measures the peak memory of parallel uploads to RIAK')
+parser.add_argument('--files', help='the number of files closed at the same time', type=int, default=16)
+parser.add_argument('--size', help='the size of every file in MB', type=int, default=64)
+parser.add_argument('--upload_memory', help='the upload budget in MB (0 means unlimited)', type=int, default=256)
+parser.add_argument('--chunk_size', help='chunk size in KB (0 disables chunked storage)', type=int, default=0)
+parser.add_argument('--bucket', help='the RIAK bucket the files are uploaded to', type=str, default='IMG_benchmark')
+parser.add_argument('-rp','--riakport', help='the port RIAK PBC is listening on', type=int, default=8087)
+parser.add_argument('-rh','--riakhost', help='the host or IP adress RIAK PBC is listening on', type=str, default='localhost')
+args = parser.parse_args()
+
+workdir = tempfile.mkdtemp(prefix='riak-fuse-upload-')
+try:
+    filenames = []
+    block = os.urandom(1024*1024)
+    for i in range(args.files):
+        filename = os.path.join(workdir, '%s.bin'% (i))
+        with open(filename, 'wb') as f:
+            for mb in range(args.size):
+                f.write(block)
+        filenames.append(filename)
+    del block
+
+    riak_pool = RiakConnectionPool(args.riakhost, args.riakport, pool_size=args.files)
+    budget = Uploader.UploadBudget(args.upload_memory*1024*1024) if args.upload_memory > 0 else None
+
+    def upload(filename):
+        with riak_pool.client() as riakClient:
+            Uploader.storeFile(riakClient.bucket(args.bucket), os.path.basename(filename), filename, 'application/octet-stream', args.chunk_size*1024, budget)
+
+    # connect first, so the connection setup does not count
+    with riak_pool.client() as riakClient:
+        riakClient.ping()
+    baseline = peak_rss()
+
+    threads = [threading.Thread(target=upload, args=(filename,)) for filename in filenames]
+    started = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - started
+
+    growth = max(peak_rss() - baseline, 0)
+    print('files: %s x %s MB, upload budget: %s MB, chunk size: %s KB'% (args.files,args.size,args.upload_memory,args.chunk_size))
+    print('elapsed: %.2f s (%.1f MB/s)'% (elapsed,args.files * args.size / elapsed))
+    print('peak RSS growth: %.1f MB total, %.1f MB per upload'% (growth / 1048576.0,growth / 1048576.0 / args.files))
+
+    with riak_pool.client() as riakClient:
+        bucket = riakClient.bucket(args.bucket)
+        for filename in filenames:
+            manifest = ChunkStore.fetchManifest(bucket, os.path.basename(filename))
+            if manifest is not None:
+                ChunkStore.deleteChunks(bucket, manifest)
+            bucket.delete(os.path.basename(filename))
+    riak_pool.close()
+finally:
+    shutil.rmtree(workdir)
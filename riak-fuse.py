@@ -19,14 +19,34 @@ from __future__ import with_statement
 import os
 import sys
 import errno
+import shutil
 import logging
+import threading
 import riak
 import argparse
 import NameMapping
+import ChunkStore
+import Uploader
+import Compression
+import BlobStore
+import RiakCluster
+from LockTable import LockTable
+from AttributeCache import AttributeCache
+from KeyIndex import KeyIndex
+from AttributePrefetcher import AttributePrefetcher
+from ContentPrefetcher import ContentPrefetcher
+from DirectoryCoalescer import DirectoryCoalescer
+from RiakDirectory import RiakDirectory
+from ContentCache import ContentCache
+from Compression import Compressor
+from WriteBackQueue import WriteBackQueue
+from GroupCommit import GroupCommit
+from MetadataSnapshot import MetadataSnapshot
+from Metrics import Metrics
 from time import time
+from itertools import islice
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 from fuse import FUSE, FuseOSError, Operations
-import riak.datatypes as datatypes
 
 # Log related
 logger = logging.getLogger('root')
@@ -40,8 +60,105 @@ ch.setFormatter(log_formatter)
 logger.addHandler(ch)
 
 class riakfuse(Operations):
-    def __init__(self, root):
+    def __init__(self, root, riak_pool, attr_cache, content_cache, path_mapper, metrics=None):
         self.root = root
+        # path -> RIAK bucket, directory bucket and key, compiled from the path template once
+        self.path_mapper = path_mapper
+        # one shared, pooled set of RIAK connections for all operations of this mount
+        self.riak_pool = riak_pool
+        # fine-grained locks for multi-threaded mode: one per bucket/key
+        # (always take key locks before directory locks and both before a pooled connection)
+        self.key_locks = LockTable()
+        # seek+read/write fallback where positional I/O is not available (python 2)
+        self.rwlock = threading.Lock()
+        # getattr results of RIAK backed files
+        self.attr_cache = attr_cache
+        # downloaded contents of RIAK backed files and the handles opened on them
+        self.content_cache = content_cache
+        # state of every open file handle: path, open flags, whether it was written to and where its contents came from
+        self.handles = {}
+        self.uploads_avoided = 0
+        # caps the file contents all running uploads hold in memory at the same time
+        if (upload_memory > 0):
+            self.upload_budget = Uploader.UploadBudget(upload_memory*1024*1024)
+        else:
+            self.upload_budget = None
+        # compresses uploaded contents where it is worthwhile (reads decode compressed and plain objects alike)
+        if (compression != 'none'):
+            self.compressor = Compressor(compression, level=compression_level)
+        else:
+            self.compressor = None
+        # the w/dw/pw RIAK acknowledges stored contents with (the defaults of the bucket where not given)
+        self.quorum = dict((name, value) for name, value in (('w', riak_w), ('dw', riak_dw), ('pw', riak_pw)) if value is not None)
+        # closed files are synced to disk together, every window seconds (durability mode group)
+        if (durability == 'group'):
+            self.group_commit = GroupCommit(window=group_commit_window, use_syncfs=group_commit_syncfs)
+        else:
+            self.group_commit = None
+        # chunks of replaced or removed files are deleted a grace period later - readers of the old manifest can finish
+        if (chunk_delete_grace > 0):
+            self.chunk_deleter = ChunkStore.ChunkDeleter(riak_pool, grace=chunk_delete_grace)
+        else:
+            self.chunk_deleter = None
+        # a few threads fetching ahead for all readers of chunked files
+        if (chunk_readahead > 0):
+            self.readahead_pool = ChunkStore.ReadaheadPool(workers=chunk_readahead_workers)
+        else:
+            self.readahead_pool = None
+        # identical contents are stored once and referred to by the keys of the files (content-addressed)
+        if (dedup):
+            self.blob_store = BlobStore.BlobStore(riak_pool, dedup_bucket, bucket_type=riak_directory_set_buckettype, content_type=riak_content_type,
+                                                  chunk_size=chunk_size, budget=self.upload_budget, compressor=self.compressor, quorum=self.quorum,
+                                                  deleter=self.chunk_deleter)
+        else:
+            self.blob_store = None
+        # background uploads of closed files (write-back mode)
+        if (write_back_journal is not None):
+            self.write_back = WriteBackQueue(write_back_journal, self._write_back, workers=write_back_workers, queue_size=write_back_queue, backoff=write_back_backoff, drain_timeout=write_back_drain_timeout)
+        else:
+            self.write_back = None
+        # listings and sizes in the RIAK directory buckets (directory locks are held in there)
+        self.riak_directory = RiakDirectory(riak_pool, bucket_type=riak_directory_set_buckettype, directory_key=riak_directory_set_directorykey, shards=riak_directory_shards, metadata=riak_metadata)
+        # in-memory directory membership, answers lookups of missing files without a RIAK round trip
+        # (only trustworthy while this mount maintains the directory sets)
+        if (maintain_riak_directory_structure) and (key_index_refresh > 0):
+            self.key_index = KeyIndex(self._load_directory_keys, refresh_interval=key_index_refresh, max_directories=key_index_directories)
+        else:
+            self.key_index = None
+        # listings and sizes of the last run, answered right after a restart until they are reconciled with RIAK
+        if (metadata_snapshot is not None) and ((use_riak_directory_structure_for_read_access) or (use_riak_file_contents_for_read_access)):
+            self.metadata_snapshot = MetadataSnapshot(metadata_snapshot, self._load_directory_keys, interval=metadata_snapshot_interval, max_directories=metadata_snapshot_directories,
+                                                      rate=metadata_snapshot_rate)
+        else:
+            self.metadata_snapshot = None
+        # sizes of listed files, fetched in the background right after the listing (readdir-plus)
+        if (use_riak_directory_structure_for_read_access) and (use_riak_file_contents_for_read_access) and (readdir_prefetch_batch > 0):
+            self.attribute_prefetcher = AttributePrefetcher(self._prefetch_attrs, batch_size=readdir_prefetch_batch, concurrency=readdir_prefetch_concurrency)
+        else:
+            self.attribute_prefetcher = None
+        # the next files of a directory scan (files opened in listing order), fetched into the content cache ahead of their open
+        if (self.content_cache is not None) and (content_prefetch_depth > 0):
+            self.content_prefetcher = ContentPrefetcher(self._prefetch_content, self._content_size, Uploader.UploadBudget(content_prefetch_memory*1024*1024),
+                                                        depth=content_prefetch_depth, concurrency=content_prefetch_concurrency,
+                                                        max_names=content_prefetch_names)
+        else:
+            self.content_prefetcher = None
+        # changes to the directory sets, written as one set operation per directory and flush window
+        if (maintain_riak_directory_structure):
+            self.directory_updates = DirectoryCoalescer(self.riak_directory.flush, window=directory_flush_window, batch_size=directory_flush_batch)
+        else:
+            self.directory_updates = None
+        # latencies of all calls and RIAK requests per call (the backend is instrumented already), plus what
+        # the caches and queues report about themselves
+        self.metrics = metrics
+        if self.metrics is not None:
+            self.metrics.add_stats('riak_pool', riak_pool.stats)
+            self.metrics.add_stats('attr_cache', attr_cache.stats)
+            self.metrics.add_stats('handles', lambda: dict(open=len(self.handles), uploads_avoided=self.uploads_avoided))
+            for name in ('content_cache', 'upload_budget', 'compressor', 'blob_store', 'group_commit', 'write_back', 'key_index', 'metadata_snapshot', 'attribute_prefetcher', 'content_prefetcher', 'directory_updates',
+                         'readahead_pool', 'chunk_deleter'):
+                if getattr(self, name, None) is not None:
+                    self.metrics.add_stats(name, getattr(self, name).stats)
 
     # Helpers
     # =======
@@ -52,17 +169,199 @@ class riakfuse(Operations):
         path = os.path.join(self.root, partial)
         return path
 
+    # returns all keys listed in the directory set(s) of the given directory bucket
+    def _load_directory_keys(self, RiakDirectoryBucketNamespace):
+        return list(self._with_pending_changes(RiakDirectoryBucketNamespace, self.riak_directory.load_keys(RiakDirectoryBucketNamespace)))
+
+    # the keys of a directory set loaded from RIAK plus the changes of this mount not flushed to it yet
+    def _with_pending_changes(self, RiakDirectoryBucketNamespace, keys):
+        if self.directory_updates is None:
+            return keys
+        adds, discards = self.directory_updates.pending(RiakDirectoryBucketNamespace)
+        if not adds and not discards:
+            return keys
+        return (set(keys) | adds) - discards
+
+    # remembers the state of a newly opened handle and returns it
+    def _new_handle(self, fh, path, flags, dirty=False, from_riak=False, cached=False, chunks=None):
+        self.handles[fh] = dict(path=path, flags=flags, dirty=dirty or bool(flags & os.O_TRUNC), from_riak=from_riak, cached=cached, chunks=chunks)
+        return fh
+
+    # returns a function fetching the bytes of a chunk from the given content bucket
+    def _chunk_fetcher(self, RiakBucketNamespace):
+        def fetch(chunk_key):
+            with self.riak_pool.client() as riakClient:
+                return Compression.decode(riakClient.bucket(RiakBucketNamespace).get(chunk_key))
+        return fetch
+
+    def _mark_dirty(self, fh):
+        handle = self.handles.get(fh)
+        if handle is not None:
+            handle['dirty'] = True
+
+    # returns the path of an up-to-date cached copy of the key, downloading it on a miss. If it can't be
+    # cached (too large or not in RIAK) the path is None and the already fetched RiakObject holding the
+    # contents is returned instead, together with its bucket (see _dereference)
+    def _cached_content(self, path, RiakBucketNamespace, RiakKeyNamespace):
+        name = (RiakBucketNamespace, RiakKeyNamespace)
+        if (content_cache_validation == 'size'):
+            # usually answered by the attribute cache - a warm open then costs no RIAK request at all
+            tag = str(self.getattr(path)['st_size'])
+            cache_path = self.content_cache.lookup(name, tag)
+            if cache_path is not None:
+                return cache_path, None, None
+        with self.riak_pool.client() as riakClient:
+            bucket = riakClient.bucket(RiakBucketNamespace)
+            if (content_cache_validation == 'vclock'):
+                # a head request only transfers the metadata of the object
+                tag = self._vclock_tag(bucket.get(RiakKeyNamespace, head_only=True))
+                cache_path = self.content_cache.lookup(name, tag)
+                if cache_path is not None:
+                    return cache_path, None, None
+            the_imge_data = bucket.get(RiakKeyNamespace)
+        if (content_cache_validation == 'vclock'):
+            # a reference changes with the contents it refers to, so its vclock is as good
+            tag = self._vclock_tag(the_imge_data)
+        RiakContentBucket, the_imge_data = self._dereference(RiakBucketNamespace, the_imge_data)
+        if (not the_imge_data.exists) or ChunkStore.isManifest(the_imge_data):
+            # chunked files are read chunk by chunk instead
+            return None, RiakContentBucket, the_imge_data
+        binary_data = Compression.decode(the_imge_data)
+        if (content_cache_validation == 'size'):
+            tag = str(len(binary_data))
+        return self.content_cache.store(name, binary_data, tag), RiakContentBucket, the_imge_data
+
+    # returns the bucket and the object holding the contents of a fetched key: the blob a deduplicated file
+    # refers to (see BlobStore), the key itself otherwise. Must not be called with a pooled connection held.
+    def _dereference(self, RiakBucketNamespace, riak_object):
+        if not BlobStore.isReference(riak_object):
+            return RiakBucketNamespace, riak_object
+        reference = BlobStore.loadReference(riak_object)
+        with self.riak_pool.client() as riakClient:
+            return reference['bucket'], BlobStore.fetchBlob(riakClient, reference)
+
+    # loads a file into the content cache ahead of its open (see ContentPrefetcher)
+    def _prefetch_content(self, path, size):
+        RiakBucketNamespace, RiakDirectoryBucketNamespace, RiakKeyNamespace = self.path_mapper.map(path)
+        if RiakKeyNamespace is None:
+            return
+        if (self.write_back is not None) and self.write_back.pending((RiakBucketNamespace,RiakKeyNamespace)):
+            # the local copy is newer than what RIAK has
+            return
+        if size > self.content_cache.max_bytes:
+            # would not be cached anyway
+            return
+        # an open of the same file waits for it and finds it in the cache then
+        with self.key_locks.lock((RiakBucketNamespace,RiakKeyNamespace)):
+            self._cached_content(path, RiakBucketNamespace, RiakKeyNamespace)
+
+    def _content_size(self, path):
+        return self.getattr(path)['st_size']
+
+    def _vclock_tag(self, riak_object):
+        if riak_object.vclock is None:
+            return None
+        return riak_object.vclock.encode('base64')
+
+    # the name (bucket, key) a path is stored under in RIAK
+    def _riak_name(self, path):
+        name = self.path_mapper.map(path)
+        return (name.bucket, name.key)
+
     def pathYieldGenerator():
         mylist = range(3)
         for i in mylist:
             yield i*i
 
+    # every filesystem call goes through here (fusepy) - timed when metrics are collected
+    def __call__(self, op, *args):
+        if self.metrics is None:
+            return super(riakfuse, self).__call__(op, *args)
+        if op == 'readdir':
+            # the listing is produced while FUSE iterates it
+            return self.metrics.generator(op, super(riakfuse, self).__call__(op, *args))
+        with self.metrics.operation(op):
+            return super(riakfuse, self).__call__(op, *args)
+
+    # ==================
+    # Lifecycle methods
+    # ==================
+    def init(self, path):
+        # called once FUSE is up (and went into background) - start all background work here
+        self.riak_pool.start()
+        if self.metrics is not None:
+            self.metrics.serve(metrics_address, metrics_port)
+        if self.key_index is not None:
+            self.key_index.start()
+        if self.metadata_snapshot is not None:
+            self.metadata_snapshot.start()
+        if self.directory_updates is not None:
+            self.directory_updates.start()
+        if self.attribute_prefetcher is not None:
+            self.attribute_prefetcher.start()
+        if self.content_prefetcher is not None:
+            self.content_prefetcher.start()
+        if self.readahead_pool is not None:
+            self.readahead_pool.start()
+        if self.chunk_deleter is not None:
+            self.chunk_deleter.start()
+        if self.group_commit is not None:
+            self.group_commit.start()
+        if self.write_back is not None:
+            # uploads interrupted by a crash or unmount are queued again first
+            self.write_back.start(self._riak_name)
+
+    def destroy(self, path):
+        logger.info('Shutting down RIAKfuse...')
+        if self.write_back is not None:
+            logger.info('waiting for pending uploads: %s'% (self.write_back.stats()))
+            self.write_back.close()
+        if self.directory_updates is not None:
+            # whatever the uploads changed is written before the connections go away
+            self.directory_updates.close()
+            logger.info('directory updates: %s'% (self.directory_updates.stats()))
+        if self.key_index is not None:
+            self.key_index.close()
+        if self.metadata_snapshot is not None:
+            # written once more with everything this run changed
+            self.metadata_snapshot.close()
+            logger.info('metadata snapshot: %s'% (self.metadata_snapshot.stats()))
+        if self.attribute_prefetcher is not None:
+            self.attribute_prefetcher.close()
+            logger.info('readdir prefetch: %s'% (self.attribute_prefetcher.stats()))
+        if self.content_prefetcher is not None:
+            self.content_prefetcher.close()
+            logger.info('scan prefetch: %s'% (self.content_prefetcher.stats()))
+        if self.readahead_pool is not None:
+            self.readahead_pool.close()
+            logger.info('chunk read-ahead: %s'% (self.readahead_pool.stats()))
+        if self.chunk_deleter is not None:
+            # what is still waiting for its grace period is deleted now
+            self.chunk_deleter.close()
+            logger.info('obsolete chunks: %s'% (self.chunk_deleter.stats()))
+        if self.group_commit is not None:
+            self.group_commit.close()
+            logger.info('group commits: %s'% (self.group_commit.stats()))
+        if self.content_cache is not None:
+            logger.info('content cache statistics: %s'% (self.content_cache.stats()))
+        logger.info('uploads avoided for unchanged files: %s'% (self.uploads_avoided))
+        if self.blob_store is not None:
+            logger.info('deduplication: %s'% (self.blob_store.stats()))
+        if self.upload_budget is not None:
+            logger.info('upload memory: %s'% (self.upload_budget.stats()))
+        if self.metrics is not None:
+            for op, summary in sorted(self.metrics.summary().items()):
+                logger.info('%s: %s'% (op,summary))
+            self.metrics.close()
+        logger.info('RIAK connections: %s'% (self.riak_pool.stats()))
+        self.riak_pool.close()
+
     # ==================
     # Filesystem methods
     # ==================
     def access(self, path, mode):
         full_path = self._full_path(path)
-        logger.debug('access %s - mode: %s'% (path,mode))
+        logger.debug('access %s - mode: %s', path,mode)
         # always return successfully on write
         if (mode == 2):
             return
@@ -72,7 +371,7 @@ class riakfuse(Operations):
 
     def chmod(self, path, mode):
         full_path = self._full_path(path)
-        logger.debug('chmod %s - mode: %s'% (path,mode))
+        logger.debug('chmod %s - mode: %s', path,mode)
         if (use_riak_file_contents_for_read_access):
             logger.debug('since riak being used for read calls - chmod is ignored')
             return
@@ -81,76 +380,151 @@ class riakfuse(Operations):
 
     def chown(self, path, uid, gid):
         full_path = self._full_path(path)
-        logger.debug('chown %s - uid: %s gid: %s'% (path,uid,gid))
+        logger.debug('chown %s - uid: %s gid: %s', path,uid,gid)
         return os.chown(full_path, uid, gid)
 
     def getattr(self, path, fh=None):
         full_path = self._full_path(path)
-        logger.debug('getattr %s'% (path))
+        logger.debug('getattr %s', path)
         if (use_riak_file_contents_for_read_access):
-            RiakDirectoryBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_directory_namespace_prefix,path)
-            RiakKeyNamespace = NameMapping.legacyPathToRiakKeyName(path)
+            RiakBucketNamespace, RiakDirectoryBucketNamespace, RiakKeyNamespace = self.path_mapper.map(path)
             if RiakKeyNamespace is None:
                 # apparently this is not a proper path, so just go ahead and unlink the local file and report on that
                 logger.warning('%s is not a mappable RIAK bucket - ignoring.'% (path))
                 # so ignore...
                 st = os.lstat(full_path)
+            elif (self.write_back is not None) and self.write_back.pending(self._riak_name(path)):
+                # RIAK does not have the latest version yet - the local copy has
+                logger.debug('upload of %s pending - using the local copy', path)
+                return dict(st_mode=(S_IFREG | riak_contents_file_mask), st_nlink=1, st_uid=riak_contents_file_uid, st_gid=riak_contents_file_gid, st_size=os.path.getsize(full_path), st_ctime=time(), st_mtime=time(),st_atime=time())
             else:
+                # answer repeated stats from memory
+                st = self.attr_cache.get(path)
+                if st is not None:
+                    return st
+                # a listing of the directory might be fetching it right now
+                if (self.attribute_prefetcher is not None) and self.attribute_prefetcher.wait(path, riak_pool_timeout):
+                    st = self.attr_cache.get(path)
+                    if st is not None:
+                        return st
+                # right after a restart the snapshot knows the sizes (until the directory is reconciled with RIAK)
+                if self.metadata_snapshot is not None:
+                    known = self.metadata_snapshot.attrs(RiakDirectoryBucketNamespace, RiakKeyNamespace)
+                    if known is not None:
+                        return self.attr_cache.put(path, self._riak_attrs(*known))
                 # we got a valid path, now just return the default file mask
                 #st = os.lstat('/etc/passwd')
                 #check if it is existing by trying to get it's size from the value stored under the file key in the directory bucket
-                logger.debug('Retrieving stored object size and status...%s/%s'% (RiakDirectoryBucketNamespace,RiakKeyNamespace))
-                # read the set contents...
-                btype = riak.RiakClient(host=riak_host, pb_port=riak_port, protocol='pbc').bucket_type('sets')
-                bucket = btype.bucket(RiakDirectoryBucketNamespace)
-                myset = datatypes.Set(bucket, RiakKeyNamespace)
-                myset.reload()
-                if len(myset) > 0:
-                    the_file_size = int(next(iter(myset)))
-                    logger.debug('Got size: %s'% (str(the_file_size)))
+                if (self.key_index is not None) and (self.key_index.contains(RiakDirectoryBucketNamespace, RiakKeyNamespace) is False):
+                    # not listed in the directory - no need to ask RIAK for the size
+                    the_file_size = the_file_mtime = None
                 else:
-                    the_file_size = None
+                    logger.debug('Retrieving stored object size and status...%s/%s', RiakDirectoryBucketNamespace,RiakKeyNamespace)
+                    with self.riak_pool.client() as riakClient:
+                        the_file_size, the_file_mtime = self.riak_directory.fetch_size(riakClient, RiakDirectoryBucketNamespace, RiakKeyNamespace)
+                    logger.debug('Got size: %s', str(the_file_size))
+                    if (self.metadata_snapshot is not None) and (the_file_size is not None):
+                        self.metadata_snapshot.record_size(RiakDirectoryBucketNamespace, RiakKeyNamespace, the_file_size, the_file_mtime)
 
                 if (the_file_size is None):
-                    logger.debug('Requested file %s apparently not existing in %s checking locally...'% (RiakKeyNamespace,RiakDirectoryBucketNamespace))
+                    logger.debug('Requested file %s apparently not existing in %s checking locally...', RiakKeyNamespace,RiakDirectoryBucketNamespace)
                     if os.path.isfile(full_path):
-                        logger.debug('file exists locally - using this one...(%s)'% (full_path))
+                        logger.debug('file exists locally - using this one...(%s)', full_path)
                         return dict(st_mode=(S_IFREG | riak_contents_file_mask), st_nlink=1, st_uid=riak_contents_file_uid, st_gid=riak_contents_file_gid, st_size=os.path.getsize(full_path), st_ctime=time(), st_mtime=time(),st_atime=time())
                     else:
                         raise FuseOSError(errno.ENOENT)
                 else:
-                    # You've now got a ``RiakObject``. To get at the binary data, call:
-                    return dict(st_mode=(S_IFREG | riak_contents_file_mask), st_nlink=1, st_uid=riak_contents_file_uid, st_gid=riak_contents_file_gid, st_size=the_file_size, st_ctime=time(), st_mtime=time(),st_atime=time())
+                    return self.attr_cache.put(path, self._riak_attrs(the_file_size, the_file_mtime))
         else:
             st = os.lstat(full_path)
 
-        logger.debug('Attributes: %s'% (st))
+        logger.debug('Attributes: %s', st)
         return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime','st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
 
+    # the attributes reported for a file stored in RIAK
+    def _riak_attrs(self, the_file_size, the_file_mtime):
+        # the timestamps stay the same for as long as the entry is cached (or for good with a metadata record)
+        now = the_file_mtime if the_file_mtime is not None else time()
+        return dict(st_mode=(S_IFREG | riak_contents_file_mask), st_nlink=1, st_uid=riak_contents_file_uid, st_gid=riak_contents_file_gid, st_size=the_file_size, st_ctime=now, st_mtime=now,st_atime=now)
+
+    # loads the stored sizes of a batch of listed files into the attribute cache, over one pooled connection
+    def _prefetch_attrs(self, entries):
+        with self.riak_pool.client() as riakClient:
+            for path, RiakDirectoryBucketNamespace, RiakKeyNamespace in entries:
+                the_file_size, the_file_mtime = self.riak_directory.fetch_size(riakClient, RiakDirectoryBucketNamespace, RiakKeyNamespace)
+                if the_file_size is not None:
+                    # valid for the stats of the whole scan that follows, not just the usual ttl
+                    self.attr_cache.put(path, self._riak_attrs(the_file_size, the_file_mtime), ttl=max(attr_cache_ttl, readdir_prefetch_ttl))
+                    if self.metadata_snapshot is not None:
+                        self.metadata_snapshot.record_size(RiakDirectoryBucketNamespace, RiakKeyNamespace, the_file_size, the_file_mtime)
+
     def readdir(self, path, fh):
+        if self.content_prefetcher is None:
+            for r in self._readdir(path, fh):
+                yield r
+            return
+        # a scan through the directory opens the files in the order they are listed in - only the first names are kept
+        listed = []
+        for r in self._readdir(path, fh):
+            if len(listed) < self.content_prefetcher.max_names + 2:
+                listed.append(r)
+            yield r
+        self.content_prefetcher.listed(path, listed)
+
+    def _readdir(self, path, fh):
         full_path = self._full_path(path)
-        logger.debug('readdir %s - fh: %s'% (path,fh))
+        logger.debug('readdir %s - fh: %s', path,fh)
         dirents = ['.', '..']
         # generate the correct names for the buckets and keys
-        RiakDirectoryBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_directory_namespace_prefix,path)
+        RiakDirectoryBucketNamespace = self.path_mapper.map(path).directory_bucket
 
         if (use_riak_directory_structure_for_read_access) and (RiakDirectoryBucketNamespace is not None):
             try:
-                logger.debug('using RIAK directory structure in %s (for %s)'% (RiakDirectoryBucketNamespace,path))
-                # Updating the $prefix+$id+$directoryprefix set with the given information
-                # we shall use our own riak client instance for this
-                btype = riak.RiakClient(host=riak_host, pb_port=riak_port, protocol='pbc').bucket_type(riak_directory_set_buckettype)
-                # get the bucket for the directory namespace - this is a sets pre-configured bucket
-                bucket = btype.bucket(RiakDirectoryBucketNamespace)
-                # get the correct key inside that bucket
-                myset = datatypes.Set(bucket, riak_directory_set_directorykey)
-                # fetch the directory in order to be able to output it...
-                myset.reload()
+                logger.debug('using RIAK directory structure in %s (for %s)', RiakDirectoryBucketNamespace,path)
                 for r in dirents:
                     yield r
 
-                for id in myset:
-                    yield id
+                # changes of this mount that are not flushed to RIAK yet
+                if self.directory_updates is not None:
+                    adds, discards = self.directory_updates.pending(RiakDirectoryBucketNamespace)
+                else:
+                    adds, discards = set(), set()
+                # right after a restart the snapshot knows the listing (until the directory is reconciled with RIAK)
+                if self.metadata_snapshot is not None:
+                    snapshot_keys = self.metadata_snapshot.listing(RiakDirectoryBucketNamespace)
+                    if snapshot_keys is not None:
+                        for id in snapshot_keys:
+                            if id not in discards:
+                                yield id
+                        for id in adds.difference(snapshot_keys):
+                            yield id
+                        return
+                    # what RIAK lists is recorded for the next snapshot
+                    listed = []
+                else:
+                    listed = None
+                # no more than the attribute cache holds - further entries would evict the first before they are used
+                prefetch_budget = self.attr_cache.max_entries
+                pending_adds = {}
+                for id in adds:
+                    pending_adds.setdefault(self.riak_directory.set_key_for(id), []).append(id)
+                # the listing is read and yielded shard by shard, only one shard is held in memory
+                for set_key, members in self.riak_directory.listing(RiakDirectoryBucketNamespace):
+                    if (self.attribute_prefetcher is not None) and (prefetch_budget > 0):
+                        # the stats following the listing find the sizes in the attribute cache
+                        entries = list(islice(((os.path.join(path, id), RiakDirectoryBucketNamespace, id) for id in members if os.path.join(path, id) not in self.attr_cache), prefetch_budget))
+                        prefetch_budget -= len(entries)
+                        self.attribute_prefetcher.prefetch(entries)
+                    if listed is not None:
+                        listed.extend(members)
+                    for id in members:
+                        if id not in discards:
+                            yield id
+                    for id in pending_adds.get(set_key, []):
+                        if id not in members:
+                            yield id
+                if listed is not None:
+                    self.metadata_snapshot.record_listing(RiakDirectoryBucketNamespace, listed)
             except Exception as e:
                 # throw controlled exception
                 logger.error('ERROR retrieving directory structure on RIAK bucket %s (Exception: %s)'% (RiakDirectoryBucketNamespace,str(e)))
@@ -169,39 +543,35 @@ class riakfuse(Operations):
                 yield r
 
     def mknod(self, path, mode, dev):
-        logger.debug('mknod %s - mode: %s dev: %s'% (path,mode,dev))
+        logger.debug('mknod %s - mode: %s dev: %s', path,mode,dev)
         return os.mknod(self._full_path(path), mode, dev)
 
     def rmdir(self, path):
         full_path = self._full_path(path)
-        logger.debug('rmdir %s'% (path))
+        logger.debug('rmdir %s', path)
         return os.rmdir(full_path)
 
     def mkdir(self, path, mode):
-        logger.debug('mkdir %s - mode: %s'% (path,mode))
+        logger.debug('mkdir %s - mode: %s', path,mode)
         return os.mkdir(self._full_path(path), mode)
 
     def statfs(self, path):
         full_path = self._full_path(path)
-        logger.debug('statfs %s'% (path))
+        logger.debug('statfs %s', path)
         stv = os.statvfs(full_path)
         return dict((key, getattr(stv, key)) for key in ('f_bavail', 'f_bfree',
             'f_blocks', 'f_bsize', 'f_favail', 'f_ffree', 'f_files', 'f_flag',
             'f_frsize', 'f_namemax'))
 
     def rename(self, old, new):
-        logger.debug('rename %s - target: %s'% (old,new))
+        logger.debug('rename %s - target: %s', old,new)
         if (maintain_riak_directory_structure):
             # check if this is the directory that matches our patterns
             try:
                 # generate the correct names for the buckets and keys
-                RiakBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_namespace_prefix,old)
-                RiakNewBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_namespace_prefix,new)
-                RiakKeyNamespace = NameMapping.legacyPathToRiakKeyName(old)
-                RiakNewKeyNamespace = NameMapping.legacyPathToRiakKeyName(new)
-                RiakDirectoryBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_directory_namespace_prefix,old)
-                RiakDirectoryNewBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_directory_namespace_prefix,new)
-                logger.debug('rename %s %s %s %s'% (RiakKeyNamespace, RiakNewKeyNamespace, RiakDirectoryBucketNamespace, RiakDirectoryNewBucketNamespace))
+                RiakBucketNamespace, RiakDirectoryBucketNamespace, RiakKeyNamespace = self.path_mapper.map(old)
+                RiakNewBucketNamespace, RiakDirectoryNewBucketNamespace, RiakNewKeyNamespace = self.path_mapper.map(new)
+                logger.debug('rename %s %s %s %s', RiakKeyNamespace, RiakNewKeyNamespace, RiakDirectoryBucketNamespace, RiakDirectoryNewBucketNamespace)
                 # only continue of the Bucket Names match, not supported to rename between buckets
                 if (RiakDirectoryBucketNamespace == RiakDirectoryNewBucketNamespace):
                     # this is not a valid namespace - so pattern did not match on a directory/filename structure known to be mapped
@@ -212,46 +582,30 @@ class riakfuse(Operations):
                         # so do the local rename anways...
                         return os.rename(self._full_path(old), self._full_path(new))
 
-                    logger.debug('updating %s directory structure for %s to %s (renaming)'% (RiakDirectoryBucketNamespace,RiakKeyNamespace, RiakNewKeyNamespace))
-                    # Updating the $prefix+$id+$directoryprefix set with the given information
-                    # we shall use our own riak client instance for this
-                    btype = riak.RiakClient(host=riak_host, pb_port=riak_port, protocol='pbc').bucket_type(riak_directory_set_buckettype)
-                    # get the bucket for the directory namespace - this is a sets pre-configured bucket
-                    bucket = btype.bucket(RiakDirectoryBucketNamespace)
-                    # get the correct key inside that bucket
-                    myset = datatypes.Set(bucket, riak_directory_set_directorykey)
-                    # fetch the directory in order to be change it...
-                    myset.reload()
-                    # add this file to the directory - if it's already there it won't be added (handled by RIAK)
-                    myset.discard(RiakKeyNamespace)
-                    myset.add(RiakNewKeyNamespace)
-                    # send to RIAK afterall
-                    myset.store()
-                    logger.debug('DONE updating RIAK directory structure')
-
-                    # create RiakClient instance
-                    riakClient = riak.RiakClient(host=riak_host, pb_port=riak_port, protocol='pbc')
-                    # get the correct bucket
-                    old_bucket = riakClient.bucket(RiakBucketNamespace)
-                    new_bucket = riakClient.bucket(RiakNewBucketNamespace)
-                    # read the old key contents...
-                    the_imge_data = old_bucket.get(RiakKeyNamespace)
-                    logger.debug('Got the old key contents from RIAK (%s/%s)'% (RiakBucketNamespace,RiakKeyNamespace))
-                    # and write those to the new bucket...
-                    riak_image = new_bucket.new(RiakNewKeyNamespace, encoded_data=the_imge_data, content_type=riak_content_type)
-                    logger.debug('Wrote contents to RIAK %s'% (RiakNewKeyNamespace))
-                    # remove the old one...
-                    old_bucket.delete(RiakKeyNamespace)
-                    logger.debug('Removed old key from RIAK %s'% (RiakKeyNamespace))
-                    # send to RIAK afterall
-                    riak_image.store()
-                    # if the local copy is removed, it's gone anyways...
-                    if not (remove_local_copy_after_successful_mapping):
-                        # we shall now rename the local file and finish...
-                        return os.rename(self._full_path(old), self._full_path(new))
+                    if self.write_back is not None:
+                        # RIAK has to have the latest version of both names before they are moved
+                        if not (self.write_back.wait((RiakBucketNamespace,RiakKeyNamespace), write_back_wait_timeout) and
+                                self.write_back.wait((RiakNewBucketNamespace,RiakNewKeyNamespace), write_back_wait_timeout)):
+                            logger.error('ERROR renaming %s - its upload is still pending after %s seconds'% (old,write_back_wait_timeout))
+                            raise FuseOSError(errno.EAGAIN)
+
+                    logger.debug('updating %s directory structure for %s to %s (renaming)', RiakDirectoryBucketNamespace,RiakKeyNamespace, RiakNewKeyNamespace)
+                    # both keys are locked for the whole move
+                    with self.key_locks.lock((RiakBucketNamespace,RiakKeyNamespace), (RiakNewBucketNamespace,RiakNewKeyNamespace)):
+                        self._move_content(RiakBucketNamespace, RiakDirectoryBucketNamespace, RiakKeyNamespace, RiakNewBucketNamespace, RiakNewKeyNamespace)
+                        self.attr_cache.invalidate(old, new)
+                        if self.content_cache is not None:
+                            self.content_cache.invalidate((RiakBucketNamespace,RiakKeyNamespace))
+                            self.content_cache.invalidate((RiakNewBucketNamespace,RiakNewKeyNamespace))
+                        # if the local copy is removed, it's gone anyways...
+                        if not (remove_local_copy_after_successful_mapping):
+                            # we shall now rename the local file and finish...
+                            return os.rename(self._full_path(old), self._full_path(new))
                 else:
-                    logger.debug('ERROR unsupported rename of file between buckets (%s -> %s)'% (RiakDirectoryBucketNamespace,RiakDirectoryNewBucketNamespace))
+                    logger.debug('ERROR unsupported rename of file between buckets (%s -> %s)', RiakDirectoryBucketNamespace,RiakDirectoryNewBucketNamespace)
                     raise FuseOSError(errno.ENOTSUP)
+            except FuseOSError:
+                raise
             except Exception as e:
                 # throw controlled exception but do not remove the actual local file due to errors in the process...
                 logger.error('ERROR updating directory structure on RIAK bucket %s the key %s (Exception: %s)'% (RiakDirectoryBucketNamespace,RiakKeyNamespace,str(e)))
@@ -260,8 +614,76 @@ class riakfuse(Operations):
             # go ahead and rename locally
             return os.rename(self._full_path(old), self._full_path(new))
 
+    ## Moves a file in RIAK from one key to another without moving its contents where that is possible: a chunked
+    ## file only has its manifest written under the new key (the chunks keep their keys), a deduplicated file a
+    ## reference to the same blob. Only a plain object has to be copied - RIAK can neither copy nor rename.
+    ## Crash-safe order: new key, metadata, listing, then the old key - an interruption leaves both names, never none.
+    ## The key locks have to be held.
+    def _move_content(self, RiakBucketNamespace, RiakDirectoryBucketNamespace, RiakKeyNamespace, RiakNewBucketNamespace, RiakNewKeyNamespace):
+        with self.riak_pool.client() as riakClient:
+            # a small pointer for chunked and deduplicated files
+            the_imge_data = riakClient.bucket(RiakBucketNamespace).get(RiakKeyNamespace)
+            logger.debug('Got the old key contents from RIAK (%s/%s)', RiakBucketNamespace,RiakKeyNamespace)
+            # what the new key held so far is cleaned up once it is replaced
+            replaced_manifest, replaced_reference = self._fetch_pointers(riakClient.bucket(RiakNewBucketNamespace), RiakNewKeyNamespace)
+
+        old_reference = reference = None
+        if BlobStore.isReference(the_imge_data) and (self.blob_store is not None):
+            # the new key refers to the blob with a token of its own, counted before it is stored
+            old_reference = BlobStore.loadReference(the_imge_data)
+            reference = self.blob_store.link(old_reference)
+
+        with self.riak_pool.client() as riakClient:
+            new_bucket = riakClient.bucket(RiakNewBucketNamespace)
+            if reference is not None:
+                BlobStore.storeReference(new_bucket, RiakNewKeyNamespace, reference, self.quorum)
+            elif the_imge_data.exists:
+                # a manifest or a plain object is copied as it is - compressed contents stay compressed
+                riak_image = new_bucket.new(RiakNewKeyNamespace, encoded_data=the_imge_data.encoded_data, content_type=the_imge_data.content_type or riak_content_type)
+                if the_imge_data.content_encoding:
+                    riak_image.content_encoding = the_imge_data.content_encoding
+                riak_image.store(return_body=False, **self.quorum)
+            logger.debug('Wrote contents to RIAK %s', RiakNewKeyNamespace)
+            # the metadata record moves along
+            self.riak_directory.move_size(riakClient, RiakDirectoryBucketNamespace, RiakKeyNamespace, RiakNewKeyNamespace)
+
+        # the directory set has to list the new key before the old one is gone - flushed right away even with a flush window
+        self.directory_updates.rename(RiakDirectoryBucketNamespace, RiakKeyNamespace, RiakNewKeyNamespace)
+        self.directory_updates.flush(RiakDirectoryBucketNamespace)
+        if self.key_index is not None:
+            self.key_index.discard(RiakDirectoryBucketNamespace, RiakKeyNamespace)
+            self.key_index.add(RiakDirectoryBucketNamespace, RiakNewKeyNamespace)
+        if self.metadata_snapshot is not None:
+            self.metadata_snapshot.rename(RiakDirectoryBucketNamespace, RiakKeyNamespace, RiakNewKeyNamespace)
+        logger.debug('DONE updating RIAK directory structure')
+
+        with self.riak_pool.client() as riakClient:
+            riakClient.bucket(RiakBucketNamespace).delete(RiakKeyNamespace)
+            logger.debug('Removed old key from RIAK %s', RiakKeyNamespace)
+            if replaced_manifest is not None:
+                # chunks are named after the manifest id, not the key - only an interrupted earlier rename can have
+                # left the same manifest under both keys
+                kept = set(ChunkStore.loadManifest(the_imge_data)['chunks']) if ChunkStore.isManifest(the_imge_data) else set()
+                for chunk_key in set(replaced_manifest['chunks']) - kept:
+                    riakClient.bucket(RiakNewBucketNamespace).delete(chunk_key)
+        if old_reference is not None:
+            self.blob_store.drop(old_reference)
+        if (replaced_reference is not None) and (self.blob_store is not None):
+            self.blob_store.drop(replaced_reference)
+
+    # the manifest and the blob reference stored under a key (None, None for plain or missing objects), a head
+    # request if it is neither
+    def _fetch_pointers(self, bucket, key):
+        riak_object = bucket.get(key, head_only=True)
+        if not (ChunkStore.isManifest(riak_object) or BlobStore.isReference(riak_object)):
+            return None, None
+        riak_object = bucket.get(key)
+        if ChunkStore.isManifest(riak_object):
+            return ChunkStore.loadManifest(riak_object), None
+        return None, BlobStore.loadReference(riak_object)
+
     def utimens(self, path, times=None):
-        logger.debug('utimens %s'% (path))
+        logger.debug('utimens %s', path)
         return os.utime(self._full_path(path), times)
 
     # ============
@@ -270,78 +692,145 @@ class riakfuse(Operations):
 
     def open(self, path, flags):
         full_path = self._full_path(path)
-        logger.debug('open %s - flags: %s'% (path,flags))
+        logger.debug('open %s - flags: %s', path,flags)
 
         # when we're reading from RIAK, we're going to retrieve the file contents from RIAK and store it locally for temporary use
         if (use_riak_file_contents_for_read_access):
-            RiakBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_namespace_prefix,path)
-            RiakKeyNamespace = NameMapping.legacyPathToRiakKeyName(path)
+            RiakBucketNamespace, RiakDirectoryBucketNamespace, RiakKeyNamespace = self.path_mapper.map(path)
 
             if RiakKeyNamespace is None:
                 # apparently this is not a proper path, so just go ahead and unlink the local file and report on that
                 logger.warning('%s is not a mappable RIAK bucket - ignoring.'% (path))
                 # so do the local rename anways...
-                return os.open(full_path, flags)
+                return self._new_handle(os.open(full_path, flags), path, flags)
+            if self.content_prefetcher is not None:
+                # during a scan through the directory the files after this one are fetched ahead
+                self.content_prefetcher.opened(path)
+            if (self.write_back is not None) and self.write_back.pending((RiakBucketNamespace,RiakKeyNamespace)):
+                # RIAK does not have the latest version yet - the local copy has, even while its upload keeps failing
+                with self.key_locks.lock((RiakBucketNamespace,RiakKeyNamespace)):
+                    if os.path.exists(full_path):
+                        logger.debug('upload of %s pending - using the local copy', path)
+                        # the upload keeps the copy while it is open, release removes it once RIAK has it
+                        return self._new_handle(os.open(full_path, flags), path, flags, from_riak=True)
+                # uploaded and removed in the meantime - RIAK has the latest version now
             try:
-                logger.debug('Retrieving key contents and storing temporarily...%s/%s'% (RiakBucketNamespace,RiakKeyNamespace))
-                # create RiakClient instance
-                riakClient = riak.RiakClient(host=riak_host, pb_port=riak_port, protocol='pbc')
-                # get the correct bucket
-                bucket = riakClient.bucket(RiakBucketNamespace)
-                # read the old key contents...
-                the_imge_data = bucket.get(RiakKeyNamespace)
-                # You've now got a ``RiakObject``. To get at the binary data, call:
-                with open(full_path, 'wb') as f:
-                    binary_data = the_imge_data.encoded_data
-                    f.write(binary_data)
+                logger.debug('Retrieving key contents and storing temporarily...%s/%s', RiakBucketNamespace,RiakKeyNamespace)
+                # the local copy must not be overwritten while a release of the same key is reading it
+                with self.key_locks.lock((RiakBucketNamespace,RiakKeyNamespace)):
+                    if self.content_cache is not None:
+                        cache_path, RiakContentBucket, the_imge_data = self._cached_content(path, RiakBucketNamespace, RiakKeyNamespace)
+                        if cache_path is not None:
+                            if (flags & os.O_ACCMODE) == os.O_RDONLY:
+                                # readers are served straight from the cache, the source tree is not touched
+                                return self._new_handle(os.open(cache_path, flags), path, flags, cached=True)
+                            # writers get a local copy - taken from the cache instead of RIAK
+                            shutil.copyfile(cache_path, full_path)
+                            return self._new_handle(os.open(full_path, flags), path, flags, from_riak=True)
+                    else:
+                        # borrow a pooled RiakClient instance
+                        with self.riak_pool.client() as riakClient:
+                            # get the correct bucket
+                            bucket = riakClient.bucket(RiakBucketNamespace)
+                            # read the old key contents...
+                            the_imge_data = bucket.get(RiakKeyNamespace)
+                        RiakContentBucket, the_imge_data = self._dereference(RiakBucketNamespace, the_imge_data)
+                    if ChunkStore.isManifest(the_imge_data):
+                        manifest = ChunkStore.loadManifest(the_imge_data)
+                        fetch = self._chunk_fetcher(RiakContentBucket)
+                        if (flags & os.O_ACCMODE) == os.O_RDONLY:
+                            # reads are answered with just the chunks they cover - the handle itself only reserves a descriptor
+                            fh = os.open(os.devnull, os.O_RDONLY)
+                            return self._new_handle(fh, path, flags, chunks=ChunkStore.ChunkReader(manifest, fetch, readahead=chunk_readahead, pool=self.readahead_pool))
+                        # writers need the whole file locally
+                        ChunkStore.materialize(manifest, fetch, full_path)
+                        return self._new_handle(os.open(full_path, flags), path, flags, from_riak=True)
+                    # You've now got a ``RiakObject``. To get at the binary data, call:
+                    with open(full_path, 'wb') as f:
+                        binary_data = Compression.decode(the_imge_data)
+                        f.write(binary_data)
             except Exception as e:
                 # throw controlled exception but do not remove the actual local file due to errors in the process...
                 logger.error('ERROR retrieving data from RIAK bucket %s the key %s (Exception: %s)'% (RiakBucketNamespace,RiakKeyNamespace,str(e)))
                 raise FuseOSError(errno.EACCES)
             else:
-                logger.debug('DONE Got the old key contents from RIAK (%s/%s) and stored temporarily %s'% (RiakBucketNamespace,RiakKeyNamespace,full_path))
-        return os.open(full_path, flags)
+                logger.debug('DONE Got the old key contents from RIAK (%s/%s) and stored temporarily %s', RiakBucketNamespace,RiakKeyNamespace,full_path)
+                return self._new_handle(os.open(full_path, flags), path, flags, from_riak=True)
+        return self._new_handle(os.open(full_path, flags), path, flags)
 
     def create(self, path, mode, fi=None):
         full_path = self._full_path(path)
-        logger.debug('create %s - mode: %s'% (path,mode))
-        return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+        logger.debug('create %s - mode: %s', path,mode)
+        # a new file always has to go to RIAK
+        return self._new_handle(os.open(full_path, os.O_WRONLY | os.O_CREAT, mode), path, os.O_WRONLY | os.O_CREAT, dirty=True)
 
     def read(self, path, length, offset, fh):
-        logger.debug('read %s - length: %s offset: %s fh: %s'% (path, length, offset, fh))
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        logger.debug('read %s - length: %s offset: %s fh: %s', path, length, offset, fh)
+        handle = self.handles.get(fh)
+        if (handle is not None) and (handle['chunks'] is not None):
+            return handle['chunks'].read(length, offset)
+        # positional reads do not share the file offset, so concurrent reads on one handle are safe
+        if hasattr(os, 'pread'):
+            return os.pread(fh, length, offset)
+        with self.rwlock:
+            os.lseek(fh, offset, os.SEEK_SET)
+            return os.read(fh, length)
 
     def write(self, path, buf, offset, fh):
-        logger.debug('write %s - length: %s offset: %s fh: %s'% (path, sys.getsizeof(buf), offset, fh))
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.write(fh, buf)
+        logger.debug('write %s - length: %s offset: %s fh: %s', path, len(buf), offset, fh)
+        self._mark_dirty(fh)
+        if hasattr(os, 'pwrite'):
+            return os.pwrite(fh, buf, offset)
+        with self.rwlock:
+            os.lseek(fh, offset, os.SEEK_SET)
+            return os.write(fh, buf)
 
     def truncate(self, path, length, fh=None):
         full_path = self._full_path(path)
-        logger.debug('truncate %s - length: %s'% (path,length))
+        logger.debug('truncate %s - length: %s', path,length)
+        if fh is not None:
+            self._mark_dirty(fh)
+        else:
+            # truncated by name - every handle open on that file sees the change
+            for handle in list(self.handles.values()):
+                if handle['path'] == path:
+                    handle['dirty'] = True
         with open(full_path, 'r+') as f:
             f.truncate(length)
 
+    # flush is called on every close of a handle, right before release - how the local copy is made durable
+    # depends on the durability mode: always (fsync), group (synced with the next group commit) or riak (not
+    # at all if release stores it in RIAK right after, with the configured quorum)
     def flush(self, path, fh):
-        logger.debug('flush %s - fh: %s'% (path,fh))
+        logger.debug('flush %s - fh: %s', path,fh)
+        handle = self.handles.get(fh)
+        if (handle is not None) and not handle['dirty']:
+            # nothing was written through this handle
+            return
+        if (durability == 'group'):
+            return self.group_commit.add(fh)
+        if (durability == 'riak') and (self.write_back is None) and (self.path_mapper.map(path).bucket is not None):
+            return
         return os.fsync(fh)
 
+    # an explicit fsync of an application is always honored - in group mode it waits for the group commit
     def fsync(self, path, fdatasync, fh):
-        logger.debug('fsync %s - fdatasync: %s fh: %s'% (path,fdatasync,fh))
-        return self.flush(path, fh)
+        logger.debug('fsync %s - fdatasync: %s fh: %s', path,fdatasync,fh)
+        if (durability == 'group'):
+            return self.group_commit.sync(fh)
+        if fdatasync and hasattr(os, 'fdatasync'):
+            return os.fdatasync(fh)
+        return os.fsync(fh)
 
     # unlink is called whenever a file is removed. Since we're maintaining a
     def unlink(self, path):
-        logger.debug('unlink path %s'% (path))
+        logger.debug('unlink path %s', path)
 
         # all Riak interactions only necessary when this module actually is managing directory structures in RIAK
         if (maintain_riak_directory_structure):
             try:
                 # generate the correct names for the buckets and keys
-                RiakBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_namespace_prefix,path)
-                RiakKeyNamespace = NameMapping.legacyPathToRiakKeyName(path)
-                RiakDirectoryBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_directory_namespace_prefix,path)
+                RiakBucketNamespace, RiakDirectoryBucketNamespace, RiakKeyNamespace = self.path_mapper.map(path)
 
                 # this is not a valid namespace - so pattern did not match on a directory/filename structure known to be mapped
                 # --> therefore this method will return to the caller now.
@@ -350,40 +839,47 @@ class riakfuse(Operations):
                     logger.warning('%s is not a mappable RIAK bucket - ignoring.'% (path))
                     return os.unlink(self._full_path(path))
 
-                logger.debug('updating %s directory structure for %s (discarding)'% (RiakDirectoryBucketNamespace,RiakKeyNamespace))
+                if self.write_back is not None:
+                    # no need to upload what is about to be removed - but a running upload has to finish first
+                    if not self.write_back.cancel((RiakBucketNamespace,RiakKeyNamespace), write_back_wait_timeout):
+                        logger.error('ERROR unlinking %s - its upload is still pending after %s seconds'% (path,write_back_wait_timeout))
+                        raise FuseOSError(errno.EAGAIN)
+
+                logger.debug('updating %s directory structure for %s (discarding)', RiakDirectoryBucketNamespace,RiakKeyNamespace)
                 # Updating the $prefix+$id+$directoryprefix set with the given information
-                # we shall use our own riak client instance for this
-                btype = riak.RiakClient(host=riak_host, pb_port=riak_port, protocol='pbc').bucket_type(riak_directory_set_buckettype)
-                # get the bucket for the directory namespace - this is a sets pre-configured bucket
-                bucket = btype.bucket(RiakDirectoryBucketNamespace)
-                # get the correct key inside that bucket
-                myset = datatypes.Set(bucket, riak_directory_set_directorykey)
-                # fetch the directory in order to be change it...
-                myset.reload()
-                # add this file to the directory - if it's already there it won't be added (handled by RIAK)
-                myset.discard(RiakKeyNamespace)
-
-                mysizeset = datatypes.Set(bucket, RiakKeyNamespace) # this is the set
-                mysizeset.reload()
-                logger.debug('SizeSet len %s'% (len(mysizeset)))
-                if len(mysizeset) > 0:
-                    the_file_size = int(next(iter(mysizeset)))
-                    logger.debug('Discarding object size %s in riak %s'% (the_file_size,RiakKeyNamespace))
-                    mysizeset.discard(str(the_file_size))
-
-                # send to RIAK afterall
-                #logger.debug('Storing directory structure...')
-                myset.store()
-                #logger.debug('Storing size structure...')
-                mysizeset.store()
-                logger.debug('DONE updating directory structure')
-                # now update the bucket itself by removing the key
-                # create RiakClient instance
-                riakClient = riak.RiakClient(host=riak_host, pb_port=riak_port, protocol='pbc')
-                # get the correct bucket
-                release_bucket = riakClient.bucket(RiakBucketNamespace)
-                # remove that key
-                release_bucket.delete(RiakKeyNamespace)
+                # the key is locked for the whole read-modify-write
+                with self.key_locks.lock((RiakBucketNamespace,RiakKeyNamespace)):
+                    # the directory set is changed with the next flush (right away without a flush window)
+                    self.directory_updates.discard(RiakDirectoryBucketNamespace, RiakKeyNamespace)
+                    if self.key_index is not None:
+                        self.key_index.discard(RiakDirectoryBucketNamespace, RiakKeyNamespace)
+                    if self.metadata_snapshot is not None:
+                        self.metadata_snapshot.discard(RiakDirectoryBucketNamespace, RiakKeyNamespace)
+
+                    with self.riak_pool.client() as riakClient:
+                        self.riak_directory.remove_size(riakClient, RiakDirectoryBucketNamespace, RiakKeyNamespace)
+                        # a chunked file takes its chunks along (only looked for where chunks are written)
+                        might_be_chunked = (chunk_size > 0)
+                        logger.debug('DONE updating directory structure')
+                        # now update the bucket itself by removing the key
+                        # get the correct bucket
+                        release_bucket = riakClient.bucket(RiakBucketNamespace)
+                        # a deduplicated file refers to its blob, which is counted down once the key is gone
+                        if might_be_chunked or (self.blob_store is not None):
+                            old_manifest, old_reference = self._fetch_pointers(release_bucket, RiakKeyNamespace)
+                        else:
+                            old_manifest = old_reference = None
+                        # remove that key
+                        release_bucket.delete(RiakKeyNamespace)
+                        if old_manifest is not None:
+                            ChunkStore.deleteChunks(release_bucket, old_manifest, self.chunk_deleter)
+                    if (old_reference is not None) and (self.blob_store is not None):
+                        self.blob_store.drop(old_reference)
+                    self.attr_cache.invalidate(path)
+                    if self.content_cache is not None:
+                        self.content_cache.invalidate((RiakBucketNamespace,RiakKeyNamespace))
+            except FuseOSError:
+                raise
             except Exception as e:
                 # throw controlled exception but do not remove the actual local file due to errors in the process...
                 logger.error('ERROR updating directory structure on RIAK bucket %s the key %s (Exception: %s)'% (RiakDirectoryBucketNamespace,RiakKeyNamespace,str(e)))
@@ -400,12 +896,17 @@ class riakfuse(Operations):
     # This is when the file is closed by the process that accessed it. Wether it has been written or not, we do not care right now
     # if it's released, it'll be pushed to the bucket in Riak
     def release(self, path, fh):
-        logger.debug('release %s - fh: %s'% (path,fh))
+        logger.debug('release %s - fh: %s', path,fh)
+
+        # unknown handles are treated as changed - better one upload too many than one too few
+        handle = self.handles.pop(fh, None)
+
+        # served from the content cache or chunk by chunk - nothing changed that would need to go to RIAK
+        if (handle is not None) and (handle['cached'] or handle['chunks'] is not None):
+            return os.close(fh)
 
         # First step: get the correct names for buckets and keys
-        RiakBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_namespace_prefix,path)
-        RiakKeyNamespace = NameMapping.legacyPathToRiakKeyName(path)
-        RiakDirectoryBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_directory_namespace_prefix,path)
+        RiakBucketNamespace, RiakDirectoryBucketNamespace, RiakKeyNamespace = self.path_mapper.map(path)
 
         # this is not a valid namespace - so pattern did not match on a directory/filename structure known to be mapped
         # --> therefore this method will return to the caller now.
@@ -414,67 +915,118 @@ class riakfuse(Operations):
             logger.warning('%s is not a mappable RIAK bucket - ignoring.'% (path))
             return os.close(fh)
 
+        if (handle is not None) and not handle['dirty']:
+            # opened and closed without being written to - RIAK already has this version (or was never asked to)
+            self.uploads_avoided += 1
+            logger.debug('%s unchanged - not uploading (%s uploads avoided)', path,self.uploads_avoided)
+            returnvalueclose = os.close(fh)
+            if handle['from_riak'] and (remove_local_copy_after_successful_mapping) and \
+                    not ((self.write_back is not None) and self.write_back.pending((RiakBucketNamespace,RiakKeyNamespace))):
+                # just a temporary download of what is stored in RIAK anyways (a pending upload removes it itself)
+                logger.debug('removing local copy %s', path)
+                os.unlink(self._full_path(path))
+            return returnvalueclose
+
         # this seems to be a mappable RIAK path - so let's log and move on to actually moving the file to RIAK
-        logger.debug('updating on RIAK bucket %s the key %s (%s bytes to write.)'% (RiakBucketNamespace,RiakKeyNamespace,os.path.getsize(self._full_path(path))))
-
-        try:
-            # create RiakClient instance
-            riakClient = riak.RiakClient(host=riak_host, pb_port=riak_port, protocol='pbc')
-            # get the correct bucket
-            release_bucket = riakClient.bucket(RiakBucketNamespace)
-            # open the local file for read access off the filesystem
-            the_imge_data = open(self._full_path(path), 'rb').read()
-            # get the key+value and add it to the bucket
-            riak_image = release_bucket.new(RiakKeyNamespace, encoded_data=the_imge_data, content_type=riak_content_type)
-            # send to RIAK afterall
-            riak_image.store()
-        except Exception as e:
-            logger.error('ERROR updating on RIAK bucket %s the key %s (Exception: %s)'% (RiakBucketNamespace,RiakKeyNamespace,str(e)))
-        else:
-            logger.debug('DONE updating on RIAK bucket %s the key %s'% (RiakBucketNamespace,RiakKeyNamespace))
-            # is the directory structure (also) maintained in RIAK - if so, go ahead and update properly
-            if (maintain_riak_directory_structure):
-                logger.debug('updating %s directory structure for %s'% (RiakDirectoryBucketNamespace,RiakKeyNamespace))
-                # Updating the $prefix+$id+$directoryprefix set with the given information
-                # we shall use our own riak client instance for this
-                btype = riak.RiakClient(host=riak_host, pb_port=riak_port, protocol='pbc').bucket_type(riak_directory_set_buckettype)
-                # get the bucket for the directory namespace - this is a sets pre-configured bucket
-                bucket = btype.bucket(RiakDirectoryBucketNamespace)
-                # get the correct key inside that bucket
-                myset = datatypes.Set(bucket, riak_directory_set_directorykey)
-                # add this file to the directory - if it's already there it won't be added (handled by RIAK)
-                myset.add(RiakKeyNamespace)
-
-                logger.debug('updating size (%s) entry in directory %s/%s'% (str(os.stat(self._full_path(path)).st_size),RiakDirectoryBucketNamespace,RiakKeyNamespace))
-                btype.bucket(RiakDirectoryBucketNamespace).new(RiakKeyNamespace, encoded_data=str(os.stat(self._full_path(path)).st_size), content_type=riak_content_type)
-                mysizeset = datatypes.Set(bucket, RiakKeyNamespace)
-                mysizeset.add(str(os.stat(self._full_path(path)).st_size))
-
-                # send to RIAK afterall
-                myset.store()
-                mysizeset.store()
-                logger.debug('DONE updating directory structure')
+        logger.debug('updating on RIAK bucket %s the key %s', RiakBucketNamespace,RiakKeyNamespace)
+
+        if self.write_back is not None:
+            # the file is complete once it is closed - the write-back workers push it to RIAK, the caller doesn't wait for that
+            returnvalueclose = os.close(fh)
+            self.write_back.enqueue((RiakBucketNamespace,RiakKeyNamespace), path)
+            return returnvalueclose
+
+        # nobody else may touch this key (open/unlink/rename) while it is pushed to RIAK
+        with self.key_locks.lock((RiakBucketNamespace,RiakKeyNamespace)):
+            # the handle is closed whatever happens to the upload
+            try:
+                try:
+                    record = self._store_content(path, RiakBucketNamespace, RiakKeyNamespace)
+                except Exception as e:
+                    logger.error('ERROR updating on RIAK bucket %s the key %s (Exception: %s)'% (RiakBucketNamespace,RiakKeyNamespace,str(e)))
+                    if (durability == 'riak'):
+                        # flush left it to RIAK - the local copy is all there is now
+                        os.fsync(fh)
+                    return
+                # is the directory structure (also) maintained in RIAK - if so, go ahead and update properly
+                if (maintain_riak_directory_structure):
+                    self._add_to_directory(RiakKeyNamespace, RiakDirectoryBucketNamespace, record)
+            finally:
+                os.close(fh)
+
             # should the local copy of the file be removed or not
             if (remove_local_copy_after_successful_mapping):
-                logger.debug('removing local copy %s'% (path))
-                # first close it
-                returnvalueclose = os.close(fh)
-                # then remove it (just locally)
+                logger.debug('removing local copy %s', path)
+                # just locally, the handle is closed already
                 os.unlink(self._full_path(path))
-                # return the correct return value as per close
-                return returnvalueclose
             else:
-                logger.debug('not removing local copy %s'% (path))
-                return os.close(fh)
+                logger.debug('not removing local copy %s', path)
+
+    # this is what release does in the background when write-back is enabled - any exception makes the workers retry
+    def _write_back(self, path):
+        RiakBucketNamespace, RiakDirectoryBucketNamespace, RiakKeyNamespace = self.path_mapper.map(path)
+
+        with self.key_locks.lock((RiakBucketNamespace,RiakKeyNamespace)):
+            if not os.path.exists(self._full_path(path)):
+                # removed or renamed locally in the meantime - unlink/rename took care of RIAK already
+                logger.warning('%s is gone - nothing to write back.'% (path))
+                return
+            record = self._store_content(path, RiakBucketNamespace, RiakKeyNamespace)
+            if (maintain_riak_directory_structure):
+                self._add_to_directory(RiakKeyNamespace, RiakDirectoryBucketNamespace, record)
+            if (remove_local_copy_after_successful_mapping) and not self._is_open(path):
+                logger.debug('removing local copy %s', path)
+                os.unlink(self._full_path(path))
+
+    # tells whether a handle of path is still open (its local copy must stay until it is released)
+    def _is_open(self, path):
+        return any(handle['path'] == path for handle in list(self.handles.values()))
+
+    # pushes the local copy of path to its key in RIAK and returns its metadata record (the key lock has to be held)
+    def _store_content(self, path, RiakBucketNamespace, RiakKeyNamespace):
+        if self.blob_store is not None:
+            # uploaded only if no other file has the same contents (the blob store borrows its own connections)
+            record = self.blob_store.storeFile(RiakBucketNamespace, RiakKeyNamespace, self._full_path(path))
+        else:
+            # borrow a pooled RiakClient instance
+            with self.riak_pool.client() as riakClient:
+                # get the correct bucket
+                release_bucket = riakClient.bucket(RiakBucketNamespace)
+                # large files are stored chunk by chunk (only changed chunks are uploaded), memory is bounded by the upload budget
+                record = Uploader.storeFile(release_bucket, RiakKeyNamespace, self._full_path(path), riak_content_type, chunk_size, self.upload_budget, self.compressor,
+                                            quorum=self.quorum, deleter=self.chunk_deleter)
+        logger.debug('DONE updating on RIAK bucket %s the key %s (%s bytes written)', RiakBucketNamespace,RiakKeyNamespace,record['size'])
+        self.attr_cache.invalidate(path)
+        if self.content_cache is not None:
+            self.content_cache.invalidate((RiakBucketNamespace,RiakKeyNamespace))
+        return record
+
+    # lists the key in its directory set and stores its metadata (the key lock has to be held)
+    def _add_to_directory(self, RiakKeyNamespace, RiakDirectoryBucketNamespace, record):
+        logger.debug('updating %s directory structure for %s', RiakDirectoryBucketNamespace,RiakKeyNamespace)
+        # the size set / metadata record belongs to this key alone, it is stored right away
+        logger.debug('updating size (%s) entry in directory %s/%s', record['size'],RiakDirectoryBucketNamespace,RiakKeyNamespace)
+        with self.riak_pool.client() as riakClient:
+            self.riak_directory.store_size(riakClient, RiakDirectoryBucketNamespace, RiakKeyNamespace, record)
+        # Updating the $prefix+$id+$directoryprefix set with the given information - together with the other
+        # files of the directory with the next flush (right away without a flush window)
+        self.directory_updates.add(RiakDirectoryBucketNamespace, RiakKeyNamespace)
+        if self.key_index is not None:
+            self.key_index.add(RiakDirectoryBucketNamespace, RiakKeyNamespace)
+        if self.metadata_snapshot is not None:
+            # sizes sets have no mtime - neither has the snapshot then
+            self.metadata_snapshot.add(RiakDirectoryBucketNamespace, RiakKeyNamespace, record['size'], record['mtime'] if (riak_metadata == 'record') else None)
+        logger.debug('DONE updating directory structure')
+
     #################################### partially supported methods
     def readlink(self, path):
-        logger.debug('readlink %s'% (path))
-        RiakBucketNamespace = NameMapping.legacyPathToRiakBucketName(riak_namespace_prefix,path)
+        logger.debug('readlink %s', path)
+        RiakBucketNamespace = self.path_mapper.map(path).bucket
 
         if RiakBucketNamespace is None:
-            logger.debug('%s is not a mappable RIAK bucket - therefore readlink is supported '% (path))
+            logger.debug('%s is not a mappable RIAK bucket - therefore readlink is supported ', path)
             pathname = os.readlink(self._full_path(path))
-            logger.debug('Readlink Path %s'% (pathname))
+            logger.debug('Readlink Path %s', pathname)
             if pathname.startswith("/"):
                 # Path name is absolute, sanitize it.
                 return pathname
@@ -488,55 +1040,161 @@ class riakfuse(Operations):
     #################################### Unsupported Methods
 
     def symlink(self, name, target):
-        logger.debug('symlink %s - target: %s'% (name,target))
+        logger.debug('symlink %s - target: %s', name,target)
         logger.warning('symlink call is not supported')
         raise FuseOSError(errno.ENOTSUP)
 
     def link(self, path, target):
-        logger.debug('link %s - target: %s'% (path,target))
+        logger.debug('link %s - target: %s', path,target)
         logger.warning('link call is not supported')
         raise FuseOSError(errno.ENOTSUP)
     ########################################################
 
-def main(mountpoint, root, daemonize):
+# builds the filesystem from the configuration - riak_pool is the RIAK backend handing out clients
+# (RiakConnectionPool, RiakCluster, or FakeRiak.FakeRiakPool to run without a cluster)
+def build_filesystem(root, riak_pool):
+    if (metrics_port > 0):
+        metrics = Metrics()
+        # counts the RIAK requests of every filesystem call
+        riak_pool = metrics.instrument(riak_pool)
+    else:
+        metrics = None
+    attr_cache = AttributeCache(ttl=attr_cache_ttl, max_entries=attr_cache_size)
+    path_mapper = NameMapping.PathMapper(path_template, riak_namespace_prefix, riak_directory_namespace_prefix, cache_size=path_cache_size)
+    if (use_riak_file_contents_for_read_access) and (content_cache_dir is not None):
+        content_cache = ContentCache(content_cache_dir, content_cache_size*1024*1024)
+    else:
+        content_cache = None
+    return riakfuse(root, riak_pool, attr_cache, content_cache, path_mapper, metrics)
+
+def main(mountpoint, root, daemonize, multithreaded):
     logger.info("Starting up RIAKfuse...")
-    FUSE(riakfuse(root), mountpoint, nothreads=True, foreground=daemonize)
+    # one long-lived set of RIAK connections (per node) for the lifetime of the mount
+    riak_pool = RiakCluster.createPool(riak_host, riak_port, pool_size=riak_pool_size, keepalive_interval=riak_pool_keepalive, acquire_timeout=riak_pool_timeout,
+                                       retries=riak_retries, request_timeout=riak_request_timeout, balance=riak_balance, eject_after=riak_eject_after,
+                                       eject_interval=riak_eject_interval, probe_interval=riak_probe_interval)
+    if multithreaded:
+        logger.info('multi-threaded mode - up to %s RIAK connections per node are used in parallel'% (riak_pool_size))
+    # let the kernel cache attributes and lookups for as long as we do
+    FUSE(build_filesystem(root, riak_pool), mountpoint, nothreads=not multithreaded, foreground=daemonize, attr_timeout=attr_cache_ttl, entry_timeout=attr_cache_ttl)
 
-if __name__ == '__main__':
-    riak_port = 8087
+# the command line options of riak-fuse (also used by debugging/riak-fuse-benchmark.py)
+def argument_parser():
     parser = argparse.ArgumentParser(description='This script acts as glue between a local file storage mount point and RIAK. It\'s targeted at specific use cases when local mount-points need to be migrated to RIAK without changing the applications accessing those mount point. Think of it as a transparent RIAK filesystem layer with multiple options to control it\'s behavior regarding local files.')
     parser.add_argument('-s','--source', help='the source mount point', type=str, required=True)
     parser.add_argument('-t','--target', help='the target mount point', type=str, required=True)
     parser.add_argument('-f','--foreground', help='don\'t go into background on start-up', dest='foreground', action='store_true', default=False, required=False)
+    parser.add_argument('-mt','--multithreaded', help='serve filesystem calls in parallel threads instead of one after another', dest='multithreaded', action='store_true', default=False, required=False)
     parser.add_argument('-rp','--riakport', help='the port RIAK PBC is listening on', type=int, default=8087 , required=False)
-    parser.add_argument('-rh','--riakhost', help='the host or IP adress RIAK PBC is listening on', type=str, default='localhost' , required=False)
+    parser.add_argument('-rh','--riakhost', help='the host or IP adress RIAK PBC is listening on - a comma separated list of host[:port] spreads the requests over several nodes', type=str, default='localhost' , required=False)
+    parser.add_argument('-rps','--riak_pool_size', help='the maximum number of pooled RIAK PBC connections', type=int, default=8 , required=False)
+    parser.add_argument('-rpk','--riak_pool_keepalive', help='seconds between keepalive pings on idle RIAK connections (0 disables them)', type=int, default=30 , required=False)
+    parser.add_argument('-rpt','--riak_pool_timeout', help='seconds to wait for a free pooled RIAK connection', type=int, default=10 , required=False)
+    parser.add_argument('-rr','--riak_retries', help='how often a RIAK request is retried on a fresh connection', type=int, default=3 , required=False)
+    parser.add_argument('-rto','--riak_request_timeout', help='seconds a RIAK request may take before it fails and its connection is dropped (0 waits forever)', type=float, default=0 , required=False)
+    parser.add_argument('-rb','--riak_balance', help='how requests are spread over several RIAK nodes: least_outstanding (fewest requests in progress) or latency (lowest ping latency times requests in progress)', type=str, choices=list(RiakCluster.BALANCE_POLICIES), default=RiakCluster.LEAST_OUTSTANDING , required=False)
+    parser.add_argument('-rea','--riak_eject_after', help='the number of connection failures in a row after which a RIAK node gets no more requests', type=int, default=3 , required=False)
+    parser.add_argument('-rei','--riak_eject_interval', help='seconds an ejected RIAK node gets no requests before it is pinged again', type=float, default=10 , required=False)
+    parser.add_argument('-rpi','--riak_probe_interval', help='seconds between the pings measuring the latency of every RIAK node (set --riak_request_timeout, or a hanging node stalls the pings)', type=float, default=2 , required=False)
+    parser.add_argument('-pt','--path_template', help='which paths are stored in RIAK: {bucket} is the path component the bucket names are built from, {key} the file name, * any component', type=str, default=NameMapping.LEGACY_TEMPLATE , required=False)
+    parser.add_argument('-pcs','--path_cache_size', help='the number of mapped paths remembered', type=int, default=10000 , required=False)
     parser.add_argument('-rnp','--riak_namespace_prefix', help='the prefix given to each RIAK binary content bucket', type=str, default='IMG_' , required=False)
     parser.add_argument('-rdnp','--riak_directory_namespace_prefix', help='the prefix given to each RIAK directory content bucket', type=str, default='IMGDIR_' , required=False)
     parser.add_argument('-rbt','--riak_directory_set_buckettype', help='the RIAK bucket type name used for directory content buckets', type=str, default='sets' , required=False)
     parser.add_argument('-rdk','--riak_directory_set_directorykey', help='the reserved key name of the directory listing set', type=str, default='directory' , required=False)
+    parser.add_argument('-rmd','--riak_metadata', help='how file metadata is kept in the RIAK directory buckets: sets (one size set per file) or record (one JSON record with size, mtime, hash and chunk info per file - convert existing buckets with debugging/riak-convert-metadata.py first)', type=str, choices=['sets','record'], default='sets' , required=False)
+    parser.add_argument('-rds','--riak_directory_shards', help='the number of sets the directory listing of a directory bucket is spread over (0 keeps the single directory set - split existing ones with debugging/riak-shard-directory.py first)', type=int, default=0 , required=False)
     parser.add_argument('-rct','--riak_content_type', help='the mime type used for the RIAK binary content', type=str, default='application/octet-stream' , required=False)
     parser.add_argument('-dell','--delete_local', help='when present the local copy of a file shall be removed when it was successfully transferred to RIAK', dest='delete_local', action='store_true', default=False , required=False)
     parser.add_argument('-ddir','--disable_maintain_directory', help='when present the directory structure will NOT be maintained in RIAK', dest='disable_maintain_directory', action='store_false', default=True , required=False)
     parser.add_argument('-rreadcontent','--use_riak_read_content', help='should the contents of RIAK be used to fulfill read accesses to files', dest='use_riak_read_content', action='store_true', default=False , required=False)
     parser.add_argument('-rreaddir','--use_riak_read_directory', help='should also the maintained RIAK datastructure be used for directory read access', dest='use_riak_read_directory', action='store_true', default=False , required=False)
+    parser.add_argument('-act','--attr_cache_ttl', help='seconds file attributes read from RIAK are cached (also passed to the kernel as attr_timeout/entry_timeout)', type=float, default=1.0 , required=False)
+    parser.add_argument('-acs','--attr_cache_size', help='the maximum number of cached file attributes', type=int, default=10000 , required=False)
+    parser.add_argument('-rpb','--readdir_prefetch_batch', help='the number of listed files whose sizes are fetched together right after a readdir from RIAK (0 disables the prefetch)', type=int, default=0 , required=False)
+    parser.add_argument('-rpc','--readdir_prefetch_concurrency', help='the number of prefetch batches fetched in parallel', type=int, default=4 , required=False)
+    parser.add_argument('-rpl','--readdir_prefetch_ttl', help='seconds prefetched file sizes stay in the attribute cache (at least as long as the stats following a listing take)', type=float, default=10.0 , required=False)
+    parser.add_argument('-kir','--key_index_refresh', help='enables an in-memory Bloom filter per directory that answers lookups of missing files without RIAK, reloaded every this many seconds (0 disables the index)', type=int, default=0 , required=False)
+    parser.add_argument('-kid','--key_index_directories', help='the maximum number of directories kept in the key index', type=int, default=1000 , required=False)
+    parser.add_argument('-mss','--metadata_snapshot', help='SQLite file the RIAK directory listings and sizes used by the mount are saved in, to be answered from right after the next start until they are reconciled with RIAK', type=str, default=None , required=False)
+    parser.add_argument('-msi','--metadata_snapshot_interval', help='seconds between saves of the metadata snapshot (it is also saved when unmounting, 0 only then)', type=int, default=300 , required=False)
+    parser.add_argument('-msd','--metadata_snapshot_directories', help='the maximum number of directories kept in the metadata snapshot', type=int, default=10000 , required=False)
+    parser.add_argument('-msr','--metadata_snapshot_rate', help='directories of the metadata snapshot reconciled with RIAK per second after a start (0: as fast as possible)', type=float, default=5.0 , required=False)
+    parser.add_argument('-ccd','--content_cache_dir', help='directory used to cache RIAK contents read by open() (enables the content cache)', type=str, default=None , required=False)
+    parser.add_argument('-ccs','--content_cache_size', help='the maximum size of the content cache in MB', type=int, default=1024 , required=False)
+    parser.add_argument('-ccv','--content_cache_validation', help='how a cached copy is checked against RIAK before it is used: vclock (head request) or size (stored size, usually cached already)', type=str, choices=['vclock','size'], default='vclock' , required=False)
+    parser.add_argument('-cpd','--content_prefetch_depth', help='how many files following the opened one are fetched into the content cache ahead of their open when a directory is read file by file in listing order (0 disables it)', type=int, default=8 , required=False)
+    parser.add_argument('-cpc','--content_prefetch_concurrency', help='how many files of a directory scan are fetched in parallel', type=int, default=4 , required=False)
+    parser.add_argument('-cpn','--content_prefetch_names', help='how many names of a directory listing are remembered to detect a scan through it (files after them are not fetched ahead)', type=int, default=10000 , required=False)
+    parser.add_argument('-cpm','--content_prefetch_memory', help='the maximum size in MB of the files fetched ahead at the same time', type=int, default=64 , required=False)
+    parser.add_argument('-wbj','--write_back_journal', help='journal file of pending uploads - enables write-back: closed files are uploaded to RIAK in the background', type=str, default=None , required=False)
+    parser.add_argument('-wbw','--write_back_workers', help='the number of background upload workers in write-back mode', type=int, default=4 , required=False)
+    parser.add_argument('-wbq','--write_back_queue', help='the maximum number of queued uploads in write-back mode (closing files waits when it is reached)', type=int, default=1000 , required=False)
+    parser.add_argument('-wbb','--write_back_backoff', help='seconds before a failed upload is retried the first time (doubled on every further failure)', type=float, default=1.0 , required=False)
+    parser.add_argument('-wbd','--write_back_drain_timeout', help='seconds unmounting waits for pending uploads before leaving them in the journal', type=int, default=60 , required=False)
+    parser.add_argument('-wbt','--write_back_wait_timeout', help='seconds unlink and rename wait for a pending upload of the file before failing with EAGAIN', type=int, default=10 , required=False)
+    parser.add_argument('-chs','--chunk_size', help='files larger than this many KB are stored in RIAK as chunks of this size plus a manifest, renaming them only copies the manifest (0 disables chunked storage - a rename copies the whole file then, unless --dedup is used)', type=int, default=0 , required=False)
+    parser.add_argument('-chr','--chunk_readahead', help='the number of chunks fetched ahead when a chunked file is read', type=int, default=2 , required=False)
+    parser.add_argument('-chw','--chunk_readahead_workers', help='the number of threads fetching chunks ahead for all readers of chunked files', type=int, default=4 , required=False)
+    parser.add_argument('-chg','--chunk_delete_grace', help='seconds the chunks of a replaced or removed chunked file are kept for readers that still have its old manifest (0 deletes them right away)', type=int, default=60 , required=False)
+    parser.add_argument('-dfw','--directory_flush_window', help='seconds changes to a RIAK directory set are collected before they are written in one go (0 writes every change right away)', type=float, default=0 , required=False)
+    parser.add_argument('-dfb','--directory_flush_batch', help='the number of collected changes to a directory set that are written right away', type=int, default=1000 , required=False)
+    parser.add_argument('-cmp','--compression', help='the codec stored contents are compressed with: zlib, zstd (needs the zstandard module) or none - already compressed formats are stored as they are', type=str, choices=['none','zlib','zstd'], default='none' , required=False)
+    parser.add_argument('-cml','--compression_level', help='the compression level (0 uses the default of the codec: 1 for zlib, 3 for zstd)', type=int, default=0 , required=False)
+    parser.add_argument('-dd','--dedup', help='store identical contents only once: files refer to a blob named after their sha1, blobs are deleted with their last reference (all mounts on the same buckets need this option)', dest='dedup', action='store_true', default=False , required=False)
+    parser.add_argument('-ddb','--dedup_bucket', help='the RIAK bucket the deduplicated blobs are stored in (their reference sets in the same bucket of --riak_directory_set_buckettype)', type=str, default='IMGBLOBS' , required=False)
+    parser.add_argument('-dur','--durability', help='how closed files are made durable: always (fsync on every close), group (closed files are synced together every --group_commit_window seconds, explicit fsyncs wait for it) or riak (no fsync of files RIAK acknowledged on close - see --riak_w/--riak_dw/--riak_pw)', type=str, choices=['always','group','riak'], default='always' , required=False)
+    parser.add_argument('-gcw','--group_commit_window', help='seconds closed files are collected before they are synced together in durability mode group', type=float, default=0.05 , required=False)
+    parser.add_argument('-gcs','--group_commit_syncfs', help='sync a group with one syncfs(2) per filesystem instead of one fdatasync per file (Linux only; writes out everything dirty on the filesystem, write errors are only reported by Linux 5.8 and later)', dest='group_commit_syncfs', action='store_true', default=False , required=False)
+    parser.add_argument('-rw','--riak_w', help='the number of RIAK replicas that have to acknowledge a stored content (a number, one, quorum or all - the bucket default if not given)', type=str, default=None , required=False)
+    parser.add_argument('-rdw','--riak_dw', help='the number of RIAK replicas that have to write a stored content to disk before it is acknowledged (durability mode riak should have at least 1)', type=str, default=None , required=False)
+    parser.add_argument('-rpw','--riak_pw', help='the number of primary RIAK replicas (no fallbacks) that have to acknowledge a stored content', type=str, default=None , required=False)
+    parser.add_argument('-um','--upload_memory', help='the maximum MB of file contents held in memory by all running uploads together (0 means unlimited)', type=int, default=256 , required=False)
+    parser.add_argument('-ll','--log_level', help='the minimum level of logged messages', type=str, choices=['CRITICAL','ERROR','WARNING','INFO','DEBUG'], default='INFO' , required=False)
+    parser.add_argument('-mp','--metrics_port', help='port serving latency histograms, RIAK request counters and cache/queue stats in the Prometheus text format on /metrics (0 disables the metrics)', type=int, default=0 , required=False)
+    parser.add_argument('-ma','--metrics_address', help='the address the metrics port is bound to', type=str, default='127.0.0.1' , required=False)
     parser.add_argument('-rfuid','--riak_contents_file_uid', help='the UID used for files when RIAK is used for read directory access', type=int, default=0 , required=False)
     parser.add_argument('-rfgid','--riak_contents_file_gid', help='the GID used for files when RIAK is used for read directory access', type=int, default=0 , required=False)
-    args = vars(parser.parse_args())
-
-    ##################################################################################################
-    # configuration
-    ##################################################################################################
-    logger.debug('Source mount point: %s'% (args['source']))
-    logger.debug('Target mount point: %s'% (args['target']))
+    return parser
 
+# sets the configuration globals the filesystem methods read from the parsed command line
+def configure(args):
+    global riak_port, riak_host, riak_pool_size, riak_pool_keepalive, riak_pool_timeout, riak_retries, \
+        riak_request_timeout, riak_balance, riak_eject_after, riak_eject_interval, riak_probe_interval, \
+        path_template, path_cache_size, riak_namespace_prefix, riak_directory_namespace_prefix, \
+        riak_directory_set_buckettype, riak_directory_set_directorykey, riak_directory_shards, \
+        riak_content_type, riak_metadata, remove_local_copy_after_successful_mapping, \
+        maintain_riak_directory_structure, use_riak_directory_structure_for_read_access, \
+        use_riak_file_contents_for_read_access, riak_contents_file_mask, riak_contents_file_uid, \
+        riak_contents_file_gid, attr_cache_ttl, attr_cache_size, readdir_prefetch_batch, \
+        readdir_prefetch_concurrency, readdir_prefetch_ttl, key_index_refresh, key_index_directories, metadata_snapshot, \
+        metadata_snapshot_interval, metadata_snapshot_directories, metadata_snapshot_rate, content_cache_dir, \
+        content_cache_size, content_cache_validation, content_prefetch_depth, content_prefetch_concurrency, \
+        content_prefetch_memory, content_prefetch_names, chunk_size, chunk_readahead, chunk_readahead_workers, chunk_delete_grace, upload_memory, \
+        directory_flush_window, directory_flush_batch, write_back_journal, write_back_workers, \
+        write_back_queue, write_back_backoff, write_back_drain_timeout, write_back_wait_timeout, metrics_port, metrics_address, \
+        compression, compression_level, dedup, dedup_bucket, durability, group_commit_window, group_commit_syncfs, riak_w, riak_dw, riak_pw
     # RIAK related
     riak_port = args['riakport']
     riak_host = args['riakhost']
+    riak_pool_size = args['riak_pool_size']
+    riak_pool_keepalive = args['riak_pool_keepalive']
+    riak_pool_timeout = args['riak_pool_timeout']
+    riak_retries = args['riak_retries']
+    riak_request_timeout = args['riak_request_timeout']
+    riak_balance = args['riak_balance']
+    riak_eject_after = args['riak_eject_after']
+    riak_eject_interval = args['riak_eject_interval']
+    riak_probe_interval = args['riak_probe_interval']
+    path_template = args['path_template']
+    path_cache_size = args['path_cache_size']
     riak_namespace_prefix = args['riak_namespace_prefix']
     riak_directory_namespace_prefix = args['riak_directory_namespace_prefix']
     riak_directory_set_buckettype = args['riak_directory_set_buckettype']
     riak_directory_set_directorykey = args['riak_directory_set_directorykey']
+    riak_directory_shards = args['riak_directory_shards']
     riak_content_type = args['riak_content_type']
+    riak_metadata = args['riak_metadata']
 
     # Options / Flags
     remove_local_copy_after_successful_mapping = args['delete_local']       # wether or not the local copy of a file shall be removed when it was successfully transferred to RIAK, default=False
@@ -546,7 +1204,71 @@ if __name__ == '__main__':
     riak_contents_file_mask = 0o777
     riak_contents_file_uid = args['riak_contents_file_uid']
     riak_contents_file_gid = args['riak_contents_file_gid']
-    logger.setLevel(logging.DEBUG)
+    attr_cache_ttl = args['attr_cache_ttl']
+    attr_cache_size = args['attr_cache_size']
+    readdir_prefetch_batch = args['readdir_prefetch_batch']
+    readdir_prefetch_concurrency = args['readdir_prefetch_concurrency']
+    readdir_prefetch_ttl = args['readdir_prefetch_ttl']
+    key_index_refresh = args['key_index_refresh']
+    key_index_directories = args['key_index_directories']
+    metadata_snapshot = os.path.abspath(args['metadata_snapshot']) if args['metadata_snapshot'] else None
+    metadata_snapshot_interval = args['metadata_snapshot_interval']
+    metadata_snapshot_directories = args['metadata_snapshot_directories']
+    metadata_snapshot_rate = args['metadata_snapshot_rate']
+    # FUSE changes into / when it goes into background - so all paths have to be absolute
+    content_cache_dir = os.path.abspath(args['content_cache_dir']) if args['content_cache_dir'] else None
+    content_cache_size = args['content_cache_size']
+    content_cache_validation = args['content_cache_validation']
+    content_prefetch_depth = args['content_prefetch_depth']
+    content_prefetch_concurrency = args['content_prefetch_concurrency']
+    content_prefetch_memory = args['content_prefetch_memory']
+    content_prefetch_names = args['content_prefetch_names']
+    chunk_size = args['chunk_size']*1024
+    chunk_readahead = args['chunk_readahead']
+    chunk_readahead_workers = args['chunk_readahead_workers']
+    chunk_delete_grace = args['chunk_delete_grace']
+    upload_memory = args['upload_memory']
+    compression = args['compression']
+    compression_level = args['compression_level']
+    dedup = args['dedup']
+    dedup_bucket = args['dedup_bucket']
+    durability = args['durability']
+    group_commit_window = args['group_commit_window']
+    group_commit_syncfs = args['group_commit_syncfs']
+    # RIAK takes the quorums as numbers or as one/quorum/all/default
+    riak_w, riak_dw, riak_pw = [int(value) if (value is not None) and value.isdigit() else value
+                                for value in (args['riak_w'], args['riak_dw'], args['riak_pw'])]
+    directory_flush_window = args['directory_flush_window']
+    directory_flush_batch = args['directory_flush_batch']
+    write_back_journal = os.path.abspath(args['write_back_journal']) if args['write_back_journal'] else None
+    write_back_workers = args['write_back_workers']
+    write_back_queue = args['write_back_queue']
+    write_back_backoff = args['write_back_backoff']
+    write_back_drain_timeout = args['write_back_drain_timeout']
+    write_back_wait_timeout = args['write_back_wait_timeout']
+    metrics_port = args['metrics_port']
+    metrics_address = args['metrics_address']
+
+if __name__ == '__main__':
+    parser = argument_parser()
+    args = vars(parser.parse_args())
+    try:
+        NameMapping.PathMapper(args['path_template'], '', '')
+        RiakCluster.parseNodes(args['riakhost'], args['riakport'])
+    except ValueError as e:
+        parser.error(str(e))
+    if (args['compression'] != 'none') and not Compression.available(args['compression']):
+        parser.error('--compression %s needs the zstandard module'% (args['compression']))
+
+    ##################################################################################################
+    # configuration
+    ##################################################################################################
+    # debug messages are not even formatted below the configured level
+    logger.setLevel(getattr(logging, args['log_level']))
+    logger.debug('Source mount point: %s', args['source'])
+    logger.debug('Target mount point: %s', args['target'])
+
+    configure(args)
 
     # call main with parameters set
-    main(args['target'], args['source'],  args['foreground'])
+    main(args['target'], args['source'],  args['foreground'], args['multithreaded'])
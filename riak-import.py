@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# imports an existing source tree into RIAK - with the same buckets, keys and directory structure a mount
+# with the same options would create. Interrupted imports are resumed from the checkpoint file.
+#
+# Example:
+#        python riak-import.py -s /mnt/source -cp /var/lib/riak-fuse/import.checkpoint -w 16
+#        python riak-import.py -s /mnt/source -cp /var/lib/riak-fuse/import.checkpoint -w 16 --delete_local
+
+import os
+import sys
+import logging
+import argparse
+import NameMapping
+import Compression
+from Uploader import UploadBudget
+import RiakCluster
+from RiakDirectory import RiakDirectory
+from BlobStore import BlobStore
+from BulkImporter import BulkImporter, ImportCheckpoint
+
+# Log related
+logger = logging.getLogger('root')
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setFormatter(log_formatter)
+logger.addHandler(ch)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='imports the files of a source mount point into RIAK in parallel, like riak-fuse.py would store them when they are closed')
+    parser.add_argument('-s','--source', help='the source mount point', type=str, required=True)
+    parser.add_argument('-cp','--checkpoint', help='file recording the imported files - a run with the same file skips them', type=str, default=None , required=False)
+    parser.add_argument('-w','--workers', help='the number of files uploaded in parallel', type=int, default=8 , required=False)
+    parser.add_argument('-pi','--progress_interval', help='seconds between progress reports (0 only reports at the end)', type=int, default=10 , required=False)
+    parser.add_argument('-rp','--riakport', help='the port RIAK PBC is listening on', type=int, default=8087 , required=False)
+    parser.add_argument('-rh','--riakhost', help='the host or IP adress RIAK PBC is listening on - a comma separated list of host[:port] spreads the requests over several nodes', type=str, default='localhost' , required=False)
+    parser.add_argument('-rr','--riak_retries', help='how often a RIAK request is retried on a fresh connection', type=int, default=3 , required=False)
+    parser.add_argument('-rto','--riak_request_timeout', help='seconds a RIAK request may take before it fails (0 waits forever)', type=float, default=0 , required=False)
+    parser.add_argument('-rb','--riak_balance', help='how requests are spread over several RIAK nodes: least_outstanding or latency', type=str, choices=list(RiakCluster.BALANCE_POLICIES), default=RiakCluster.LEAST_OUTSTANDING , required=False)
+    parser.add_argument('-pt','--path_template', help='which paths are stored in RIAK: {bucket} is the path component the bucket names are built from, {key} the file name, * any component', type=str, default=NameMapping.LEGACY_TEMPLATE , required=False)
+    parser.add_argument('-rnp','--riak_namespace_prefix', help='the prefix given to each RIAK binary content bucket', type=str, default='IMG_' , required=False)
+    parser.add_argument('-rdnp','--riak_directory_namespace_prefix', help='the prefix given to each RIAK directory content bucket', type=str, default='IMGDIR_' , required=False)
+    parser.add_argument('-rbt','--riak_directory_set_buckettype', help='the RIAK bucket type name used for directory content buckets', type=str, default='sets' , required=False)
+    parser.add_argument('-rdk','--riak_directory_set_directorykey', help='the reserved key name of the directory listing set', type=str, default='directory' , required=False)
+    parser.add_argument('-rmd','--riak_metadata', help='how file metadata is kept in the RIAK directory buckets: sets or record (as used by the mount)', type=str, choices=['sets','record'], default='sets' , required=False)
+    parser.add_argument('-rds','--riak_directory_shards', help='the number of sets the directory listing of a directory bucket is spread over (as used by the mount)', type=int, default=0 , required=False)
+    parser.add_argument('-rct','--riak_content_type', help='the mime type used for the RIAK binary content', type=str, default='application/octet-stream' , required=False)
+    parser.add_argument('-dell','--delete_local', help='when present the local copy of a file shall be removed when it was successfully transferred to RIAK', dest='delete_local', action='store_true', default=False , required=False)
+    parser.add_argument('-ddir','--disable_maintain_directory', help='when present the directory structure will NOT be maintained in RIAK', dest='disable_maintain_directory', action='store_false', default=True , required=False)
+    parser.add_argument('-chs','--chunk_size', help='files larger than this many KB are stored in RIAK as chunks of this size plus a manifest (0 disables chunked storage)', type=int, default=0 , required=False)
+    parser.add_argument('-cmp','--compression', help='the codec imported contents are compressed with: zlib, zstd (needs the zstandard module) or none (as used by the mount)', type=str, choices=['none','zlib','zstd'], default='none' , required=False)
+    parser.add_argument('-cml','--compression_level', help='the compression level (0 uses the default of the codec)', type=int, default=0 , required=False)
+    parser.add_argument('-dd','--dedup', help='store identical contents only once, as references to shared blobs (as used by the mount)', dest='dedup', action='store_true', default=False , required=False)
+    parser.add_argument('-ddb','--dedup_bucket', help='the RIAK bucket the deduplicated blobs are stored in (as used by the mount)', type=str, default='IMGBLOBS' , required=False)
+    parser.add_argument('-um','--upload_memory', help='the maximum MB of file contents held in memory by all running uploads together (0 means unlimited)', type=int, default=256 , required=False)
+    parser.add_argument('-dfw','--directory_flush_window', help='seconds new files are collected before they are added to their directory set in one go', type=float, default=5.0 , required=False)
+    parser.add_argument('-dfb','--directory_flush_batch', help='the number of collected files that are added to a directory set right away', type=int, default=1000 , required=False)
+    parser.add_argument('-v','--verbose', help='log every file', dest='verbose', action='store_true', default=False , required=False)
+    args = parser.parse_args()
+
+    try:
+        path_mapper = NameMapping.PathMapper(args.path_template, args.riak_namespace_prefix, args.riak_directory_namespace_prefix)
+        RiakCluster.parseNodes(args.riakhost, args.riakport)
+    except ValueError as e:
+        parser.error(str(e))
+    if not os.path.isdir(args.source):
+        parser.error('%s is no directory'% (args.source))
+    if (args.compression != 'none') and not Compression.available(args.compression):
+        parser.error('--compression %s needs the zstandard module'% (args.compression))
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    # every worker holds one connection while it uploads, directory flushes need one more
+    riak_pool = RiakCluster.createPool(args.riakhost, args.riakport, pool_size=args.workers + 1, retries=args.riak_retries,
+                                       request_timeout=args.riak_request_timeout, balance=args.riak_balance)
+    riak_pool.start()
+    if args.disable_maintain_directory:
+        riak_directory = RiakDirectory(riak_pool, bucket_type=args.riak_directory_set_buckettype, directory_key=args.riak_directory_set_directorykey, shards=args.riak_directory_shards, metadata=args.riak_metadata)
+    else:
+        riak_directory = None
+    checkpoint = ImportCheckpoint(os.path.abspath(args.checkpoint)) if args.checkpoint else None
+    budget = UploadBudget(args.upload_memory*1024*1024) if args.upload_memory > 0 else None
+    compressor = Compression.Compressor(args.compression, level=args.compression_level) if args.compression != 'none' else None
+    if args.dedup:
+        blob_store = BlobStore(riak_pool, args.dedup_bucket, bucket_type=args.riak_directory_set_buckettype, content_type=args.riak_content_type,
+                               chunk_size=args.chunk_size*1024, budget=budget, compressor=compressor)
+    else:
+        blob_store = None
+
+    importer = BulkImporter(os.path.abspath(args.source), riak_pool, path_mapper, riak_directory, checkpoint, content_type=args.riak_content_type,
+                            chunk_size=args.chunk_size*1024, budget=budget, workers=args.workers, delete_local=args.delete_local,
+                            flush_window=args.directory_flush_window, flush_batch=args.directory_flush_batch, compressor=compressor,
+                            blob_store=blob_store)
+    try:
+        stats = importer.run(progress_interval=args.progress_interval)
+    finally:
+        riak_pool.close()
+    logger.info('%s files not matching the path template were left alone, %s local copies removed'% (stats['unmappable'],stats['deleted']))
+    if blob_store is not None:
+        dedup = blob_store.stats()
+        logger.info('%s files stored as %s blobs - %.1f MB saved, dedup ratio %.2f'% (dedup['stored'],dedup['uploaded'],dedup['bytes_saved'] / 1048576.0,dedup['dedup_ratio']))
+    sys.exit(1 if stats['failed'] else 0)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# 2017, Daniel Kirstenpfad
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# checks that the local files, the RIAK content buckets and the RIAK directory buckets agree with each other
+# and reports (or with --repair fixes) every difference - see Scrubber.py for what is compared and repaired.
+# All RIAK requests are rate limited, so it can run next to mounts serving live traffic.
+#
+# Example:
+#        python riak-scrub.py -s /mnt/source
+#        python riak-scrub.py test other --repair --rate_limit 50
+#        python riak-scrub.py -s /mnt/source test --verify_content --stream_keys
+
+import os
+import sys
+import logging
+import argparse
+import NameMapping
+import Compression
+from RateLimiter import RateLimiter
+import RiakCluster
+from RiakDirectory import RiakDirectory
+from BlobStore import BlobStore
+from Scrubber import Scrubber, PROBLEMS
+
+# Log related
+logger = logging.getLogger('root')
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch = logging.StreamHandler()
+ch.setFormatter(log_formatter)
+logger.addHandler(ch)
+
+# returns (bucket, directory bucket) -> {key: local path} of all mappable files below root
+def localFiles(root, path_mapper):
+    folders = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            name = path_mapper.map('/' + os.path.relpath(full_path, root).replace(os.sep, '/'))
+            if name.key is not None and os.path.isfile(full_path):
+                folders.setdefault((name.bucket, name.directory_bucket), {})[name.key] = full_path
+    return folders
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compares local files, RIAK contents and the RIAK directory structure and reports or repairs the differences')
+    parser.add_argument('folders', help='the folders ({bucket} part of the path template) to scrub - all folders of the source mount point if none are given', nargs='*')
+    parser.add_argument('-s','--source', help='the source mount point holding the local copies', type=str, default=None , required=False)
+    parser.add_argument('--repair', help='repair the differences instead of only reporting them', dest='repair', action='store_true', default=False)
+    parser.add_argument('--verify_content', help='fetch the contents and compare their length and sha1 (otherwise only their existence is checked)', dest='verify_content', action='store_true', default=False)
+    parser.add_argument('--stream_keys', help='also list the content buckets to find contents missing from the directory structure (a full key listing - expensive on large clusters)', dest='stream_keys', action='store_true', default=False)
+    parser.add_argument('-w','--workers', help='the number of keys inspected in parallel', type=int, default=8 , required=False)
+    parser.add_argument('-rl','--rate_limit', help='the maximum number of RIAK requests per second (0 means unlimited)', type=float, default=100 , required=False)
+    parser.add_argument('-g','--grace', help='seconds a difference has to persist before it counts - longer than the directory flush window of the mounts', type=float, default=10 , required=False)
+    parser.add_argument('-rp','--riakport', help='the port RIAK PBC is listening on', type=int, default=8087 , required=False)
+    parser.add_argument('-rh','--riakhost', help='the host or IP adress RIAK PBC is listening on - a comma separated list of host[:port] spreads the requests over several nodes', type=str, default='localhost' , required=False)
+    parser.add_argument('-rr','--riak_retries', help='how often a RIAK request is retried on a fresh connection', type=int, default=3 , required=False)
+    parser.add_argument('-rto','--riak_request_timeout', help='seconds a RIAK request may take before it fails (0 waits forever)', type=float, default=0 , required=False)
+    parser.add_argument('-rb','--riak_balance', help='how requests are spread over several RIAK nodes: least_outstanding or latency', type=str, choices=list(RiakCluster.BALANCE_POLICIES), default=RiakCluster.LEAST_OUTSTANDING , required=False)
+    parser.add_argument('-pt','--path_template', help='which paths are stored in RIAK: {bucket} is the path component the bucket names are built from, {key} the file name, * any component', type=str, default=NameMapping.LEGACY_TEMPLATE , required=False)
+    parser.add_argument('-rnp','--riak_namespace_prefix', help='the prefix given to each RIAK binary content bucket', type=str, default='IMG_' , required=False)
+    parser.add_argument('-rdnp','--riak_directory_namespace_prefix', help='the prefix given to each RIAK directory content bucket', type=str, default='IMGDIR_' , required=False)
+    parser.add_argument('-rbt','--riak_directory_set_buckettype', help='the RIAK bucket type name used for directory content buckets', type=str, default='sets' , required=False)
+    parser.add_argument('-rdk','--riak_directory_set_directorykey', help='the reserved key name of the directory listing set', type=str, default='directory' , required=False)
+    parser.add_argument('-rmd','--riak_metadata', help='how file metadata is kept in the RIAK directory buckets: sets or record (as used by the mount)', type=str, choices=['sets','record'], default='sets' , required=False)
+    parser.add_argument('-rds','--riak_directory_shards', help='the number of sets the directory listing of a directory bucket is spread over (as used by the mount)', type=int, default=0 , required=False)
+    parser.add_argument('-rct','--riak_content_type', help='the mime type used for re-uploaded RIAK binary content', type=str, default='application/octet-stream' , required=False)
+    parser.add_argument('-chs','--chunk_size', help='re-uploaded files larger than this many KB are stored as chunks (as used by the mount)', type=int, default=0 , required=False)
+    parser.add_argument('-cmp','--compression', help='the codec re-uploaded contents are compressed with: zlib, zstd (needs the zstandard module) or none (as used by the mount)', type=str, choices=['none','zlib','zstd'], default='none' , required=False)
+    parser.add_argument('-cml','--compression_level', help='the compression level (0 uses the default of the codec)', type=int, default=0 , required=False)
+    parser.add_argument('-dd','--dedup', help='re-upload files as references to shared blobs (as used by the mount)', dest='dedup', action='store_true', default=False , required=False)
+    parser.add_argument('-ddb','--dedup_bucket', help='the RIAK bucket the deduplicated blobs are stored in (as used by the mount)', type=str, default='IMGBLOBS' , required=False)
+    args = parser.parse_args()
+
+    try:
+        path_mapper = NameMapping.PathMapper(args.path_template, args.riak_namespace_prefix, args.riak_directory_namespace_prefix)
+        RiakCluster.parseNodes(args.riakhost, args.riakport)
+    except ValueError as e:
+        parser.error(str(e))
+    if not args.folders and not args.source:
+        parser.error('give the folders to scrub or a source mount point')
+    if (args.compression != 'none') and not Compression.available(args.compression):
+        parser.error('--compression %s needs the zstandard module'% (args.compression))
+    logger.setLevel(logging.INFO)
+
+    local = localFiles(os.path.abspath(args.source), path_mapper) if args.source else {}
+    if args.folders:
+        names = [(args.riak_namespace_prefix + folder, args.riak_directory_namespace_prefix + folder) for folder in args.folders]
+    else:
+        names = sorted(local)
+
+    riak_pool = RiakCluster.createPool(args.riakhost, args.riakport, pool_size=args.workers + 1, retries=args.riak_retries,
+                                       request_timeout=args.riak_request_timeout, balance=args.riak_balance)
+    riak_pool.start()
+    compressor = Compression.Compressor(args.compression, level=args.compression_level) if args.compression != 'none' else None
+    blob_store = BlobStore(riak_pool, args.dedup_bucket, bucket_type=args.riak_directory_set_buckettype, content_type=args.riak_content_type,
+                           chunk_size=args.chunk_size*1024, compressor=compressor) if args.dedup else None
+    riak_directory = RiakDirectory(riak_pool, bucket_type=args.riak_directory_set_buckettype, directory_key=args.riak_directory_set_directorykey, shards=args.riak_directory_shards, metadata=args.riak_metadata)
+    scrubber = Scrubber(riak_pool, riak_directory, RateLimiter(args.rate_limit), workers=args.workers, repair=args.repair, verify_content=args.verify_content,
+                        stream_keys=args.stream_keys, grace=args.grace, content_type=args.riak_content_type, chunk_size=args.chunk_size*1024, compressor=compressor,
+                        blob_store=blob_store)
+    scrubber.start()
+    try:
+        for bucket, directory in names:
+            try:
+                scrubber.scrub(bucket, directory, local.get((bucket, directory), {}))
+            except Exception as e:
+                logger.error('ERROR scrubbing %s (Exception: %s)'% (directory,str(e)))
+                scrubber.failed += 1
+    finally:
+        scrubber.close()
+        riak_pool.close()
+
+    stats = scrubber.stats()
+    logger.info('%s directories, %s keys checked, %s repaired, %s failed, %.1fs waited for the rate limit'% (stats['directories'],stats['checked'],stats['repaired'],stats['failed'],stats['waited']))
+    logger.info(', '.join('%s: %s'% (problem,stats[problem]) for problem in PROBLEMS))
+    sys.exit(1 if stats['failed'] or (sum(stats[problem] for problem in PROBLEMS) and not args.repair) else 0)